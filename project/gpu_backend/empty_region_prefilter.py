@@ -0,0 +1,49 @@
+import cv2
+import numpy as np
+
+EMPTY_PREDICTION = {"coord": [], "points": [], "prob": [], "count": 0, "outlines": []}
+
+
+class EmptyRegionPrefilter:
+    """Flag egg-laying regions that are very unlikely to contain any eggs, so
+    that they can be skipped instead of being run through the egg detector.
+
+    Regions are scored by their strongest blob-like response at roughly the
+    scale of an egg (a difference of Gaussians), relative to the region's
+    background noise. Blank agarose scores low; any egg-sized object with
+    contrast against its surroundings scores high.
+    """
+
+    def __init__(self, threshold, sigma_small=1.5, sigma_large=6, percentile=99.9):
+        """Create a new EmptyRegionPrefilter instance.
+
+        Arguments:
+          - threshold: regions scoring below this value are considered empty
+          - sigma_small: standard deviation (in pixels) of the Gaussian used to
+                         smooth away pixel noise
+          - sigma_large: standard deviation (in pixels) of the Gaussian used to
+                         estimate the local background
+          - percentile: percentile of the absolute blob response used as the
+                        region's score
+        """
+        self.threshold = threshold
+        self.sigma_small = sigma_small
+        self.sigma_large = sigma_large
+        self.percentile = percentile
+
+    def score(self, img):
+        """Return the contrast score of a (normalized) region image."""
+        if img.size == 0:
+            return 0.0
+        gray = np.asarray(img, dtype=np.float32)
+        if gray.ndim == 3:
+            gray = gray.mean(axis=2)
+        dog = cv2.GaussianBlur(gray, (0, 0), self.sigma_small) - cv2.GaussianBlur(
+            gray, (0, 0), self.sigma_large
+        )
+        deviation = np.abs(dog - np.median(dog))
+        noise = 1.4826 * np.median(deviation)
+        return float(np.percentile(deviation, self.percentile) / max(noise, 1e-6))
+
+    def is_empty(self, img):
+        return self.score(img) < self.threshold
@@ -0,0 +1,90 @@
+from collections import OrderedDict
+import inspect
+import threading
+import torch
+
+from project.detectors.splinedist.config import Config
+from project.detectors.splinedist.models.model2d import SplineDist2D
+from project.lib.web.gpu_task_types import GPUTaskTypes
+
+TORCH_LOAD_SUPPORTS_MMAP = "mmap" in inspect.signature(torch.load).parameters
+
+
+class ModelManager:
+    """Load detection networks on first use and keep them resident on the GPU
+    within a memory budget, evicting the least recently used ones as needed."""
+
+    def __init__(self, network_consts, memory_budget=None, use_mmap=True):
+        """Create a new ModelManager instance.
+
+        Arguments:
+          - network_consts: dict mapping each GPUTaskTypes member to the paths
+                            of its weights ("wts") and config ("config")
+          - memory_budget: max number of bytes that resident networks may
+                           occupy on the device. If None, networks are never
+                           evicted.
+          - use_mmap: whether to memory-map weight files while loading them
+                      (only takes effect on versions of torch supporting it)
+        """
+        self.network_consts = network_consts
+        self.memory_budget = memory_budget
+        self.use_mmap = use_mmap and TORCH_LOAD_SUPPORTS_MMAP
+        self.networks = OrderedDict()
+        self.sizes = {}
+        self.lock = threading.Lock()
+
+    def __getitem__(self, task_type: GPUTaskTypes) -> SplineDist2D:
+        return self.get(task_type)
+
+    @property
+    def resident_bytes(self):
+        return sum(self.sizes.values())
+
+    @staticmethod
+    def network_size(network: torch.nn.Module):
+        return sum(
+            t.numel() * t.element_size()
+            for t in list(network.parameters()) + list(network.buffers())
+        )
+
+    def get(self, task_type: GPUTaskTypes) -> SplineDist2D:
+        with self.lock:
+            if task_type in self.networks:
+                self.networks.move_to_end(task_type)
+                return self.networks[task_type]
+            network = self.load(task_type)
+            size = self.network_size(network)
+            self.make_room(size)
+            self.networks[task_type] = network.cuda()
+            self.sizes[task_type] = size
+            return network
+
+    def load(self, task_type: GPUTaskTypes) -> SplineDist2D:
+        print("loading network for task type:", task_type.name)
+        consts = self.network_consts[task_type]
+        network = SplineDist2D(Config(consts["config"], n_channel_in=3))
+        network.train(False)
+        kwargs = {"map_location": "cpu"}
+        if self.use_mmap:
+            kwargs["mmap"] = True
+        network.load_state_dict(torch.load(consts["wts"], **kwargs))
+        return network
+
+    def make_room(self, n_bytes):
+        """Evict least recently used networks until n_bytes more fit within the
+        memory budget. A network larger than the budget is still loaded, but
+        only after every other network has been evicted."""
+        if self.memory_budget is None:
+            return
+        while self.networks and self.resident_bytes + n_bytes > self.memory_budget:
+            self.evict(next(iter(self.networks)))
+
+    def evict(self, task_type: GPUTaskTypes):
+        print("evicting network for task type:", task_type.name)
+        del self.networks[task_type]
+        del self.sizes[task_type]
+        torch.cuda.empty_cache()
+
+    def preload(self, task_types):
+        for task_type in task_types:
+            self.get(task_type)
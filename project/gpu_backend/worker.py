@@ -9,14 +9,18 @@ import jwt
 import numpy as np
 import os
 import requests
+import threading
 import time
 import timeit
-import torch
 
 from project import app, create_app
-from project.detectors.splinedist.config import Config
-from project.detectors.splinedist.models.model2d import SplineDist2D
-from project.lib.datamanagement.models import EggLayingImage
+from project.gpu_backend.empty_region_prefilter import (
+    EMPTY_PREDICTION,
+    EmptyRegionPrefilter,
+)
+from project.gpu_backend.model_manager import ModelManager
+from project.lib.datamanagement.blob_store import blob_store
+from project.lib.datamanagement.models import EggLayingImage, ImageContent
 from project.lib.image.circleFinder import ARENA_IMG_RESIZE_FACTOR
 from project.lib.image.converter import byte_to_bgr
 from project.lib.image.drawing import get_interpolated_points
@@ -66,9 +70,23 @@ create_app()
 server_uri = os.environ["MAIN_SERVER_URI"]
 key_holder = AuthHelper(os.environ["PRIVATE_KEY_PATH"])
 reconnect_attempt_delay = int(os.environ["GPU_WORKER_RECONNECT_ATTEMPT_DELAY"])
+heartbeat_interval = float(os.getenv("GPU_WORKER_HEARTBEAT_INTERVAL", 20))
 request_headers = {"Authorization": f"access_token {key_holder.get_jwt()}"}
 active_tasks = {}
-networks = {}
+model_memory_budget = os.getenv("GPU_WORKER_MODEL_MEMORY_BUDGET_MB")
+networks = ModelManager(
+    NETWORK_CONSTS,
+    memory_budget=None
+    if model_memory_budget is None
+    else int(float(model_memory_budget) * 1024**2),
+    use_mmap=os.getenv("GPU_WORKER_MMAP_WEIGHTS", "1") == "1",
+)
+empty_region_threshold = os.getenv("GPU_WORKER_EMPTY_REGION_THRESHOLD")
+empty_region_prefilter = (
+    None
+    if empty_region_threshold is None
+    else EmptyRegionPrefilter(float(empty_region_threshold))
+)
 pauser = PythonPauser()
 with open("project/models/modelRevDates.json", "r") as f:
     model_to_update_date = json.load(f)
@@ -136,6 +154,35 @@ def request_work():
         time.sleep(reconnect_attempt_delay)
 
 
+class HeartbeatThread(threading.Thread):
+    """Periodically renew the server-side leases of the active tasks so that
+    they don't get handed to another worker while inference is running."""
+
+    def __init__(self, interval):
+        threading.Thread.__init__(self, daemon=True)
+        self.interval = interval
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            task_ids = [
+                task["task_id"]
+                for task in list(active_tasks.values())
+                if "task_id" in task
+            ]
+            if len(task_ids) == 0:
+                continue
+            try:
+                requests.request(
+                    "POST",
+                    f"{server_uri}/tasks/gpu/heartbeat",
+                    json={"task_ids": task_ids},
+                    headers=request_headers,
+                )
+            except requests.exceptions.ConnectionError:
+                print("failed to send heartbeat to the egg-counting server")
+
+
 def report_progress_to_server(task_type, group_id, region_index, tot_regions, img_path):
     requests.request(
         "POST",
@@ -152,12 +199,21 @@ def report_progress_to_server(task_type, group_id, region_index, tot_regions, im
 
 
 def post_results_to_server(task_key, result):
-    requests.request(
+    if task_key in active_tasks:
+        result["task_id"] = active_tasks[task_key].get("task_id")
+    r = requests.request(
         "POST",
         f"{server_uri}/tasks/gpu/{task_key}",
         json=result,
         headers=request_headers,
     )
+    try:
+        backoff = r.json().get("backoff", 0)
+    except (json.decoder.JSONDecodeError, AttributeError):
+        return
+    if backoff > 0:
+        print(f"server is busy finalizing results; waiting {backoff:.1f}s")
+        time.sleep(backoff)
 
 
 def perform_task(attempt_ct=0):
@@ -173,20 +229,22 @@ def perform_task(attempt_ct=0):
             print("task type:", task_type.name)
         print("num attempts:", attempt_ct + 1)
         decode_start_t = timeit.default_timer()
-        num_tries, img_entity = 0, None
+        num_tries, sha256 = 0, None
 
-        while not img_entity and num_tries < MAX_SQL_QUERIES_PER_IMG:
+        while not sha256 and num_tries < MAX_SQL_QUERIES_PER_IMG:
             with app.app_context():
-                img_entity = EggLayingImage.query.filter_by(
-                    session_id=task["room"], basename=os.path.basename(task["img_path"])
-                ).first()
+                sha256 = EggLayingImage.find_column(
+                    task["room"],
+                    os.path.basename(task["img_path"]),
+                    EggLayingImage.content_sha256,
+                )
             num_tries += 1
-            if not img_entity and num_tries < MAX_SQL_QUERIES_PER_IMG:
+            if not sha256 and num_tries < MAX_SQL_QUERIES_PER_IMG:
                 print("Couldn't find image; retrying...")
                 print("amount for sleep:", num_tries * 2)
                 time.sleep(num_tries * 2)
 
-        if not img_entity:
+        if not sha256:
             print("Couldn't find image specified in task")
             img_basename = os.path.basename(task["img_path"])
             print(
@@ -198,7 +256,7 @@ def perform_task(attempt_ct=0):
             raise FileNotFoundError(
                 (f"Couldn't find image {img_basename} for room {task['room']}")
             )
-        img = byte_to_bgr(img_entity.image)
+        img = byte_to_bgr(blob_store.view(ImageContent.blob_key_for(sha256)))
         print("time spent decoding:", timeit.default_timer() - decode_start_t)
         resize_norm_start_t = timeit.default_timer()
         if task_type == GPUTaskTypes.arena:
@@ -247,6 +305,14 @@ def perform_task(attempt_ct=0):
                     report_progress_to_server(
                         task_type.name, task_key, 0, None, task["img_path"]
                     )
+                if (
+                    task_type == GPUTaskTypes.egg
+                    and empty_region_prefilter is not None
+                    and empty_region_prefilter.is_empty(img)
+                ):
+                    print(f"region {i} classified as empty; skipping")
+                    predictions.append(dict(EMPTY_PREDICTION))
+                    continue
                 n_tiles = [1, 1, 1]
                 for dim in range(2):
                     if img.shape[dim] >= 1600:
@@ -273,11 +339,24 @@ def perform_task(attempt_ct=0):
         post_req_start_t = timeit.default_timer()
         print("time spent predicting:", post_req_start_t - predict_start_t)
         post_results_to_server(
-            task_key, {"predictions": converted_predictions, "metadata": metadata}
+            task_key,
+            {
+                "predictions": converted_predictions,
+                "metadata": metadata,
+                "timing": task_timing(
+                    start_t, len(imgs) if task_type == GPUTaskTypes.egg else None
+                ),
+            },
         )
         clean_up_task(task_key, start_t, post_req_start_t)
 
 
+def task_timing(start_t, n_regions):
+    """Return the timing reported to the server along with a task's results,
+    which feeds its estimates of queue wait times."""
+    return {"seconds": timeit.default_timer() - start_t, "n_regions": n_regions}
+
+
 def clean_up_task(task_key, start_t, post_req_start_t):
     del active_tasks[task_key]
     end_t = timeit.default_timer()
@@ -285,20 +364,16 @@ def clean_up_task(task_key, start_t, post_req_start_t):
     print("total time for task:", end_t - start_t)
 
 
-def init_networks():
-    for type in GPUTaskTypes:
-        init_splinedist_network(type)
-
-
-def init_splinedist_network(type):
-    networks[type] = SplineDist2D(
-        Config(NETWORK_CONSTS[type]["config"], n_channel_in=3)
+def preload_networks():
+    """Load the networks listed in GPU_WORKER_PRELOAD_MODELS (comma-separated
+    task type names) at startup; all others get loaded on first use."""
+    names = os.getenv("GPU_WORKER_PRELOAD_MODELS", "")
+    networks.preload(
+        [GPUTaskTypes[name.strip()] for name in names.split(",") if name.strip()]
     )
-    networks[type].cuda()
-    networks[type].train(False)
-    networks[type].load_state_dict(torch.load(NETWORK_CONSTS[type]["wts"]))
 
 
-init_networks()
+preload_networks()
+HeartbeatThread(heartbeat_interval).start()
 while True:
     request_work()
@@ -0,0 +1,98 @@
+from abc import ABC, abstractmethod
+import mmap
+import os
+from pathlib import Path
+import shutil
+import uuid
+
+
+class BlobStore(ABC):
+    """Store of binary objects (e.g., images) that SQL rows reference by key.
+
+    Keys are /-separated strings, as in object stores such as S3 or Google
+    Cloud Storage, whose basic operations (put, streaming get, delete) the
+    interface mirrors so that one can stand in for the local implementation.
+    """
+
+    @abstractmethod
+    def put(self, key, data=None, path=None):
+        """Store an object, replacing any stored under the same key.
+
+        Arguments:
+          - key: key of the object
+          - data: the object's bytes
+          - path: path of a file with the object's bytes, used instead of data;
+                  the file is moved into the store (or removed)
+        """
+
+    @abstractmethod
+    def open(self, key):
+        """Open an object as a readable binary file-like object."""
+
+    @abstractmethod
+    def exists(self, key):
+        """Return whether an object is stored under a key."""
+
+    @abstractmethod
+    def delete(self, key):
+        """Delete an object (has no effect if none is stored under the key)."""
+
+    def view(self, key):
+        """Return a read-only buffer with the bytes of an object."""
+        with self.open(key) as f:
+            return f.read()
+
+    def iter_chunks(self, key, chunk_size=1024**2):
+        """Stream the bytes of an object in chunks."""
+        with self.open(key) as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                yield chunk
+
+
+class LocalBlobStore(BlobStore):
+    """BlobStore keeping objects as files under a root folder, with the parts of
+    their keys as subfolders. Buffers of objects are memory-mapped, so reading
+    an object doesn't copy it into memory up front."""
+
+    def __init__(self, root="blobs"):
+        """Create a new LocalBlobStore instance.
+
+        Arguments:
+          - root: folder holding the stored objects
+        """
+        self.root = root
+
+    def path(self, key):
+        return os.path.join(self.root, *key.split("/"))
+
+    def put(self, key, data=None, path=None):
+        target = self.path(key)
+        Path(target).parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = f"{target}.{uuid.uuid4().hex}.tmp"
+        if path is None:
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+        else:
+            shutil.move(path, tmp_path)
+        os.replace(tmp_path, target)
+
+    def open(self, key):
+        return open(self.path(key), "rb")
+
+    def exists(self, key):
+        return os.path.isfile(self.path(key))
+
+    def delete(self, key):
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    def view(self, key):
+        with self.open(key) as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return b""
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+blob_store = LocalBlobStore(os.environ.get("BLOB_STORE_PATH", "blobs"))
@@ -7,20 +7,245 @@ import sqlalchemy
 from werkzeug.security import generate_password_hash
 
 from ... import app, db
+from project.lib.datamanagement.blob_store import blob_store
 
-LONGBLOG_LEN = (2**32) - 1
 
+def delete_expired_rows(
+    cls, expiration_seconds=60 * 60, batch_size=500, max_batches=None
+):
+    """Delete the rows of a model whose timestamp is older than the expiration.
 
-def delete_expired_rows(cls):
-    # adapted from code at this source:
-    # https://silvaneves.org/deleting-old-items-in-sqlalchemy.html
+    Rows are deleted with set-based DELETE statements of at most `batch_size`
+    rows each (committed one at a time), selecting only primary keys, so that
+    no rows (or blobs) get loaded. Expiring a SocketIOUser also deletes its
+    images.
 
-    expiration_seconds = 60 * 60
+    Arguments:
+      cls: model class with `id` and `timestamp` columns
+      expiration_seconds: age after which rows expire
+      batch_size: max number of rows deleted per statement
+      max_batches: max number of statements to run; if None, rows are deleted
+                   until none are expired
+    """
     limit = datetime.utcnow() - timedelta(seconds=expiration_seconds)
-    query_results = cls.query.filter(cls.timestamp <= limit)
-    for item in query_results:
-        db.session.delete(item)
+    n_batches = 0
+    while max_batches is None or n_batches < max_batches:
+        ids = db.session.scalars(
+            sqlalchemy.select(cls.id).where(cls.timestamp <= limit).limit(batch_size)
+        ).all()
+        if len(ids) == 0:
+            break
+        if cls is SocketIOUser:
+            delete_sessions(ids)
+        elif cls is EggLayingImage:
+            blob_keys = delete_images(EggLayingImage.id.in_(ids))
+            db.session.commit()
+            delete_blobs(blob_keys)
+        else:
+            db.session.execute(
+                sqlalchemy.delete(cls)
+                .where(cls.id.in_(ids))
+                .execution_options(synchronize_session=False)
+            )
+            db.session.commit()
+        n_batches += 1
+        if len(ids) < batch_size:
+            break
+
+
+def delete_sessions(sids):
+    """Delete SocketIOUser rows along with their images, without loading the
+    images."""
+    blob_keys = delete_images(EggLayingImage.session_id.in_(sids))
+    db.session.execute(
+        sqlalchemy.delete(SocketIOUser)
+        .where(SocketIOUser.id.in_(sids))
+        .execution_options(synchronize_session=False)
+    )
     db.session.commit()
+    delete_blobs(blob_keys)
+
+
+def delete_blobs(blob_keys):
+    for key in blob_keys:
+        blob_store.delete(key)
+
+
+class BatchWriter:
+    """Accumulate the parameters of a statement's executions and run them in
+    executemany batches of at most `batch_size`, within the current transaction
+    (which the caller commits once all are written)."""
+
+    def __init__(self, statement, batch_size=50):
+        self.statement = statement
+        self.batch_size = batch_size
+        self.pending = []
+
+    def add(self, **params):
+        self.pending.append(params)
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.pending) > 0:
+            db.session.execute(self.statement, self.pending)
+            self.pending = []
+
+
+def annotated_img_writer(session_id, batch_size=50):
+    """Return a BatchWriter setting the annotated_img_key of a session's images,
+    taking parameters image_basename and key."""
+    table = EggLayingImage.__table__
+    return BatchWriter(
+        sqlalchemy.update(table)
+        .where(
+            table.c.session_id == session_id,
+            table.c.basename == sqlalchemy.bindparam("image_basename"),
+        )
+        .values(annotated_img_key=sqlalchemy.bindparam("key")),
+        batch_size=batch_size,
+    )
+
+
+def add_image_reference(user, basename, sha256, data=None, path=None, levels=None):
+    """Add an EggLayingImage for a session, storing the image's bytes (and its
+    pyramid) only if no other image with the same content is stored already.
+
+    Arguments:
+      user: SocketIOUser of the session
+      basename: name of the image file
+      sha256: SHA-256 hex digest of the image's bytes
+      data: the image's bytes
+      path: path of a file with the image's bytes, used instead of data; it's
+            moved into the blob store if the image is stored
+      levels: dict mapping downscaling factors to the encoded levels of the
+              image's pyramid
+    """
+    n_updated = db.session.execute(
+        sqlalchemy.update(ImageContent)
+        .where(ImageContent.sha256 == sha256)
+        .values(refcount=ImageContent.refcount + 1)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    if n_updated == 0:
+        # blobs are keyed by content, so one left by a rolled-back attempt
+        # (whose staged file it was moved from) holds the same bytes
+        key = ImageContent.blob_key_for(sha256)
+        if not blob_store.exists(key):
+            blob_store.put(key, data=data, path=path)
+        db.session.add(ImageContent(sha256=sha256, refcount=1))
+        for factor, level_data in (levels or {}).items():
+            key = ImagePyramidLevel.blob_key_for(sha256, factor)
+            if not blob_store.exists(key):
+                blob_store.put(key, data=level_data)
+            db.session.add(ImagePyramidLevel(content_sha256=sha256, factor=factor))
+    return EggLayingImage(content_sha256=sha256, basename=basename, user=user)
+
+
+def add_images(session_id, uploads):
+    """Add the EggLayingImages of a batch of uploads to a session in one
+    transaction.
+
+    Another session may store the same image concurrently, in which case the
+    insert of its content fails; the batch is then retried once, with the
+    content referenced instead.
+
+    Arguments:
+      session_id: ID of the SocketIOUser of the session (created if needed)
+      uploads: list of dicts with keys filename, sha256, levels (optional),
+               and either data (the image's bytes) or staged_path (path of a
+               file with them)
+    """
+    for attempt in range(2):
+        try:
+            user = SocketIOUser.query.filter_by(id=session_id).first()
+            if not user:
+                user = SocketIOUser(id=session_id)
+                db.session.add(user)
+            for upload in uploads:
+                db.session.add(
+                    add_image_reference(
+                        user,
+                        upload["filename"],
+                        upload["sha256"],
+                        data=upload.get("data"),
+                        path=upload.get("staged_path"),
+                        levels=upload.get("levels"),
+                    )
+                )
+                db.session.flush()
+            db.session.commit()
+            return
+        except sqlalchemy.exc.IntegrityError:
+            db.session.rollback()
+            if attempt > 0:
+                raise
+
+
+def delete_images(condition):
+    """Delete the EggLayingImage rows matching a condition and release their
+    references to image contents, deleting the rows of those no longer
+    referenced. No blobs are loaded along the way.
+
+    Returns the keys of the blobs to delete once the deletion is committed.
+    """
+    ref_counts = db.session.execute(
+        sqlalchemy.select(EggLayingImage.content_sha256, sqlalchemy.func.count())
+        .where(condition)
+        .group_by(EggLayingImage.content_sha256)
+    ).all()
+    blob_keys = (
+        db.session.execute(
+            sqlalchemy.select(EggLayingImage.annotated_img_key).where(
+                condition, EggLayingImage.annotated_img_key.is_not(None)
+            )
+        )
+        .scalars()
+        .all()
+    )
+    db.session.execute(
+        sqlalchemy.delete(EggLayingImage)
+        .where(condition)
+        .execution_options(synchronize_session=False)
+    )
+    for sha256, n_refs in ref_counts:
+        db.session.execute(
+            sqlalchemy.update(ImageContent)
+            .where(ImageContent.sha256 == sha256)
+            .values(refcount=ImageContent.refcount - n_refs)
+            .execution_options(synchronize_session=False)
+        )
+    orphans = (
+        db.session.execute(
+            sqlalchemy.select(ImageContent.sha256).where(
+                ImageContent.sha256.in_([sha256 for sha256, _ in ref_counts]),
+                ImageContent.refcount <= 0,
+            )
+        )
+        .scalars()
+        .all()
+    )
+    if len(orphans) == 0:
+        return blob_keys
+    levels = db.session.execute(
+        sqlalchemy.select(
+            ImagePyramidLevel.content_sha256, ImagePyramidLevel.factor
+        ).where(ImagePyramidLevel.content_sha256.in_(orphans))
+    ).all()
+    blob_keys.extend(ImageContent.blob_key_for(sha256) for sha256 in orphans)
+    blob_keys.extend(
+        ImagePyramidLevel.blob_key_for(sha256, factor) for sha256, factor in levels
+    )
+    for cls, column in (
+        (ImagePyramidLevel, ImagePyramidLevel.content_sha256),
+        (ImageContent, ImageContent.sha256),
+    ):
+        db.session.execute(
+            sqlalchemy.delete(cls)
+            .where(column.in_(orphans))
+            .execution_options(synchronize_session=False)
+        )
+    return blob_keys
 
 
 class User(UserMixin, db.Model):
@@ -36,13 +261,15 @@ class User(UserMixin, db.Model):
 
 class SocketIOUser(db.Model):
     id = db.Column(db.String(24), primary_key=True)
-    timestamp = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    timestamp = db.Column(
+        db.DateTime, nullable=False, default=datetime.utcnow, index=True
+    )
 
 
 class ErrorReport(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    image = db.Column(db.LargeBinary(length=LONGBLOG_LEN), nullable=False)
-    outline_image = db.Column(db.LargeBinary(length=LONGBLOG_LEN), nullable=False)
+    image_key = db.Column(db.String(255), nullable=False)
+    outline_image_key = db.Column(db.String(255), nullable=False)
     img_path = db.Column(db.String(1000), nullable=False)
     region_index = db.Column(db.Integer, nullable=False)
     original_ct = db.Column(db.Integer, nullable=False)
@@ -51,9 +278,19 @@ class ErrorReport(db.Model):
     user = db.relationship(
         "User", backref=db.backref("error_reports", lazy=True, cascade="all,delete")
     )
-    timestamp = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    timestamp = db.Column(
+        db.DateTime, nullable=False, default=datetime.utcnow, index=True
+    )
     egg_counting_model_id = db.Column(db.String(1000), nullable=False)
 
+    @property
+    def image(self):
+        return blob_store.view(self.image_key)
+
+    @property
+    def outline_image(self):
+        return blob_store.view(self.outline_image_key)
+
 
 class EggRegionTemplate(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -65,19 +302,93 @@ class EggRegionTemplate(db.Model):
     )
 
 
+class ImageContent(db.Model):
+    """Reference to the bytes of an uploaded image in the blob store, stored
+    once per distinct content and shared by the EggLayingImage rows that
+    reference them."""
+
+    sha256 = db.Column(db.String(64), primary_key=True)
+    refcount = db.Column(db.Integer, nullable=False, default=0)
+
+    @staticmethod
+    def blob_key_for(sha256):
+        return f"images/{sha256[:2]}/{sha256[2:4]}/{sha256}"
+
+
+class ImagePyramidLevel(db.Model):
+    """Reference to a copy of an image's content downscaled by an integer factor
+    (with its EXIF orientation applied), encoded as JPEG in the blob store."""
+
+    content_sha256 = db.Column(
+        db.String(64), db.ForeignKey(ImageContent.sha256), primary_key=True
+    )
+    factor = db.Column(db.Integer, primary_key=True)
+
+    @staticmethod
+    def blob_key_for(sha256, factor):
+        return f"pyramid/{sha256[:2]}/{sha256[2:4]}/{sha256}_{factor}.jpg"
+
+
 class EggLayingImage(db.Model):
+    # images are looked up by session and basename; MySQL can only index a
+    # prefix of the long basename column
+    __table_args__ = (
+        db.Index(
+            "ix_egg_laying_image_session_id_basename",
+            "session_id",
+            "basename",
+            mysql_length={"basename": 255},
+        ),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     session_id = db.Column(
         db.String(24), db.ForeignKey(SocketIOUser.id), nullable=False
     )
-    timestamp = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
-    image = db.Column(db.LargeBinary(length=LONGBLOG_LEN), nullable=False)
-    annotated_img = db.Column(db.LargeBinary(length=LONGBLOG_LEN), nullable=True)
+    timestamp = db.Column(
+        db.DateTime, nullable=False, default=datetime.utcnow, index=True
+    )
+    content_sha256 = db.Column(
+        db.String(64), db.ForeignKey(ImageContent.sha256), nullable=False, index=True
+    )
+    content = db.relationship(ImageContent)
+    annotated_img_key = db.Column(db.String(255), nullable=True)
     basename = db.Column(db.String(1000), nullable=False)
     user = db.relationship(
         "SocketIOUser", backref=db.backref("images", lazy=True, cascade="all,delete")
     )
 
+    @staticmethod
+    def find_column(session_id, basename, column):
+        """Return a single column of a session's image (or None if there's no
+        such image), without loading the rest of the row.
+
+        Arguments:
+          session_id: ID of the session that uploaded the image
+          basename: name of the image file
+          column: column to load, e.g., EggLayingImage.content_sha256
+        """
+        row = (
+            EggLayingImage.query.filter_by(session_id=session_id, basename=basename)
+            .with_entities(column)
+            .first()
+        )
+        return None if row is None else row[0]
+
+    @property
+    def image(self):
+        return blob_store.view(ImageContent.blob_key_for(self.content_sha256))
+
+    @property
+    def annotated_img(self):
+        if self.annotated_img_key is None:
+            return None
+        return blob_store.view(self.annotated_img_key)
+
+    @staticmethod
+    def annotated_img_key_for(session_id, basename):
+        return f"annotated/{session_id}/{basename}"
+
 
 def login_google_user():
     user_info_endpoint = "/oauth2/v2/userinfo"
@@ -11,9 +11,9 @@ import threading
 from typing import Union
 
 from project import app
-from project.lib.datamanagement.models import EggLayingImage
 from project.lib.image.chamber import CT
 from project.lib.image.converter import byte_to_bgr
+from project.lib.image.pyramid import load_image, read_original
 from project.lib.util import distance, trueRegions, COL_G
 
 dirname = os.path.dirname(__file__)
@@ -222,6 +222,13 @@ class CircleFinder:
         self.model = model
         self.predict_resize_factor = predict_resize_factor
 
+    def __getstate__(self):
+        """Leave out the model when pickling (e.g., to find circles in another
+        process using predictions that were already made)."""
+        state = self.__dict__.copy()
+        state["model"] = None
+        return state
+
     def getPixelToMMRatio(self):
         """Calculate the image's ratio of pixels to mm, averaged between the result
         for rows and for columns."""
@@ -285,18 +292,16 @@ class CircleFinder:
             el for sub_l in list(self.well_to_well_slopes.values()) for el in sub_l
         ]
 
+    def img_path(self):
+        return os.path.join(app.config["UPLOAD_FOLDER"], self.room, self.img_name)
+
     def getLargeChamberBBoxesAndImages(self, centers, pxToMM):
         if getattr(self, "img", None) is not None:
             img = self.img
         else:
-            with app.app_context():
-                img = byte_to_bgr(
-                    EggLayingImage.query.filter_by(
-                        session_id=self.room, basename=self.img_name
-                    )
-                    .first()
-                    .image
-                )
+            # decoded from the original rather than a pyramid level, whose
+            # JPEG compression would change the wells' edges
+            img = byte_to_bgr(read_original(self.img_path()))
         bboxes = []
         img = cv2.medianBlur(img, 5)
         img_for_circles = cv2.resize(
@@ -827,22 +832,12 @@ class CircleFinder:
                 self.centroids.append((cy, cx))
         if debug:
             print("what are centroids?", self.centroids)
-            if not hasattr(self, "imageResized"):
-                with app.app_context():
-                    self.imageResized = byte_to_bgr(
-                        EggLayingImage.query.filter_by(
-                            session_id=self.room, basename=self.img_name
-                        )
-                        .first()
-                        .image
-                    )
-                    self.imageResized = cv2.resize(
-                        self.imageResized,
-                        (0, 0),
-                        fx=self.predict_resize_factor,
-                        fy=self.predict_resize_factor,
-                    )
-            imgCopy = cv2.resize(np.array(self.imageResized), (0, 0), fx=0.5, fy=0.5)
+            if hasattr(self, "imageResized"):
+                imgCopy = cv2.resize(
+                    np.array(self.imageResized), (0, 0), fx=0.5, fy=0.5
+                )
+            else:
+                imgCopy = load_image(self.img_path(), 0.5 * self.predict_resize_factor)
             for centroid in self.centroids:
                 cv2.drawMarker(
                     imgCopy,
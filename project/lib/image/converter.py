@@ -2,15 +2,37 @@ import cv2
 import numpy as np
 from typing import ByteString
 
+from project.lib.image.exif import exif_orientation
+
+
+def apply_orientation(img: np.ndarray, orientation):
+    """transform a decoded image as specified by an EXIF orientation (1-8)."""
+    if orientation == 2:
+        return cv2.flip(img, 1)
+    if orientation == 3:
+        return cv2.rotate(img, cv2.ROTATE_180)
+    if orientation == 4:
+        return cv2.flip(img, 0)
+    if orientation == 5:
+        return cv2.transpose(img)
+    if orientation == 6:
+        return cv2.rotate(img, cv2.ROTATE_90_CLOCKWISE)
+    if orientation == 7:
+        return cv2.flip(cv2.transpose(img), -1)
+    if orientation == 8:
+        return cv2.rotate(img, cv2.ROTATE_90_COUNTERCLOCKWISE)
+    return img
+
 
 def byte_to_bgr(img_in: ByteString):
-    return cv2.cvtColor(
+    # decode straight from the buffer (e.g., a memory-mapped blob), without
+    # copying it first; reading the EXIF orientation does copy it, though, since
+    # PIL needs a file object and BytesIO copies anything but a bytes object
+    img = cv2.cvtColor(
         cv2.imdecode(
-            np.asarray(
-                bytearray(img_in),
-                dtype="uint8",
-            ),
-            cv2.IMREAD_COLOR,
+            np.frombuffer(img_in, dtype=np.uint8),
+            cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION,
         ),
         cv2.COLOR_RGB2BGR,
     )
+    return apply_orientation(img, exif_orientation(data=img_in))
@@ -0,0 +1,60 @@
+from collections import OrderedDict
+import os
+from threading import Lock
+
+import numpy as np
+
+
+class DecodedImageCache:
+    """Process-wide LRU cache of decoded images, bounded by the number of bytes
+    of their pixel arrays.
+
+    Images are keyed by their identity (i.e., their content, not the path they
+    were uploaded under) and dtype. Cached arrays are read-only, and callers get
+    views of them, so pixels can't be changed behind the cache's back; callers
+    that draw on an image need to copy it first.
+    """
+
+    def __init__(self, max_bytes=512 * 1024**2):
+        """Create a new DecodedImageCache instance.
+
+        Arguments:
+          - max_bytes: max number of bytes of the cached arrays; 0 disables the
+                       cache
+        """
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.n_bytes = 0
+        self.lock = Lock()
+
+    def get(self, identity, dtype, decode) -> np.ndarray:
+        """Return a read-only view of a decoded image.
+
+        Arguments:
+          - identity: hashable identity of the image's content
+          - dtype: dtype of the decoded image
+          - decode: function returning the decoded image, called on a miss
+        """
+        key = (identity, np.dtype(dtype).str)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key].view()
+        img = decode()
+        img.flags.writeable = False
+        if img.nbytes > self.max_bytes:
+            return img.view()
+        with self.lock:
+            if key not in self.entries:
+                self.entries[key] = img
+                self.n_bytes += img.nbytes
+            self.entries.move_to_end(key)
+            while self.n_bytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.n_bytes -= evicted.nbytes
+            return self.entries[key].view()
+
+
+decoded_images = DecodedImageCache(
+    max_bytes=int(os.environ.get("DECODED_IMAGE_CACHE_MB", 512)) * 1024**2
+)
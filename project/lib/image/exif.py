@@ -1,10 +1,56 @@
 from io import BytesIO
 from PIL import ExifTags, Image
 
+ORIENTATION_TAG = next(
+    tag for tag, name in ExifTags.TAGS.items() if name == "Orientation"
+)
+TRANSPOSITIONS = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+
+
+def exif_orientation(data=None, path=None):
+    """return the EXIF orientation (1-8) of an image, reading only its header.
+
+    Arguments:
+      data: binary image data
+      path: path to an image file
+
+    Images without an orientation tag (or without EXIF data) are reported as
+    having orientation 1, i.e., needing no transformation.
+    """
+    try:
+        with Image.open(BytesIO(data) if data is not None else path) as image:
+            orientation = image.getexif().get(ORIENTATION_TAG, 1)
+    except (TypeError, AttributeError, KeyError, IndexError, SyntaxError):
+        return 1
+    return orientation if orientation in range(1, 9) else 1
+
+
+def open_oriented(fp):
+    """open an image with PIL and apply its EXIF orientation, if any."""
+    image = Image.open(fp)
+    method = TRANSPOSITIONS.get(image.getexif().get(ORIENTATION_TAG))
+    if method is None:
+        return image
+    transposed = image.transpose(method)
+    image.close()
+    return transposed
+
 
 def correct_via_exif(data=None, path=None, format=None, read_only=False):
     """rotate an image by the amount specified in its EXIF data.
 
+    note: uploads are stored with their original bytes and get their EXIF
+    orientation applied when decoded (see `open_oriented` and
+    `converter.byte_to_bgr`), so this re-encoding isn't needed for them.
+
     Arguments:
       data: binary image data
       path: path to an image file
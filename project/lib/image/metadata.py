@@ -0,0 +1,93 @@
+from collections import namedtuple, OrderedDict
+import os
+from threading import Lock
+
+from PIL import Image
+
+from project import app, backend_type
+from project.lib.datamanagement.blob_store import blob_store
+from project.lib.datamanagement.models import EggLayingImage, ImageContent
+from project.lib.image.exif import ORIENTATION_TAG
+from project.lib.web.backend_types import BackendTypes
+
+
+class ImageMetadata(
+    namedtuple(
+        "ImageMetadata",
+        "width height channels orientation sha256",
+        defaults=(None,),
+    )
+):
+    """Dimensions (with the EXIF orientation applied), number of channels and
+    EXIF orientation of an image, and the SHA-256 hex digest of its bytes if it
+    was recorded at ingestion."""
+
+    @property
+    def shape(self):
+        """Return the shape of the image when decoded as a numpy array."""
+        if self.channels == 1:
+            return (self.height, self.width)
+        return (self.height, self.width, self.channels)
+
+
+def probe_image(fp):
+    """Read the metadata of an image from its header, without decoding pixels.
+
+    Arguments:
+      - fp: path to an image file or file-like object with its data
+    """
+    with Image.open(fp) as image:
+        width, height = image.size
+        channels = len(image.getbands())
+        try:
+            orientation = image.getexif().get(ORIENTATION_TAG, 1)
+        except (TypeError, AttributeError, KeyError, IndexError, SyntaxError):
+            orientation = 1
+    if orientation in (5, 6, 7, 8):
+        width, height = height, width
+    return ImageMetadata(width, height, channels, orientation)
+
+
+class ImageMetadataService:
+    """Probe uploaded images for their metadata and keep the results in an LRU
+    cache, keyed by image path (uploads/<sid>/<filename>)."""
+
+    def __init__(self, max_entries=4096):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, img_path) -> ImageMetadata:
+        img_path = os.path.normpath(img_path)
+        with self.lock:
+            if img_path in self.entries:
+                self.entries.move_to_end(img_path)
+                return self.entries[img_path]
+        metadata = self.probe(img_path)
+        self.put(img_path, metadata)
+        return metadata
+
+    def put(self, img_path, metadata: ImageMetadata):
+        with self.lock:
+            self.entries[os.path.normpath(img_path)] = metadata
+            self.entries.move_to_end(os.path.normpath(img_path))
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    @staticmethod
+    def probe(img_path) -> ImageMetadata:
+        if backend_type == BackendTypes.filesystem:
+            return probe_image(img_path)
+        path_split = img_path.split(os.path.sep)
+        with app.app_context():
+            sha256 = EggLayingImage.find_column(
+                path_split[-2], path_split[-1], EggLayingImage.content_sha256
+            )
+        if sha256 is None:
+            # same error as for a missing file with the filesystem backend
+            raise FileNotFoundError(f"no stored image for {img_path}")
+        # PIL reads only as much of the blob as it needs for the header
+        with blob_store.open(ImageContent.blob_key_for(sha256)) as f:
+            return probe_image(f)
+
+image_metadata = ImageMetadataService()
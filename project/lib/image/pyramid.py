@@ -0,0 +1,123 @@
+import os
+
+import cv2
+import numpy as np
+
+from project import app, backend_type
+from project.lib.datamanagement.blob_store import blob_store
+from project.lib.datamanagement.models import (
+    EggLayingImage,
+    ImageContent,
+    ImagePyramidLevel,
+)
+from project.lib.image.converter import apply_orientation, byte_to_bgr
+from project.lib.image.exif import exif_orientation
+from project.lib.web.backend_types import BackendTypes
+
+# factors by which the levels of an image's pyramid are downscaled relative to
+# the original. Ingestion doesn't build pyramids while nothing reads them, so
+# readers fall back to the original for images without one.
+PYRAMID_FACTORS = (2, 4, 8)
+PYRAMID_JPEG_QUALITY = 95
+
+
+def build_pyramid(data=None, path=None):
+    """Decode an image and downscale it by each of PYRAMID_FACTORS, with its
+    EXIF orientation applied.
+
+    Arguments:
+      - data: the image's bytes
+      - path: path to the image, used instead of data
+
+    Returns a dict mapping each factor to its level encoded as JPEG, or an empty
+    dict if the image can't be decoded by OpenCV.
+    """
+    flags = cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION
+    if path is None:
+        img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), flags)
+    else:
+        img = cv2.imread(path, flags)
+    if img is None:
+        return {}
+    img = apply_orientation(img, exif_orientation(data=data, path=path))
+    levels = {}
+    prev_factor = 1
+    for factor in PYRAMID_FACTORS:
+        img = cv2.resize(
+            img,
+            (0, 0),
+            fx=prev_factor / factor,
+            fy=prev_factor / factor,
+            interpolation=cv2.INTER_AREA,
+        )
+        levels[factor] = cv2.imencode(
+            ".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, PYRAMID_JPEG_QUALITY]
+        )[1].tobytes()
+        prev_factor = factor
+    return levels
+
+
+def level_factor(scale):
+    """Return the factor of the smallest pyramid level that is at least as large
+    as an image downscaled by `scale` (1 for the original)."""
+    factors = [factor for factor in PYRAMID_FACTORS if 1 / factor >= scale]
+    return max(factors, default=1)
+
+
+def content_sha256(img_path):
+    path_split = img_path.split(os.path.sep)
+    with app.app_context():
+        return EggLayingImage.find_column(
+            path_split[-2], path_split[-1], EggLayingImage.content_sha256
+        )
+
+
+def read_level(img_path, factor):
+    """Return a buffer with the encoded pyramid level of an uploaded image, or
+    None if its pyramid wasn't built (e.g., it was uploaded before pyramids
+    were)."""
+    img_path = os.path.normpath(img_path)
+    if backend_type == BackendTypes.filesystem:
+        level_path = app.image_store.level_path(img_path, factor)
+        if not os.path.isfile(level_path):
+            return None
+        with open(level_path, "rb") as f:
+            return f.read()
+    key = ImagePyramidLevel.blob_key_for(content_sha256(img_path), factor)
+    return blob_store.view(key) if blob_store.exists(key) else None
+
+
+def read_original(img_path):
+    img_path = os.path.normpath(img_path)
+    if backend_type == BackendTypes.filesystem:
+        with open(img_path, "rb") as f:
+            return f.read()
+    return blob_store.view(ImageContent.blob_key_for(content_sha256(img_path)))
+
+
+def load_image(img_path, scale=1.0, interpolation=cv2.INTER_LINEAR):
+    """Decode an uploaded image (as byte_to_bgr does) downscaled by `scale`,
+    starting from the smallest level of its pyramid that is at least as large.
+
+    Arguments:
+      - img_path: path of the image (uploads/<sid>/<filename>)
+      - scale: factor by which to downscale the image
+      - interpolation: OpenCV interpolation used to resize the level, if its
+                       scale doesn't match exactly
+    """
+    factor = level_factor(scale)
+    data = read_level(img_path, factor) if factor > 1 else None
+    if data is None:
+        factor = 1
+        data = read_original(img_path)
+    img = byte_to_bgr(data)
+    relative_scale = scale * factor
+    if relative_scale != 1:
+        img = cv2.resize(
+            img,
+            (0, 0),
+            fx=relative_scale,
+            fy=relative_scale,
+            interpolation=interpolation,
+        )
+    return img
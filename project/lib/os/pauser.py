@@ -1,15 +1,18 @@
 import os
 import psutil
+from threading import Lock
 
-from project.lib.web.scheduler import Scheduler
+from project.lib.web.scheduler import scheduler
+
+RESUME_DELAY = 25 * 60
 
 
 class PythonPauser:
     def __init__(self):
         self.paused_parents = set()
         self.my_pid = os.getpid()
-        self.scheduler = Scheduler(1)
-        self.resume_is_scheduled = False
+        self.resume_call = None
+        self.lock = Lock()
 
     def is_flaggable_process(self, proc: psutil.Process):
         if proc.parent() == None:
@@ -41,14 +44,12 @@ class PythonPauser:
                 self.flagged_processes.append(proc)
 
     def set_resume_timer(self):
-        if hasattr(self, "scheduled_job") and self.scheduled_job is not None:
-            self.scheduler.schedule.cancel_job(self.scheduled_job)
-            self.stop_run_continuously.set()
-        self.scheduled_job = self.scheduler.schedule.every(25).minutes.do(
-            self.resume_high_cpu_py_processes
-        )
-        self.stop_run_continuously = self.scheduler.run_continuously()
-        self.resume_is_scheduled = True
+        with self.lock:
+            if self.resume_call is not None:
+                self.resume_call.cancel()
+            self.resume_call = scheduler.call_later(
+                RESUME_DELAY, self.resume_high_cpu_py_processes
+            )
 
     def resume_high_cpu_py_processes(self):
         pid: int
@@ -62,7 +63,6 @@ class PythonPauser:
                     "but it doesn't exist anymore",
                 )
         self.paused_parents = set()
-        return self.scheduler.schedule.CancelJob
 
     def end_high_impact_py_prog(self):
         self.get_high_cpu_py_processes_with_py_parents()
@@ -0,0 +1,149 @@
+from collections import deque, OrderedDict
+from threading import Lock
+from typing import List
+
+from project.lib.web.gpu_task import GPUTask
+
+
+class AdmissionController:
+    """Limit the number of outstanding GPU tasks (queued or being processed),
+    and the number of image bytes they cover, both per room and overall.
+
+    Tasks over a limit are deferred and admitted once capacity frees up, with
+    rooms taking turns. A room without outstanding tasks always gets one task
+    admitted, so that a single oversized image can't block the room forever.
+    Limits of 0 are disabled.
+    """
+
+    def __init__(
+        self,
+        max_tasks_per_room=0,
+        max_tasks=0,
+        max_bytes_per_room=0,
+        max_bytes=0,
+    ):
+        """Create a new AdmissionController instance.
+
+        Arguments:
+          - max_tasks_per_room: max outstanding tasks of a single room
+          - max_tasks: max outstanding tasks of all rooms
+          - max_bytes_per_room: max image bytes of a single room's outstanding
+                                tasks
+          - max_bytes: max image bytes of all outstanding tasks
+        """
+        self.max_tasks_per_room = max_tasks_per_room
+        self.max_tasks = max_tasks
+        self.max_bytes_per_room = max_bytes_per_room
+        self.max_bytes = max_bytes
+        self.outstanding = {}
+        self.room_tasks = {}
+        self.room_bytes = {}
+        self.n_bytes = 0
+        self.deferred = OrderedDict()
+        self.lock = Lock()
+
+    @staticmethod
+    def over_limit(value, limit):
+        return limit > 0 and value > limit
+
+    def fits(self, task: GPUTask):
+        room = task.task_group.room
+        room_tasks = self.room_tasks.get(room, 0)
+        if room_tasks == 0:
+            return True
+        room_bytes = self.room_bytes.get(room, 0) + task.n_bytes
+        return not (
+            self.over_limit(room_tasks + 1, self.max_tasks_per_room)
+            or self.over_limit(len(self.outstanding) + 1, self.max_tasks)
+            or self.over_limit(room_bytes, self.max_bytes_per_room)
+            or self.over_limit(self.n_bytes + task.n_bytes, self.max_bytes)
+        )
+
+    def track(self, task: GPUTask):
+        room = task.task_group.room
+        self.outstanding[task.id] = task
+        self.room_tasks[room] = self.room_tasks.get(room, 0) + 1
+        self.room_bytes[room] = self.room_bytes.get(room, 0) + task.n_bytes
+        self.n_bytes += task.n_bytes
+
+    def admit(self, task: GPUTask):
+        """Admit a task if it fits within the limits and none of its room's
+        tasks are deferred; otherwise, defer it. Return whether it was admitted."""
+        room = task.task_group.room
+        with self.lock:
+            if room not in self.deferred and self.fits(task):
+                self.track(task)
+                return True
+            self.deferred.setdefault(room, deque()).append(task)
+            return False
+
+    def release(self, task_id) -> List[GPUTask]:
+        """Stop counting a task as outstanding (has no effect if it isn't), and
+        return the deferred tasks admitted in its stead."""
+        with self.lock:
+            task = self.outstanding.pop(task_id, None)
+            if task is None:
+                return []
+            room = task.task_group.room
+            self.room_tasks[room] -= 1
+            self.room_bytes[room] -= task.n_bytes
+            self.n_bytes -= task.n_bytes
+            if self.room_tasks[room] == 0:
+                del self.room_tasks[room]
+                del self.room_bytes[room]
+            return self.admit_deferred()
+
+    def release_group(self, group_id) -> List[GPUTask]:
+        """Drop the deferred tasks of a task group and release its outstanding
+        ones; return the deferred tasks admitted in their stead."""
+        with self.lock:
+            for room in list(self.deferred.keys()):
+                remaining = deque(
+                    task
+                    for task in self.deferred[room]
+                    if task.task_group.id != group_id
+                )
+                if remaining:
+                    self.deferred[room] = remaining
+                else:
+                    del self.deferred[room]
+            task_ids = [
+                task.id
+                for task in self.outstanding.values()
+                if task.task_group.id == group_id
+            ]
+        admitted = []
+        for task_id in task_ids:
+            admitted.extend(self.release(task_id))
+        return admitted
+
+    def admit_deferred(self) -> List[GPUTask]:
+        """Admit deferred tasks while they fit, one room at a time."""
+        admitted = []
+        blocked_rooms = set()
+        while len(blocked_rooms) < len(self.deferred):
+            room, room_deferred = next(iter(self.deferred.items()))
+            self.deferred.move_to_end(room)
+            if room in blocked_rooms:
+                continue
+            if not self.fits(room_deferred[0]):
+                blocked_rooms.add(room)
+                continue
+            task = room_deferred.popleft()
+            self.track(task)
+            admitted.append(task)
+            if not room_deferred:
+                del self.deferred[room]
+        return admitted
+
+    def n_deferred(self, room):
+        with self.lock:
+            return len(self.deferred.get(room, ()))
+
+    def deferred_tasks(self) -> List[GPUTask]:
+        """Return a list of the deferred tasks, each room's in the order they
+        get admitted."""
+        with self.lock:
+            return [
+                task for room_deferred in self.deferred.values() for task in room_deferred
+            ]
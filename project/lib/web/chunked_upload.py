@@ -0,0 +1,113 @@
+from collections import OrderedDict
+import hashlib
+import os
+from pathlib import Path
+from threading import Lock
+
+
+class ChunkedUpload:
+    """Track a file being uploaded in chunks to a staging path."""
+
+    def __init__(self, path):
+        self.path = path
+        self.digest = hashlib.sha256()
+        self.received = 0
+        self.lock = Lock()
+
+
+class ChunkedUploadRegistry:
+    """Stream the chunks of uploaded files to staging files, hashing them along
+    the way, while holding at most `block_size` bytes of a chunk in memory.
+
+    Chunks need to arrive in order; a client whose upload was interrupted can
+    ask for the number of bytes received so far and resume from there. If the
+    server restarted in the meantime, the hash of the received bytes gets
+    recomputed from the staging file. The last `max_finished` finished uploads
+    are remembered (by size and digest) so that retried requests for them get
+    the same answers and each is ingested only once.
+    """
+
+    def __init__(self, block_size=1024**2, max_finished=10000):
+        self.block_size = block_size
+        self.max_finished = max_finished
+        self.uploads = {}
+        self.finished = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, path) -> ChunkedUpload:
+        with self.lock:
+            if path not in self.uploads:
+                upload = ChunkedUpload(path)
+                if os.path.isfile(path):
+                    with open(path, "rb") as f:
+                        for block in iter(lambda: f.read(self.block_size), b""):
+                            upload.digest.update(block)
+                            upload.received += len(block)
+                self.uploads[path] = upload
+            return self.uploads[path]
+
+    def received(self, path):
+        with self.lock:
+            if path in self.finished:
+                return self.finished[path]["size"]
+        return self.get(path).received
+
+    def write_chunk(self, path, offset, stream):
+        """Append a chunk read from a stream to the staging file, if it starts
+        where the previous one ended.
+
+        Returns a tuple of whether the chunk was accepted and the number of
+        bytes received so far.
+        """
+        with self.lock:
+            if path in self.finished:
+                return False, self.finished[path]["size"]
+        upload = self.get(path)
+        with upload.lock:
+            if offset != upload.received:
+                return False, upload.received
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+            with open(path, "ab") as f:
+                for block in iter(lambda: stream.read(self.block_size), b""):
+                    f.write(block)
+                    upload.digest.update(block)
+                    upload.received += len(block)
+            return True, upload.received
+
+    def finish(self, path):
+        """Stop writing to a completed upload, remember it as finished and
+        return its SHA-256 hex digest."""
+        with self.lock:
+            upload = self.uploads.pop(path, None)
+        if upload is None:
+            upload = self.get(path)
+            with self.lock:
+                self.uploads.pop(path, None)
+        sha256 = upload.digest.hexdigest()
+        with self.lock:
+            self.finished[path] = {
+                "sha256": sha256,
+                "size": upload.received,
+                "claimed": False,
+            }
+            while len(self.finished) > self.max_finished:
+                self.finished.popitem(last=False)
+        return sha256
+
+    def claim(self, path):
+        """Return the SHA-256 hex digest of a finished upload the first time
+        it's claimed for ingestion, and None otherwise (or if it isn't
+        finished)."""
+        with self.lock:
+            record = self.finished.get(path)
+            if record is None or record["claimed"]:
+                return None
+            record["claimed"] = True
+            return record["sha256"]
+
+    def discard(self, path):
+        with self.lock:
+            self.uploads.pop(path, None)
+            self.finished.pop(path, None)
+        if os.path.isfile(path):
+            os.remove(path)
@@ -6,7 +6,8 @@ from pathlib import Path
 from PIL import Image, ImageDraw
 
 from project import backend_type, db
-from project.lib.datamanagement.models import EggLayingImage
+from project.lib.datamanagement.blob_store import blob_store
+from project.lib.datamanagement.models import annotated_img_writer, EggLayingImage
 from project.lib.image import drawing
 from project.lib.image.circleFinder import rotate_around_point_highperf
 from project.lib.web.backend_types import BackendTypes
@@ -30,24 +31,25 @@ class DownloadManager:
             Path(self.sessions[ts]["folder"]).mkdir(parents=True, exist_ok=True)
 
     def calculateEggPositionsForImage(self, sm, path):
-        img = sm.open_image(path, dtype=np.uint8)
         zoom = sm.alignment_data[path].get("scaling", 1)
-        ht, wd = img.shape[:2]
+        ht, wd = sm.img_shape(path)[:2]
         center = (wd / 2, ht / 2)
         rot = sm.alignment_data[path]["rotationAngle"]
-        sm.egg_positions_full_scale[path] = []
+        predictions = sm.predictions[path]
+        egg_positions = []
         for i, annotation in enumerate(sm.annotations[path]):
-            for pt in sm.predictions[path][i]["points"]:
+            for pt in predictions[i]["points"]:
                 pt = [
                     (1 / zoom) * (pt[1] + annotation["bbox"][0]),
                     (1 / zoom) * (pt[0] + annotation["bbox"][1]),
                 ]
                 pt = rotate_around_point_highperf(pt, -rot, center)
-                sm.egg_positions_full_scale[path].append(pt)
+                egg_positions.append(pt)
+        sm.egg_positions_full_scale[path] = egg_positions
     
     def prepareAnnotatedImage(self, sm, id, path, path_base):
         self.font = drawing.loadFont(80)
-        img = sm.open_image(path, dtype=np.uint8)
+        img = np.array(sm.open_image(path, dtype=np.uint8))
         check_counts = path_base in self.sessions[id]["edited_counts"]
         if check_counts:
             been_edited = [
@@ -166,6 +168,8 @@ class DownloadManager:
 
     def createImagesForDownload(self, id):
         sm = self.sessions[id]["session_manager"]
+        if backend_type == BackendTypes.sql:
+            writer = annotated_img_writer(sm.room)
         for path in sm.predictions:
             path_base = os.path.basename(path)
             if inspect.isclass(sm.predictions[path][0]) and issubclass(
@@ -176,14 +180,17 @@ class DownloadManager:
                 img = self.prepareAnnotatedImage(sm, id, path, path_base)
 
             if backend_type == BackendTypes.sql:
-
-                img_entity = EggLayingImage.query.filter_by(
-                    session_id=sm.room, basename=path_base
-                ).first()
-                img_entity.annotated_img = cv2.imencode(
-                    f".{os.path.splitext(path_base)[1]}",
-                    cv2.cvtColor(img, cv2.COLOR_RGB2BGR),
-                )[1].tobytes()
-                db.session.commit()
+                key = EggLayingImage.annotated_img_key_for(sm.room, path_base)
+                blob_store.put(
+                    key,
+                    data=cv2.imencode(
+                        f".{os.path.splitext(path_base)[1]}",
+                        cv2.cvtColor(img, cv2.COLOR_RGB2BGR),
+                    )[1].tobytes(),
+                )
+                writer.add(image_basename=path_base, key=key)
             elif backend_type == BackendTypes.filesystem:
                 cv2.imwrite(os.path.join(self.sessions[id]["folder"], path_base), img)
+        if backend_type == BackendTypes.sql:
+            writer.flush()
+            db.session.commit()
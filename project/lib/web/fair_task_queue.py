@@ -0,0 +1,122 @@
+from collections import deque
+import itertools
+import queue
+import threading
+import time
+
+from project.lib.web.gpu_task import GPUTask
+from project.lib.web.gpu_task_types import GPUTaskTypes
+
+TASK_TYPE_PRIORITIES = {GPUTaskTypes.arena: 0, GPUTaskTypes.egg: 1}
+
+
+class FairShareTaskQueue:
+    """Queue of GPU tasks that takes turns between rooms, serves interactive
+    task types (e.g., arena detection) before bulk ones (e.g., egg counting)
+    and raises the priority of tasks by one level once they've waited, so that
+    none of them starve.
+
+    Mirrors the put/get interface of queue.Queue.
+    """
+
+    def __init__(self, aging_interval=30, priorities=TASK_TYPE_PRIORITIES):
+        """Create a new FairShareTaskQueue instance.
+
+        Arguments:
+          - aging_interval: number of seconds a task needs to wait for its
+                            priority to be raised by one level
+          - priorities: dict mapping task types to their base priority (lower
+                        values get served first)
+        """
+        self.aging_interval = aging_interval
+        self.priorities = priorities
+        self.queues = {}
+        self.last_served = {}
+        self.n_tasks = 0
+        self.sequence = itertools.count()
+        self.services = itertools.count()
+        self.not_empty = threading.Condition()
+
+    def qsize(self):
+        return self.n_tasks
+
+    def empty(self):
+        return self.n_tasks == 0
+
+    def qsize_for_room(self, room):
+        with self.not_empty:
+            return sum(len(q) for q in self.queues.get(room, {}).values())
+
+    def snapshot(self):
+        """Return a list of the queued tasks, in no particular order."""
+        with self.not_empty:
+            return [
+                entry[2]
+                for room_queues in self.queues.values()
+                for task_queue in room_queues.values()
+                for entry in task_queue
+            ]
+
+    def put(self, task: GPUTask):
+        with self.not_empty:
+            self.put_nowait(task)
+            self.not_empty.notify()
+
+    def put_nowait(self, task: GPUTask):
+        room_queues = self.queues.setdefault(task.task_group.room, {})
+        room_queues.setdefault(task.task_type, deque()).append(
+            (time.time(), next(self.sequence), task)
+        )
+        self.last_served.setdefault(task.task_group.room, -1)
+        self.n_tasks += 1
+
+    def effective_priority(self, task_type, enqueue_time, now):
+        """Return the priority of a task type's queue head, raised by one level
+        once it has waited aging_interval seconds. Aging never lifts a task
+        above the top base priority, so that a room with a large backlog of
+        old tasks still takes turns with the others."""
+        priority = self.priorities.get(task_type, len(self.priorities))
+        if now - enqueue_time >= self.aging_interval:
+            priority = max(priority - 1, min(self.priorities.values(), default=0))
+        return priority
+
+    def select(self):
+        """Return the room and task type of the task that should be served next:
+        the one with the best effective priority, with ties going first to the
+        room served least recently and then to the task enqueued earliest."""
+        now = time.time()
+        best_key, best = None, None
+        for room, room_queues in self.queues.items():
+            for task_type, task_queue in room_queues.items():
+                enqueue_time, seq, _ = task_queue[0]
+                key = (
+                    self.effective_priority(task_type, enqueue_time, now),
+                    self.last_served[room],
+                    seq,
+                )
+                if best_key is None or key < best_key:
+                    best_key, best = key, (room, task_type)
+        return best
+
+    def get_nowait(self) -> GPUTask:
+        if self.n_tasks == 0:
+            raise queue.Empty
+        room, task_type = self.select()
+        task = self.queues[room][task_type].popleft()[2]
+        if len(self.queues[room][task_type]) == 0:
+            del self.queues[room][task_type]
+        if len(self.queues[room]) == 0:
+            del self.queues[room]
+            del self.last_served[room]
+        else:
+            self.last_served[room] = next(self.services)
+        self.n_tasks -= 1
+        return task
+
+    def get(self, block=True, timeout=None) -> GPUTask:
+        with self.not_empty:
+            if block and not self.not_empty.wait_for(
+                lambda: self.n_tasks > 0, timeout=timeout
+            ):
+                raise queue.Empty
+            return self.get_nowait()
@@ -0,0 +1,69 @@
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from threading import Lock
+import traceback
+
+
+class FinalizationExecutor:
+    """Run the finalization of GPU task results on a bounded pool of threads,
+    optionally offloading CPU-heavy steps to a pool of processes, and track
+    how many finalizations are pending so that workers can be slowed down."""
+
+    def __init__(self, n_threads=4, max_queue_depth=32, n_processes=0):
+        """Create a new FinalizationExecutor instance.
+
+        Arguments:
+          - n_threads: number of threads finalizing results
+          - max_queue_depth: number of pending finalizations above which
+                             workers are asked to back off
+          - n_processes: number of processes for CPU-heavy steps. If 0, those
+                         steps run on the finalizing thread instead.
+        """
+        self.n_threads = n_threads
+        self.max_queue_depth = max_queue_depth
+        self.threads = ThreadPoolExecutor(
+            max_workers=n_threads, thread_name_prefix="finalizer"
+        )
+        self.processes = (
+            ProcessPoolExecutor(max_workers=n_processes) if n_processes > 0 else None
+        )
+        self.queue_depth = 0
+        self.lock = Lock()
+
+    @property
+    def overloaded(self):
+        return self.queue_depth >= self.max_queue_depth
+
+    @property
+    def backoff(self):
+        """Return the number of seconds workers should wait before requesting
+        more work (zero unless the executor is overloaded)."""
+        if not self.overloaded:
+            return 0
+        return min(30, self.queue_depth / self.n_threads)
+
+    def submit(self, fn, *args) -> Future:
+        with self.lock:
+            self.queue_depth += 1
+        future = self.threads.submit(fn, *args)
+        future.add_done_callback(self.on_done)
+        return future
+
+    def on_done(self, future: Future):
+        with self.lock:
+            self.queue_depth -= 1
+        exc = future.exception()
+        if exc is not None:
+            print("exception while finalizing task results:")
+            traceback.print_exception(type(exc), exc, exc.__traceback__)
+
+    def run_cpu_task(self, fn, *args):
+        """Run a CPU-heavy function (which, along with its arguments and return
+        value, must be picklable) and return its result."""
+        if self.processes is None:
+            return fn(*args)
+        return self.processes.submit(fn, *args).result()
+
+    def shutdown(self):
+        self.threads.shutdown(wait=True)
+        if self.processes is not None:
+            self.processes.shutdown(wait=True)
@@ -1,40 +1,358 @@
-import queue
-from threading import Event
-from typing import List
+import copy
+import os
+import time
+from typing import Dict
+import uuid
 
+from project.lib.event import Event as NotificationEvent, Listener
+from project.lib.web.admission_control import AdmissionController
+from project.lib.web.fair_task_queue import TASK_TYPE_PRIORITIES
 from project.lib.web.gpu_task import GPUTask
 from project.lib.web.gpu_task_group import GPUTaskGroup
+from project.lib.web.gpu_task_types import GPUTaskTypes
+from project.lib.web.result_cache import ResultCache
+from project.lib.web.task_queue_backend import (
+    InMemoryTaskQueueBackend,
+    TaskQueueBackend,
+)
+from project.lib.web.task_waiters import TaskWaiterRegistry
+from project.lib.web.throughput_estimator import ThroughputEstimator
 
 
 class GPUManager:
-    def __init__(self):
-        self.queue = queue.Queue()
+    def __init__(
+        self,
+        result_cache: ResultCache = None,
+        task_aging_interval=30,
+        lease_duration=120,
+        max_attempts=3,
+        task_group_ttl=60 * 60,
+        backend: TaskQueueBackend = None,
+        n_workers=1,
+        admission_controller: AdmissionController = None,
+    ):
+        """Create a new GPUManager instance.
+
+        Arguments:
+          - result_cache: ResultCache used to complete repeat tasks without a
+                          worker (optional)
+          - task_aging_interval: number of seconds a queued task waits before
+                                 its priority is raised by one level
+          - lease_duration: number of seconds a worker may hold a task without
+                            sending a heartbeat before the task is requeued
+          - max_attempts: number of times a task is leased before it's
+                          abandoned
+          - task_group_ttl: number of seconds without activity after which a
+                            task group is considered abandoned and removed
+          - backend: TaskQueueBackend where tasks are queued. Defaults to a
+                     queue in the memory of this process.
+          - n_workers: number of GPU workers, used to estimate how long queued
+                       tasks will take to complete
+          - admission_controller: AdmissionController limiting the outstanding
+                                  tasks (optional)
+        """
+        self.instance_id = str(uuid.uuid4())
+        self.backend = (
+            InMemoryTaskQueueBackend(aging_interval=task_aging_interval)
+            if backend is None
+            else backend
+        )
+        self.task_groups: Dict[str, GPUTaskGroup]
         self.task_groups = {}
-        self.task_requests: List[Event]
-        self.task_requests = []
+        self.task_waiters = TaskWaiterRegistry()
+        self.result_cache = result_cache
+        self.on_results = NotificationEvent()
+        self.lease_duration = lease_duration
+        self.max_attempts = max_attempts
+        self.task_group_ttl = task_group_ttl
+        self.on_task_abandoned = NotificationEvent()
+        self.n_workers = n_workers
+        self.throughput = ThroughputEstimator()
+        self.admission_controller = admission_controller
+        self.on_task_admission = NotificationEvent()
 
-    def add_task_group(self, room, n_tasks, task_type) -> GPUTaskGroup:
-        new_taskgroup = GPUTaskGroup(n_tasks, room, task_type)
+    def add_task_group(
+        self, room, n_tasks, task_type, streaming=False
+    ) -> GPUTaskGroup:
+        new_taskgroup = GPUTaskGroup(n_tasks, room, task_type, streaming=streaming)
         self.task_groups[new_taskgroup.id] = new_taskgroup
         return self.task_groups[new_taskgroup.id]
 
     def register_completed_task(self, results, group_id):
-        self.task_groups[group_id].register_completed_task(results)
-        if self.task_groups[group_id].complete:
-            del self.task_groups[group_id]
+        if group_id not in self.task_groups:
+            return
+        task_group = self.task_groups[group_id]
+        task_group.register_completed_task(results)
+        if task_group.complete:
+            self.task_groups.pop(group_id, None)
 
-    def add_task_request(self, request: Event):
-        self.task_requests.insert(0, request)
+    def discard_task_group(self, group_id):
+        self.task_groups.pop(group_id, None)
+        self.backend.discard_group(group_id)
+        if self.admission_controller is not None:
+            self.enqueue_admitted(self.admission_controller.release_group(group_id))
 
-    def add_task(self, task_group, img_path, data={}):
-        task = GPUTask(task_group, img_path, data)
-        self.queue.put(task)
-        if len(self.task_requests) > 0:
-            task_request = self.task_requests.pop()
-            task_request.set()
+    def add_results_listener(self, listener: Listener):
+        """Register a listener called with the group ID and the raw results of
+        each task completed without being posted to this instance by a worker,
+        i.e., from the result cache or via another server instance."""
+        self.on_results += listener
 
-    def get_task(self):
+    def add_abandoned_task_listener(self, listener: Listener):
+        """Register a listener called with each task whose lease expired more
+        times than allowed."""
+        self.on_task_abandoned += listener
+
+    def add_task_admission_listener(self, listener: Listener):
+        """Register a listener called with each task that gets deferred by the
+        admission controller (status "deferred") and with each deferred task
+        when it's finally queued (status "queued")."""
+        self.on_task_admission += listener
+
+    def complete_from_cache(self, task: GPUTask):
+        if self.result_cache is None:
+            return False
+        task.cache_key = self.result_cache.key_for_task(
+            task.task_type, task.img_path, task.data
+        )
+        if task.cache_key is None:
+            return False
+        results = self.result_cache.get(task.cache_key)
+        if results is None:
+            return False
+        results = copy.deepcopy(results)
+        if task.task_type == GPUTaskTypes.egg:
+            results["metadata"]["index"] = task.data["index"]
+            results["metadata"]["filename"] = os.path.basename(task.img_path)
+        self.on_results.notify(
+            {"group_id": task.task_group.id, "results": results}
+        )
+        return True
+
+    def cache_results(self, results, task: GPUTask):
+        """Store the raw results posted by a worker, if they're cacheable."""
+        if task.cache_key is None or not ResultCache.is_cacheable(results):
+            return
+        self.result_cache.put(task.cache_key, results)
+
+    def add_task(self, task_group, img_path, data={}, n_bytes=0):
+        """Queue a task, unless its results are cached or the admission
+        controller defers it.
+
+        Arguments:
+          - task_group: GPUTaskGroup the task belongs to
+          - img_path: path of the image to analyze
+          - data: task-specific data passed to the worker
+          - n_bytes: size of the decoded image, counted by the admission
+                     controller
+        """
+        task = GPUTask(task_group, img_path, data, n_bytes=n_bytes)
+        if self.complete_from_cache(task):
+            return
+        if self.admission_controller is None or self.admission_controller.admit(
+            task
+        ):
+            self.enqueue(task)
+        else:
+            self.on_task_admission.notify({"task": task, "status": "deferred"})
+
+    def enqueue_admitted(self, tasks):
+        for task in tasks:
+            if task.task_group.id not in self.task_groups:
+                self.release(task.id)
+                continue
+            self.enqueue(task)
+            self.on_task_admission.notify({"task": task, "status": "queued"})
+
+    def release(self, task_id):
+        """Stop counting a task against the admission limits."""
+        if self.admission_controller is not None:
+            self.enqueue_admitted(self.admission_controller.release(task_id))
+
+    def enqueue(self, task: GPUTask):
+        self.backend.put(task, self.instance_id)
+        self.task_waiters.notify_one()
+
+    def wait_for_task(self, timeout):
+        """Wait until a task is available (or the timeout elapses). With a
+        shared backend, tasks added by other instances don't wake the waiter,
+        so the backend is checked periodically as well."""
+        waiter = self.task_waiters.register()
         try:
-            return self.queue.get(timeout=0.5)
-        except queue.Empty:
+            # a task enqueued after the caller last found the queue empty but
+            # before the waiter was registered woke no one
+            if self.backend.qsize() > 0:
+                return True
+            if not self.backend.shared:
+                return waiter.wait(timeout)
+            deadline = time.time() + timeout
+            while time.time() < deadline:
+                if waiter.wait(min(1, deadline - time.time())):
+                    return True
+                if self.backend.qsize() > 0:
+                    return True
+            return False
+        finally:
+            self.task_waiters.cancel(waiter)
+
+    def get_task(self):
+        self.requeue_expired_leases()
+        task = self.backend.lease(0.5, self.lease_duration)
+        if task is None:
             return {}
+        if task.task_group.id in self.task_groups:
+            task.task_group = self.task_groups[task.task_group.id]
+        return task
+
+    def renew_lease(self, task_id):
+        """Extend the lease of a task; return False if the task isn't leased."""
+        return self.backend.renew(task_id, self.lease_duration)
+
+    def complete_task(self, task_id):
+        """Release the lease of a task whose results were submitted.
+
+        Returns the task, or None if its results were already submitted (or the
+        task is otherwise unknown), in which case the submission should be
+        ignored. Results are accepted even if the lease expired in the meantime,
+        in which case the requeued copy of the task gets skipped.
+        """
+        task = self.backend.complete(task_id)
+        if task is not None:
+            self.release(task_id)
+        return task
+
+    def record_timing(self, task: GPUTask, timing):
+        """Update the throughput estimates with the timing a worker reported for
+        a task, i.e., a dict with the number of seconds spent on it and the
+        number of regions it covered."""
+        self.throughput.record(task.task_type, timing["n_regions"], timing["seconds"])
+
+    def estimate_task_seconds(self, task: GPUTask):
+        return self.throughput.estimate(task.task_type, task.n_regions)
+
+    def queue_status(self):
+        """Return a dict mapping each room with outstanding tasks to its queue
+        status:
+          - queued: number of queued tasks of the room
+          - processing: number of the room's tasks leased by workers
+          - deferred: number of the room's tasks deferred by the admission
+                      controller, which get queued as earlier tasks complete
+          - position: number of other rooms whose tasks are waiting (with rooms
+                      taking turns, at most this many tasks are served before
+                      the room's next one)
+          - eta_seconds: estimated number of seconds until all of the room's
+                         tasks are completed
+          - completion_time: timestamp of the estimated completion
+        """
+        deferred_tasks = (
+            []
+            if self.admission_controller is None
+            else self.admission_controller.deferred_tasks()
+        )
+        durations = {}
+        n_queued = {}
+        for task in sorted(
+            self.backend.queued_tasks(),
+            key=lambda task: TASK_TYPE_PRIORITIES.get(
+                task.task_type, len(TASK_TYPE_PRIORITIES)
+            ),
+        ):
+            room = task.task_group.room
+            durations.setdefault(room, []).append(self.estimate_task_seconds(task))
+            n_queued[room] = n_queued.get(room, 0) + 1
+        n_deferred = {}
+        for task in deferred_tasks:
+            room = task.task_group.room
+            durations.setdefault(room, []).append(self.estimate_task_seconds(task))
+            n_deferred[room] = n_deferred.get(room, 0) + 1
+        n_processing = {}
+        processing_seconds = 0
+        for task in self.backend.leased_tasks():
+            room = task.task_group.room
+            n_processing[room] = n_processing.get(room, 0) + 1
+            processing_seconds += self.estimate_task_seconds(task)
+        now = time.time()
+        statuses = {}
+        for room in {**n_processing, **durations}:
+            # workers finish the tasks they hold first; then, while the room
+            # has tasks waiting, every other room gets a turn for each of them
+            n_turns = len(durations.get(room, []))
+            total_seconds = processing_seconds + sum(
+                sum(other_durations[:n_turns]) for other_durations in durations.values()
+            )
+            eta = total_seconds / max(self.n_workers, 1)
+            statuses[room] = {
+                "queued": n_queued.get(room, 0),
+                "processing": n_processing.get(room, 0),
+                "deferred": n_deferred.get(room, 0),
+                "position": len(durations) - (room in durations),
+                "eta_seconds": round(eta, 1),
+                "completion_time": now + eta,
+            }
+        return statuses
+
+    def queue_status_for_room(self, room):
+        return self.queue_status().get(
+            room,
+            {
+                "queued": 0,
+                "processing": 0,
+                "deferred": 0,
+                "position": 0,
+                "eta_seconds": 0,
+                "completion_time": None,
+            },
+        )
+
+    def backlog_status(self):
+        """Summarize the queue for all rooms, e.g., for autoscaling decisions."""
+        tasks = self.backend.queued_tasks()
+        work_seconds = sum(self.estimate_task_seconds(task) for task in tasks)
+        return {
+            "queued": len(tasks),
+            "rooms": len({task.task_group.room for task in tasks}),
+            "n_workers": self.n_workers,
+            "work_seconds": round(work_seconds, 1),
+            "drain_seconds": round(work_seconds / max(self.n_workers, 1), 1),
+            "task_seconds": self.throughput.as_dict(),
+        }
+
+    def forward_results(self, task_id, results):
+        """Hand over results for a task whose group is held by another server
+        instance (only possible with a shared backend)."""
+        self.backend.post_results(task_id, results)
+
+    def deliver_forwarded_results(self):
+        """Finalize results that other server instances received for task
+        groups held by this instance."""
+        for group_id, results in self.backend.fetch_results(self.instance_id):
+            self.release(results.pop("task_id"))
+            if group_id in self.task_groups:
+                self.on_results.notify({"group_id": group_id, "results": results})
+
+    def requeue_expired_leases(self):
+        for task in self.backend.expire_leases(self.instance_id):
+            if task.task_group.id not in self.task_groups:
+                self.backend.complete(task.id)
+                self.release(task.id)
+                continue
+            task.task_group = self.task_groups[task.task_group.id]
+            if task.attempts >= self.max_attempts:
+                print(f"abandoning task {task.id} for {task.img_path}")
+                if self.backend.complete(task.id) is not None:
+                    self.release(task.id)
+                    self.on_task_abandoned.notify({"task": task})
+            else:
+                print(f"lease expired; requeueing task for {task.img_path}")
+                self.backend.requeue(task)
+                self.task_waiters.notify_one()
+
+    def collect_garbage(self):
+        """Remove task groups that have been inactive for longer than the TTL,
+        along with records of completed tasks older than the TTL."""
+        limit = time.time() - self.task_group_ttl
+        for group_id in list(self.task_groups.keys()):
+            if self.task_groups[group_id].last_activity < limit:
+                print(f"removing abandoned task group {group_id}")
+                self.discard_task_group(group_id)
+        self.backend.collect_garbage(limit)
@@ -1,12 +1,26 @@
+import uuid
+
 from project.lib.web.gpu_task_group import GPUTaskGroup
 
 
 class GPUTask:
-    def __init__(self, task_group: GPUTaskGroup, img_path, data):
+    def __init__(self, task_group: GPUTaskGroup, img_path, data, id=None, n_bytes=0):
+        self.id = str(uuid.uuid1()) if id is None else id
         self.task_group = task_group
         self.img_path = img_path
         self.data = data
+        self.cache_key = None
+        self.attempts = 0
+        self.owner = None
+        self.n_bytes = n_bytes
 
     @property
     def task_type(self):
         return self.task_group.task_type
+
+    @property
+    def n_regions(self):
+        """Return the number of egg-laying regions, if known before analysis."""
+        if "bboxes" not in self.data:
+            return None
+        return len(self.data["bboxes"])
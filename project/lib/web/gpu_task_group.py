@@ -1,29 +1,57 @@
+from threading import Lock
+import time
 import uuid
 
 from project.lib.event import Event, Listener
 
 
 class GPUTaskGroup:
-    """sends a notification when a group of tasks has been completed."""
+    """sends a notification when a group of tasks has been completed.
 
-    def __init__(self, n_tasks, room, task_type):
-        self.id = str(uuid.uuid1())
+    In streaming mode, each task's results are also sent to the result listeners
+    as soon as they arrive, and aren't kept until the whole group is complete;
+    the completion listeners are then called without arguments.
+    """
+
+    def __init__(self, n_tasks, room, task_type, id=None, streaming=False):
+        self.id = str(uuid.uuid1()) if id is None else id
         self.room = room
         self.n_tasks = n_tasks
         self.task_type = task_type
+        self.streaming = streaming
         self.results = []
+        self.n_completed = 0
+        self.lock = Lock()
+        self.on_result = Event()
         self.on_completion = Event()
+        self.touch()
+
+    def touch(self):
+        self.last_activity = time.time()
 
     @property
     def complete(self):
-        return len(self.results) == self.n_tasks
+        return self.n_completed == self.n_tasks
+
+    def add_result_listener(self, listener: Listener):
+        self.on_result += listener
 
     def add_completion_listener(self, listener: Listener):
         self.on_completion += listener
 
     def register_completed_task(self, results):
-        self.results.append(results)
-        if self.complete:
+        self.touch()
+        if self.streaming:
+            self.on_result.notify(results)
+        with self.lock:
+            if not self.streaming:
+                self.results.append(results)
+            self.n_completed += 1
+            if not self.complete:
+                return
+        if self.streaming:
+            self.on_completion.notify()
+        else:
             self.notify_complete()
 
     def notify_complete(self):
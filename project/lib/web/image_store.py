@@ -0,0 +1,117 @@
+import hashlib
+import os
+from pathlib import Path
+import shutil
+from threading import Lock
+import uuid
+
+
+def content_digest(data=None, path=None, block_size=1024**2):
+    """Return the SHA-256 hex digest of an image's bytes, or of those of the
+    file at `path` (read a block at a time)."""
+    if path is None:
+        return hashlib.sha256(data).hexdigest()
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class FileImageStore:
+    """Content-addressed store of uploaded images for the filesystem backend.
+
+    Each distinct image is stored once, under a path derived from the SHA-256
+    digest of its bytes and sharded into two levels of subfolders (e.g.,
+    objects/ab/cd/abcd...), so that no folder grows too large. Sessions
+    reference an image through a hard link at uploads/<sid>/<filename>, which
+    makes the link count of an object its reference count: once all sessions
+    referencing it have been deleted, it becomes an orphan and is collected.
+    The levels of an image's pyramid are stored next to it, e.g., as
+    objects/ab/cd/abcd..._4.jpg for the level downscaled by a factor of 4.
+    """
+
+    def __init__(self, folder=os.path.join("uploads", "objects")):
+        """Create a new FileImageStore instance.
+
+        Arguments:
+          - folder: folder holding the stored images
+        """
+        self.folder = folder
+        self.object_paths = set()
+        self.lock = Lock()
+        self.index_existing_objects()
+
+    def index_existing_objects(self):
+        if not os.path.isdir(self.folder):
+            return
+        for dirpath, _, filenames in os.walk(self.folder):
+            for fname in filenames:
+                self.object_paths.add(os.path.join(dirpath, fname))
+
+    def object_path(self, sha256):
+        return os.path.join(self.folder, sha256[:2], sha256[2:4], sha256)
+
+    def store(self, sha256, file_path, data=None, staged_path=None, levels=None):
+        """Store an image unless it's stored already, and reference it from a
+        session's upload folder.
+
+        Arguments:
+          - sha256: SHA-256 hex digest of the image's bytes
+          - file_path: path of the session's reference (uploads/<sid>/<filename>)
+          - data: the image's bytes
+          - staged_path: path of a file with the image's bytes, used instead of
+                         data; it's moved into the store or removed
+          - levels: dict mapping downscaling factors to the encoded levels of
+                    the image's pyramid, stored and referenced the same way
+        """
+        object_path = self.object_path(sha256)
+        self.store_object(object_path, file_path, data, staged_path)
+        for factor, level_data in (levels or {}).items():
+            self.store_object(
+                f"{object_path}_{factor}.jpg",
+                self.level_path(file_path, factor),
+                level_data,
+            )
+
+    @staticmethod
+    def level_path(file_path, factor):
+        """Return the path of a session's reference to a level of an image's
+        pyramid."""
+        return os.path.join(
+            os.path.dirname(file_path),
+            ".pyramid",
+            f"{os.path.basename(file_path)}_{factor}.jpg",
+        )
+
+    def store_object(self, object_path, file_path, data=None, staged_path=None):
+        Path(object_path).parent.mkdir(parents=True, exist_ok=True)
+        Path(file_path).parent.mkdir(parents=True, exist_ok=True)
+        if staged_path is None:
+            staged_path = f"{object_path}.{uuid.uuid4().hex}.tmp"
+            with open(staged_path, "wb") as f:
+                f.write(data)
+        with self.lock:
+            if os.path.isfile(object_path):
+                os.remove(staged_path)
+            else:
+                os.replace(staged_path, object_path)
+                self.object_paths.add(object_path)
+            if os.path.lexists(file_path):
+                os.remove(file_path)
+            try:
+                os.link(object_path, file_path)
+            except OSError:  # e.g., hard links unsupported by the filesystem
+                shutil.copyfile(object_path, file_path)
+
+    def collect_orphans(self):
+        """Delete the stored images no longer referenced by any session."""
+        with self.lock:
+            for object_path in list(self.object_paths):
+                try:
+                    if os.stat(object_path).st_nlink > 1:
+                        continue
+                    os.remove(object_path)
+                except FileNotFoundError:
+                    pass
+                self.object_paths.discard(object_path)
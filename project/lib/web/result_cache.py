@@ -0,0 +1,176 @@
+from collections import OrderedDict
+import hashlib
+import json
+import os
+from pathlib import Path
+import threading
+
+from project import backend_type
+from project.lib.datamanagement.models import EggLayingImage
+from project.lib.image.metadata import image_metadata
+from project.lib.web.backend_types import BackendTypes
+from project.lib.web.gpu_task_types import GPUTaskTypes
+from project.lib.web.image_store import content_digest
+
+ALIGNMENT_KEYS = (
+    "bboxes",
+    "nodes",
+    "rotationAngle",
+    "scaling",
+    "type",
+    "inverted",
+    "imageTranslation",
+)
+
+with open("project/models/modelRevDates.json", "r") as f:
+    MODEL_REVISION = json.load(f)["latest"]
+
+
+def canonicalize(value, n_digits=6):
+    """Return a copy of JSON-like data with floats rounded, so that alignment
+    data that round-trips through the browser still yields the same key."""
+    if isinstance(value, float):
+        rounded = round(value, n_digits)
+        return int(rounded) if rounded.is_integer() else rounded
+    if isinstance(value, dict):
+        return {k: canonicalize(v, n_digits) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [canonicalize(el, n_digits) for el in value]
+    return value
+
+
+def image_digest(img_path):
+    """Return the SHA-256 hex digest of the stored bytes of an uploaded image."""
+    if backend_type == BackendTypes.sql:
+        # images are stored by content, so the digest is known without reading
+        # their bytes
+        path_split = os.path.normpath(img_path).split(os.path.sep)
+        return EggLayingImage.find_column(
+            path_split[-2], path_split[-1], EggLayingImage.content_sha256
+        )
+    if not os.path.isfile(img_path):
+        return None
+    metadata = image_metadata.get(img_path)
+    if metadata.sha256 is None:
+        # recorded at ingestion, unless the metadata was evicted since
+        metadata = metadata._replace(sha256=content_digest(path=img_path))
+        image_metadata.put(img_path, metadata)
+    return metadata.sha256
+
+
+class ResultCache:
+    """Two-tier (memory and disk) cache of raw GPU worker results, keyed by
+    the content of the image, its alignment data and the model revision."""
+
+    def __init__(self, folder, max_entries=256, max_disk_bytes=512 * 1024**2):
+        """Create a new ResultCache instance.
+
+        Arguments:
+          - folder: directory where the persistent tier is stored
+          - max_entries: max number of results to hold in memory
+          - max_disk_bytes: max combined size of the results stored on disk
+        """
+        self.folder = folder
+        self.max_entries = max_entries
+        self.max_disk_bytes = max_disk_bytes
+        self.memory = OrderedDict()
+        self.disk_index = OrderedDict()
+        self.disk_bytes = 0
+        self.lock = threading.Lock()
+        Path(folder).mkdir(parents=True, exist_ok=True)
+        self.load_disk_index()
+
+    def load_disk_index(self):
+        entries = []
+        for fname in os.listdir(self.folder):
+            if not fname.endswith(".json"):
+                continue
+            stat = os.stat(os.path.join(self.folder, fname))
+            entries.append((stat.st_mtime, fname[: -len(".json")], stat.st_size))
+        for _, key, size in sorted(entries):
+            self.disk_index[key] = size
+            self.disk_bytes += size
+
+    def path_for_key(self, key):
+        return os.path.join(self.folder, f"{key}.json")
+
+    @staticmethod
+    def make_key(task_type: GPUTaskTypes, img_digest, data):
+        alignment_data = {k: data[k] for k in ALIGNMENT_KEYS if k in data}
+        key_data = {
+            "task_type": task_type.name,
+            "image": img_digest,
+            "alignment": canonicalize(alignment_data),
+            "model": MODEL_REVISION,
+        }
+        return hashlib.sha256(
+            json.dumps(key_data, sort_keys=True, separators=(",", ":")).encode()
+        ).hexdigest()
+
+    def key_for_task(self, task_type: GPUTaskTypes, img_path, data):
+        """Return the cache key for a task, or None if the task shouldn't be
+        cached (e.g., ignored images or images that can't be found)."""
+        if data.get("ignored", False):
+            return None
+        img_digest = image_digest(img_path)
+        if img_digest is None:
+            return None
+        return self.make_key(task_type, img_digest, data)
+
+    def get(self, key):
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                return self.memory[key]
+            if key not in self.disk_index:
+                return None
+            try:
+                with open(self.path_for_key(key), "r") as f:
+                    results = json.load(f)
+            except (OSError, json.decoder.JSONDecodeError):
+                self.disk_bytes -= self.disk_index.pop(key)
+                return None
+            os.utime(self.path_for_key(key))
+            self.disk_index.move_to_end(key)
+            self.add_to_memory(key, results)
+            return results
+
+    def put(self, key, results):
+        with self.lock:
+            self.add_to_memory(key, results)
+            serialized = json.dumps(results, separators=(",", ":"))
+            if len(serialized) > self.max_disk_bytes:
+                return
+            with open(self.path_for_key(key), "w") as f:
+                f.write(serialized)
+            self.disk_bytes += len(serialized) - self.disk_index.pop(key, 0)
+            self.disk_index[key] = len(serialized)
+            self.evict_from_disk()
+
+    def add_to_memory(self, key, results):
+        self.memory[key] = results
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+
+    def evict_from_disk(self):
+        while self.disk_bytes > self.max_disk_bytes:
+            key, size = self.disk_index.popitem(last=False)
+            self.disk_bytes -= size
+            try:
+                os.remove(self.path_for_key(key))
+            except FileNotFoundError:
+                pass
+
+    @staticmethod
+    def is_cacheable(results):
+        if "error" in results or not results.get("predictions"):
+            return False
+        metadata = results.get("metadata", {})
+        if metadata.get("ignored", False):
+            return False
+        # a region whose inference failed is left out of the predictions, so
+        # only cache results covering every region
+        return "bboxes" not in metadata or len(metadata["bboxes"]) == len(
+            results["predictions"]
+        )
@@ -0,0 +1,133 @@
+import heapq
+import os
+import shutil
+from threading import Lock
+import time
+
+from project import app, backend_type
+from project.lib.datamanagement.models import (
+    delete_expired_rows,
+    delete_sessions,
+    EggLayingImage,
+    SocketIOUser,
+)
+from project.lib.web.backend_types import BackendTypes
+
+
+class RetentionService:
+    """Delete uploaded data once it expires, in the background.
+
+    Expiry times of the entries of the upload folders (which hold the uploads
+    of the filesystem backend and partial uploads of either backend) are kept
+    in an index, updated as entries are written, so sweeps don't rescan the
+    folders. For the SQL backend, expired rows are deleted, along with the rows
+    of sessions that disconnected. Each sweep deletes at most `batch_size`
+    items of each kind; the rest are left for later sweeps. Images of an image
+    store that are no longer referenced once entries are deleted get collected.
+    """
+
+    def __init__(
+        self,
+        folders=("uploads", "downloads"),
+        max_age=60 * 60,
+        batch_size=100,
+        image_store=None,
+    ):
+        """Create a new RetentionService instance.
+
+        Arguments:
+          - folders: folders whose entries expire
+          - max_age: number of seconds after which an entry or row expires
+          - batch_size: max number of items of each kind deleted per sweep
+          - image_store: FileImageStore whose folder is within one of the
+                         folders (it doesn't expire itself)
+        """
+        self.folders = folders
+        self.max_age = max_age
+        self.batch_size = batch_size
+        self.image_store = image_store
+        self.expiry_times = {}
+        self.expiry_heap = []
+        self.disconnected_sessions = []
+        self.lock = Lock()
+        self.index_existing_entries()
+
+    def index_existing_entries(self):
+        """Add the entries already in the folders (e.g., left over from a
+        previous run) to the index, based on their modification times."""
+        for folder in self.folders:
+            if not os.path.isdir(folder):
+                continue
+            for fname in os.listdir(folder):
+                if fname == ".gitkeep":
+                    continue
+                path = os.path.join(folder, fname)
+                if self.image_store is not None and os.path.normpath(
+                    path
+                ) == os.path.normpath(self.image_store.folder):
+                    continue
+                self.track(path, os.stat(path).st_mtime)
+
+    def track(self, path, modified_at=None):
+        """Record that an entry of one of the folders was written to, which
+        postpones its expiry."""
+        path = os.path.normpath(path)
+        if modified_at is None:
+            modified_at = time.time()
+        expires_at = modified_at + self.max_age
+        with self.lock:
+            self.expiry_times[path] = expires_at
+            heapq.heappush(self.expiry_heap, (expires_at, path))
+
+    def expire_session(self, sid):
+        """Schedule the rows of a disconnected session for deletion."""
+        if backend_type != BackendTypes.sql:
+            return
+        with self.lock:
+            self.disconnected_sessions.append(sid)
+
+    def pop_expired_paths(self):
+        now = time.time()
+        paths = []
+        with self.lock:
+            while (
+                self.expiry_heap
+                and self.expiry_heap[0][0] <= now
+                and len(paths) < self.batch_size
+            ):
+                expires_at, path = heapq.heappop(self.expiry_heap)
+                # skip entries whose expiry was postponed after being pushed
+                if self.expiry_times.get(path) == expires_at:
+                    del self.expiry_times[path]
+                    paths.append(path)
+        return paths
+
+    def sweep(self):
+        self.sweep_files()
+        if backend_type == BackendTypes.sql:
+            with app.app_context():
+                self.sweep_rows()
+
+    def sweep_files(self):
+        paths = self.pop_expired_paths()
+        for path in paths:
+            if os.path.isfile(path):
+                os.remove(path)
+            elif os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+        if len(paths) > 0 and self.image_store is not None:
+            self.image_store.collect_orphans()
+
+    def sweep_rows(self):
+        with self.lock:
+            sids = self.disconnected_sessions[: self.batch_size]
+            del self.disconnected_sessions[: self.batch_size]
+        if len(sids) > 0:
+            delete_sessions(sids)
+        for cls in (SocketIOUser, EggLayingImage):
+            delete_expired_rows(
+                cls,
+                expiration_seconds=self.max_age,
+                batch_size=self.batch_size,
+                max_batches=1,
+            )
@@ -1,33 +1,100 @@
-import schedule
+import heapq
+import itertools
 import threading
 import time
+import traceback
 
 
-class Scheduler:
-    def __init__(self, interval):
+class ScheduledCall:
+    """Handle of a function call scheduled on a Scheduler."""
+
+    def __init__(self, when, interval, fn, args):
+        self.when = when
         self.interval = interval
-        self.schedule = schedule
-
-    def run_continuously(self):
-        """Continuously run, while executing pending jobs at each
-        elapsed time interval.
-        @return cease_continuous_run: threading. Event which can
-        be set to cease continuous run. Please note that it is
-        *intended behavior that run_continuously() does not run
-        missed jobs*. For example, if you've registered a job that
-        should run every minute and you set a continuous run
-        interval of one hour then your job won't be run 60 times
-        at each interval but only once.
-        """
-        cease_continuous_run = threading.Event()
-
-        class ScheduleThread(threading.Thread):
-            @classmethod
-            def run(cls):
-                while not cease_continuous_run.is_set():
-                    schedule.run_pending()
-                    time.sleep(self.interval)
-
-        continuous_thread = ScheduleThread()
-        continuous_thread.start()
-        return cease_continuous_run
+        self.fn = fn
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        """Keep the call from running (again). Has no effect on a call that's
+        already in progress."""
+        self.cancelled = True
+
+
+class Scheduler:
+    """Run scheduled function calls on a single background thread.
+
+    Pending calls are kept in a heap ordered by due time, and the thread sleeps
+    until the earliest one is due (or a new call is scheduled), so the number
+    of threads doesn't grow with the number of calls. Calls should be short,
+    since they delay the ones due after them.
+    """
+
+    def __init__(self, name="scheduler"):
+        self.name = name
+        self.heap = []
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+        self.thread = None
+        self.stopped = False
+
+    def call_later(self, delay, fn, *args) -> ScheduledCall:
+        """Run fn(*args) once, after the given number of seconds."""
+        return self.add(ScheduledCall(time.time() + delay, None, fn, args))
+
+    def call_every(self, interval, fn, *args) -> ScheduledCall:
+        """Run fn(*args) every `interval` seconds, starting `interval` seconds
+        from now. Runs missed because earlier calls took too long are skipped
+        rather than made up for."""
+        return self.add(ScheduledCall(time.time() + interval, interval, fn, args))
+
+    def add(self, call: ScheduledCall):
+        with self.condition:
+            heapq.heappush(self.heap, (call.when, next(self.sequence), call))
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self.run, name=self.name, daemon=True
+                )
+                self.thread.start()
+            self.condition.notify()
+        return call
+
+    def next_due_call(self) -> ScheduledCall:
+        """Wait until a call is due and return it, or return None once the
+        scheduler is shut down."""
+        with self.condition:
+            while not self.stopped:
+                while self.heap and self.heap[0][2].cancelled:
+                    heapq.heappop(self.heap)
+                if not self.heap:
+                    self.condition.wait()
+                    continue
+                delay = self.heap[0][0] - time.time()
+                if delay > 0:
+                    self.condition.wait(delay)
+                    continue
+                call = heapq.heappop(self.heap)[2]
+                if call.interval is not None:
+                    call.when = max(call.when + call.interval, time.time())
+                    heapq.heappush(self.heap, (call.when, next(self.sequence), call))
+                return call
+        return None
+
+    def run(self):
+        while True:
+            call = self.next_due_call()
+            if call is None:
+                return
+            try:
+                call.fn(*call.args)
+            except Exception:
+                print(f"exception in scheduled call of {call.fn}:")
+                traceback.print_exc()
+
+    def shutdown(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+
+
+scheduler = Scheduler()
@@ -1,20 +1,31 @@
 import csv
 import cv2
 import inspect
-from io import BytesIO, StringIO
+from io import StringIO
 import json
 import numpy as np
 from PIL import Image, ImageDraw
 import os
+import sqlalchemy
 import time
 import traceback
+import uuid
 import warnings
 
 from project import backend_type, db
-from project.lib.datamanagement.models import EggLayingImage, ErrorReport
+from project.lib.datamanagement.blob_store import blob_store
+from project.lib.datamanagement.models import (
+    BatchWriter,
+    EggLayingImage,
+    ErrorReport,
+    ImageContent,
+)
 from project.lib.event import Listener
 from project.lib.image import drawing
 from project.lib.image.chamber import CT
+from project.lib.image.decoded_cache import decoded_images
+from project.lib.image.exif import open_oriented
+from project.lib.image.metadata import image_metadata
 from project.lib.image.circleFinder import (
     CircleFinder,
     rotate_around_point_highperf,
@@ -27,60 +38,106 @@ from project.lib.web.exceptions import (
     errorMessages,
     ImageAnalysisException,
 )
+from project.lib.web.finalization_executor import FinalizationExecutor
 from project.lib.web.gpu_manager import GPUManager
 from project.lib.web.gpu_task_types import GPUTaskTypes
+from project.lib.web.session_state_store import (
+    InMemorySessionStateStore,
+    SessionStateMap,
+    SessionStateStore,
+)
 
 warnings.filterwarnings("error")
 
 with open("project/models/modelRevDates.json", "r") as f:
     model_to_update_date = json.load(f)
 
+# per-image state of a session, kept in its SessionStateStore so that any
+# server process can serve the session; in-flight analyses (cfs,
+# counting_task_group, counted_filenames) stay with the process running them
+STATE_FIELDS = (
+    "chamberTypes",
+    "predictions",
+    "basenames",
+    "img_shapes",
+    "inverted",
+    "paths_to_indices",
+    "models_used_by_image",
+    "annotations",
+    "egg_positions_full_scale",
+    "bboxes",
+    "alignment_data",
+    "img_paths",
+)
+
+
+def find_circles(cf: CircleFinder, predictions):
+    """Run arena-well detection for a CircleFinder; return the CircleFinder
+    (whose state gets updated along the way) and the detection results."""
+    return (cf, *cf.findCircles(debug=False, predictions=predictions))
+
 
 class SessionManager:
     """Represent and process information while using the egg-counting web app."""
 
-    def __init__(self, socketIO, room, gpu_manager: GPUManager):
+    def __init__(
+        self,
+        socketIO,
+        room,
+        gpu_manager: GPUManager,
+        finalization_executor: FinalizationExecutor = None,
+        state_store: SessionStateStore = None,
+    ):
         """Create a new SessionData instance.
 
         Arguments:
           - socketIO: SocketIO server
           - room: SocketIO room where messages get sent
           - gpu_manager: GPUManager instance where GPU tasks get added
+          - finalization_executor: FinalizationExecutor used to run CPU-heavy
+                                   steps of processing GPU results (optional)
+          - state_store: SessionStateStore where the session's state is kept,
+                         under the ID of the room the session started in
+                         (default: an InMemorySessionStateStore)
         """
-        self.chamberTypes = {}
+        self.sid = room
+        self.state_store = (
+            InMemorySessionStateStore() if state_store is None else state_store
+        )
+        for field in STATE_FIELDS:
+            setattr(self, field, SessionStateMap(self.state_store, self.sid, field))
+        self.info = SessionStateMap(self.state_store, self.sid, "info")
         self.cfs = {}
-        self.predictions = {}
-        self.basenames = {}
-        self.img_shapes = {}
-        self.n_files = 0
-        self.inverted = {}
-        self.paths_to_indices = {}
-        self.models_used_by_image = {}
-        self.annotations = {}
-        self.egg_positions_full_scale = {}
-        self.bboxes = {}
-        self.alignment_data = {}
         self.socketIO = socketIO
-        self.room = room
         self.gpu_manager = gpu_manager
+        self.finalization_executor = finalization_executor
         self.counting_task_group = None
         self.lastPing = time.time()
         self.textLabelHeight = 96
 
     def clear_data(self):
-        self.chamberTypes = {}
         self.cfs = {}
-        self.predictions = {}
-        self.annotations = {}
-        self.egg_positions_full_scale = {}
-        self.bboxes = {}
-        self.alignment_data = {}
-        self.basenames = {}
-        self.n_files = 0
-        self.img_shapes = {}
-        self.inverted = {}
-        self.paths_to_indices = {}
-        self.models_used_by_image = {}
+        for field in STATE_FIELDS:
+            getattr(self, field).clear()
+        self.info.pop("n_files", None)
+
+    @property
+    def room(self):
+        """SocketIO room where messages get sent, which changes when the client
+        reconnects."""
+        return self.info.get("room", self.sid)
+
+    @room.setter
+    def room(self, room):
+        self.info["room"] = room
+
+    @property
+    def n_files(self):
+        return self.info.get("n_files", 0)
+
+    @n_files.setter
+    def n_files(self, n_files):
+        self.info["n_files"] = n_files
 
     def emit_to_room(self, evt_name, data):
         self.socketIO.emit(evt_name, data, room=self.room)
@@ -94,6 +151,11 @@ class SessionManager:
             or "cuDNN error" in exc_str
         )
 
+    def run_cpu_task(self, fn, *args):
+        if self.finalization_executor is None:
+            return fn(*args)
+        return self.finalization_executor.run_cpu_task(fn, *args)
+
     def report_counting_error(self, imgPath, err_type):
         prefix = {
             ImageAnalysisException: "Error",
@@ -102,8 +164,8 @@ class SessionManager:
         self.emit_to_room(
             "counting-error",
             {
-                "width": self.img_shapes[imgPath][1],
-                "height": self.img_shapes[imgPath][0],
+                "width": self.img_shape(imgPath)[1],
+                "height": self.img_shape(imgPath)[0],
                 "data": "%s counting eggs for image %s"
                 % (prefix, self.basenames[imgPath]),
                 "filename": self.basenames[imgPath],
@@ -116,27 +178,51 @@ class SessionManager:
     def enqueue_arena_detection_task(self, img_path):
         self.cfs[img_path] = CircleFinder(
             os.path.basename(img_path),
-            self.img_shapes[img_path],
+            self.img_shape(img_path),
             self.room,
             allowSkew=True,
         )
         taskgroup = self.gpu_manager.add_task_group(
             self.room, n_tasks=1, task_type=GPUTaskTypes.arena
         )
-        self.gpu_manager.add_task(taskgroup, img_path)
         taskgroup.add_completion_listener(
             Listener(self.segment_image_via_object_detection, (img_path,))
         )
+        self.gpu_manager.add_task(
+            taskgroup, img_path, n_bytes=self.decoded_image_bytes(img_path)
+        )
 
     def enqueue_egg_counting_task(self, img_path, alignment_data):
-        self.gpu_manager.add_task(self.counting_task_group, img_path, alignment_data)
+        self.gpu_manager.add_task(
+            self.counting_task_group,
+            img_path,
+            alignment_data,
+            n_bytes=self.decoded_image_bytes(img_path),
+        )
+
+    def decoded_image_bytes(self, img_path, dtype=np.float32):
+        """Return the number of bytes of an image decoded as `dtype` (float32 by
+        default, as both open_image and the GPU workers' normalization use)."""
+        return int(np.prod(self.img_shape(img_path))) * np.dtype(dtype).itemsize
+
+    def img_shape(self, img_path):
+        """Return the shape of an image as decoded by open_image, reading only
+        its header if it isn't known yet."""
+        if img_path not in self.img_shapes:
+            self.img_shapes[img_path] = image_metadata.get(img_path).shape
+        return self.img_shapes[img_path]
 
     def segment_image_via_object_detection(self, img_path, predictions):
         imgBasename = os.path.basename(img_path)
         try:
-            (circles, avgDists, numRowsCols, rotationAngle, _) = self.cfs[
-                img_path
-            ].findCircles(debug=False, predictions=predictions)
+            (
+                self.cfs[img_path],
+                circles,
+                avgDists,
+                numRowsCols,
+                rotationAngle,
+                _,
+            ) = self.run_cpu_task(find_circles, self.cfs[img_path], predictions)
             if self.cfs[img_path].skewed:
                 three_or_more_rows_cols = any(
                     [el > 2 for el in self.cfs[img_path].numRowsCols]
@@ -163,10 +249,10 @@ class SessionManager:
             self.bboxes[img_path] = [
                 [round(el) for el in bbox] for bbox in self.bboxes[img_path]
             ]
-            if img_path not in self.alignment_data:
-                self.alignment_data[img_path] = {"rotationAngle": rotationAngle}
-            else:
-                self.alignment_data[img_path]["rotationAngle"] = rotationAngle
+            self.alignment_data[img_path] = {
+                **self.alignment_data.get(img_path, {}),
+                "rotationAngle": rotationAngle,
+            }
             self.emit_to_room(
                 "chamber-analysis",
                 {
@@ -174,8 +260,8 @@ class SessionManager:
                     "filename": imgBasename,
                     "chamberType": self.cfs[img_path].ct,
                     "bboxes": self.bboxes[img_path],
-                    "width": self.img_shapes[img_path][1],
-                    "height": self.img_shapes[img_path][0],
+                    "width": self.img_shape(img_path)[1],
+                    "height": self.img_shape(img_path)[0],
                 },
             )
             self.inverted[img_path] = self.cfs[img_path].inverted
@@ -202,25 +288,39 @@ class SessionManager:
 
     @staticmethod
     def open_image(img_path, dtype=np.float32):
+        """Return an uploaded image decoded with its EXIF orientation applied, as
+        a read-only array shared through the decoded-image cache (copy it
+        before drawing on it)."""
         if backend_type == BackendTypes.sql:
             path_split = img_path.split(os.path.sep)
-            img = BytesIO(
-                EggLayingImage.query.filter_by(
-                    session_id=path_split[-2], basename=path_split[-1]
-                )
-                .first()
-                .image
+            sha256 = EggLayingImage.find_column(
+                path_split[-2], path_split[-1], EggLayingImage.content_sha256
             )
+
+            def decode():
+                with blob_store.open(ImageContent.blob_key_for(sha256)) as f:
+                    return np.array(open_oriented(f), dtype=dtype)
+
+            return decoded_images.get(sha256, dtype, decode)
         elif backend_type == BackendTypes.filesystem:
-            img = img_path
-        return np.array(Image.open(img), dtype=dtype)
+            # uploads are hard links to the image store's objects, so the inode
+            # identifies the content
+            stat = os.stat(img_path)
+            return decoded_images.get(
+                (stat.st_dev, stat.st_ino, stat.st_mtime_ns),
+                dtype,
+                lambda: np.array(open_oriented(img_path), dtype=dtype),
+            )
 
-    def check_chamber_type_and_find_bounding_boxes(self, img_path, i, n_files):
+    def check_chamber_type_and_find_bounding_boxes(
+        self, img_path, i, n_files, img_shape=None
+    ):
         img_path = os.path.normpath(img_path)
         imgBasename = os.path.basename(img_path)
         self.basenames[img_path] = imgBasename
-        img = self.open_image(img_path)
-        self.img_shapes[img_path] = img.shape
+        if img_shape is None:
+            img_shape = image_metadata.get(img_path).shape
+        self.img_shapes[img_path] = img_shape
         self.paths_to_indices[img_path] = i
         self.n_files = n_files
         self.enqueue_arena_detection_task(img_path)
@@ -230,22 +330,24 @@ class SessionManager:
     ):
         if is_lowest_idx:
             self.counting_task_group = self.gpu_manager.add_task_group(
-                self.room, n_tasks=n_files, task_type=GPUTaskTypes.egg
+                self.room,
+                n_tasks=n_files,
+                task_type=GPUTaskTypes.egg,
+                streaming=True,
+            )
+            self.counted_filenames = []
+            self.counting_task_group.add_result_listener(
+                Listener(self.send_annotations_for_result)
             )
             self.counting_task_group.add_completion_listener(
-                Listener(
-                    self.send_annotations_for_task_group,
-                )
+                Listener(self.send_counting_done)
             )
         imgBasename = os.path.basename(img_path)
         img_path = os.path.normpath(img_path)
-        if not hasattr(self, "img_paths"):
-            self.img_paths = {index: img_path}
-        else:
-            self.img_paths[index] = img_path
+        self.img_paths[index] = img_path
         self.basenames[img_path] = imgBasename
+        alignment_data["index"] = index
         self.alignment_data[img_path] = alignment_data
-        self.alignment_data[img_path]["index"] = index
         if not img_path in self.chamberTypes or (
             "type" in alignment_data
             and img_path in self.chamberTypes
@@ -259,7 +361,10 @@ class SessionManager:
     def send_annotations_for_task(self, prediction_set, metadata):
         imgPath = self.img_paths[metadata["index"]]
         imgBasename = os.path.basename(imgPath)
-        self.alignment_data[imgPath]["rotationAngle"] = metadata.get("rotationAngle", 0)
+        self.alignment_data[imgPath] = {
+            **self.alignment_data[imgPath],
+            "rotationAngle": metadata.get("rotationAngle", 0),
+        }
         if "bboxes" in metadata:
             self.bboxes[imgPath] = metadata["bboxes"]
         self.predictions[imgPath] = prediction_set
@@ -336,25 +441,24 @@ class SessionManager:
             )
             self.annotations[os.path.normpath(imgPath)] = resultsData
 
-    def send_annotations_for_task_group(self, predictions, metadata):
-        if type(predictions) is dict:
-            predictions = [[predictions]]
-        for i, prediction_set in enumerate(predictions):
-            self.send_annotations_for_task(
-                prediction_set,
-                metadata[i],
-            )
+    def send_annotations_for_result(self, predictions, metadata):
+        """Send the annotations of one image as soon as its results arrive."""
+        self.send_annotations_for_task(predictions, metadata)
+        self.counted_filenames.append(metadata["filename"])
+
+    def send_counting_done(self):
         self.emit_to_room(
             "counting-done",
-            {"is_retry": True, "filenames": [ent["filename"] for ent in metadata]},
+            {"is_retry": True, "filenames": self.counted_filenames},
         )
 
     def rotate_pt(self, x, y, radians, img_path):
-        img_center = list(reversed([el / 2 for el in self.img_shapes[img_path][:2]]))
+        img_center = list(reversed([el / 2 for el in self.img_shape(img_path)[:2]]))
         return rotate_around_point_highperf((x, y), radians, img_center)
 
     def createErrorReport(self, edited_counts, user):
         font = drawing.loadFont(14)
+        writer = BatchWriter(sqlalchemy.insert(ErrorReport))
         for imgPath in edited_counts:
             rel_path = os.path.normpath(os.path.join("./uploads", self.room, imgPath))
             img = SessionManager.open_image(rel_path, dtype=np.uint8)
@@ -408,22 +512,27 @@ class SessionManager:
                         outline_img_section,
                     )
                 if backend_type == BackendTypes.sql:
-                    img_section, outline_img_section = [
-                        cv2.imencode(".png", im)[1]
-                        for im in (img_section, outline_img_section)
+                    image_key, outline_image_key = [
+                        f"error-reports/{uuid.uuid4().hex}.png" for _ in range(2)
                     ]
-                    ErrorReport(
-                        image=img_section,
-                        outline_image=outline_img_section,
+                    for key, im in (
+                        (image_key, img_section),
+                        (outline_image_key, outline_img_section),
+                    ):
+                        blob_store.put(key, data=cv2.imencode(".png", im)[1].tobytes())
+                    writer.add(
+                        image_key=image_key,
+                        outline_image_key=outline_image_key,
                         img_path=imgPath,
                         region_index=i,
                         original_ct=original_ct,
                         edited_ct=edited_counts[imgPath][i],
-                        user=user,
+                        user_id=user.id,
                         egg_counting_model_id=self.models_used_by_image[rel_path],
                     )
-                    db.session.commit()
-
+        if backend_type == BackendTypes.sql:
+            writer.flush()
+            db.session.commit()
         self.emit_to_room("report-ready", {})
 
     @staticmethod
@@ -0,0 +1,312 @@
+from abc import ABC, abstractmethod
+from collections.abc import MutableMapping
+from io import BytesIO
+import json
+from threading import Lock
+import time
+
+import numpy as np
+
+from project.lib.web import exceptions
+
+# fields whose values are lists of per-region dicts, serialized with
+# encode_regions
+REGION_FIELDS = ("predictions", "annotations")
+
+
+def to_json(value):
+    """Serialize a value as JSON, converting numpy arrays and scalars."""
+    return json.dumps(
+        value,
+        separators=(",", ":"),
+        default=lambda obj: obj.tolist() if hasattr(obj, "tolist") else str(obj),
+    )
+
+
+def numeric_array(value):
+    """Return a value as a numpy array if it's a number or a rectangular nested
+    list of numbers, or None otherwise."""
+    if isinstance(value, bool):
+        return None
+    try:
+        arr = np.asarray(value)
+    except Exception:  # e.g., ragged nested lists
+        return None
+    return arr if arr.dtype.kind in "iuf" else None
+
+
+def compact_dtype(arrays):
+    """Return the smallest dtype holding the values of the arrays losslessly.
+
+    Empty arrays are left out, since np.asarray([]) is float64 and would turn
+    the integers of the other arrays into floats.
+    """
+    arrays = [arr for arr in arrays if arr.size > 0]
+    if not arrays:
+        return np.int32
+    flat = np.concatenate([arr.ravel() for arr in arrays])
+    if flat.dtype.kind in "iu":
+        info = np.iinfo(np.int32)
+        if flat.min() >= info.min and flat.max() <= info.max:
+            return np.int32
+        return np.int64
+    flat = flat.astype(np.float64)
+    if np.array_equal(flat.astype(np.float32), flat):
+        return np.float32
+    return np.float64
+
+
+def encode_regions(regions) -> bytes:
+    """Serialize a list of per-region dicts (e.g., the predictions for an
+    image) compactly as numpy arrays.
+
+    The numeric values of each key (numbers, rectangular nested lists or lists
+    of those, like outlines) are concatenated across regions into a single
+    array, along with their shapes; any other values are kept as JSON. A list
+    holding an exception class (used to record analysis errors) is stored as
+    the class's name. Tuples come back as lists.
+    """
+    if len(regions) == 1 and isinstance(regions[0], type):
+        header = {"error": regions[0].__name__}
+        arrays = {}
+    else:
+        header = {"n": len(regions), "keys": {}, "other": [{} for _ in regions]}
+        arrays = {}
+        keys = list(dict.fromkeys(k for region in regions for k in region))
+        for key in keys:
+            values = [region.get(key) for region in regions]
+            parts = [numeric_array(value) for value in values]
+            if all(part is not None for part in parts):
+                counts = None
+            else:
+                parts = [
+                    [numeric_array(el) for el in value]
+                    if isinstance(value, list)
+                    else [None]
+                    for value in values
+                ]
+                if any(el is None for part in parts for el in part):
+                    for i, value in enumerate(values):
+                        if key in regions[i]:
+                            header["other"][i][key] = value
+                    continue
+                counts = [len(part) for part in parts]
+                parts = [el for part in parts for el in part]
+            name = f"a{len(arrays)}"
+            arrays[name] = np.concatenate(
+                [part.ravel() for part in parts] or [np.zeros(0)]
+            ).astype(compact_dtype(parts))
+            header["keys"][key] = {
+                "array": name,
+                "shapes": [part.shape for part in parts],
+                "counts": counts,
+            }
+    f = BytesIO()
+    header = np.frombuffer(to_json(header).encode(), dtype=np.uint8)
+    np.savez(f, header=header, **arrays)
+    return f.getvalue()
+
+
+def decode_regions(data) -> list:
+    """Deserialize a list of per-region dicts serialized by encode_regions."""
+    with np.load(BytesIO(data), allow_pickle=False) as arrays:
+        header = json.loads(arrays["header"].tobytes())
+        if "error" in header:
+            return [getattr(exceptions, header["error"])]
+        regions = [{} for _ in range(header["n"])]
+        for key, spec in header["keys"].items():
+            flat = arrays[spec["array"]]
+            parts, offset = [], 0
+            for shape in spec["shapes"]:
+                size = int(np.prod(shape))
+                parts.append(flat[offset : offset + size].reshape(shape).tolist())
+                offset += size
+            if spec["counts"] is None:
+                values = parts
+            else:
+                values, offset = [], 0
+                for count in spec["counts"]:
+                    values.append(parts[offset : offset + count])
+                    offset += count
+            for region, value in zip(regions, values):
+                region[key] = value
+        for region, other in zip(regions, header["other"]):
+            region.update(other)
+        return regions
+
+
+def encode_value(field, value) -> bytes:
+    if field in REGION_FIELDS:
+        return encode_regions(value)
+    return to_json(value).encode()
+
+
+def decode_value(field, data):
+    if field in REGION_FIELDS:
+        return decode_regions(data)
+    return json.loads(data)
+
+
+class SessionStateStore(ABC):
+    """Store the state of users' sessions (e.g., predictions and annotations
+    per image), as entries of named fields that map keys to values.
+
+    Values are only written when (re)assigned: mutating a value read from the
+    store in place doesn't update it. Values are stored as JSON (or numpy
+    arrays), so tuples come back as lists.
+    """
+
+    shared = False
+
+    @abstractmethod
+    def get(self, sid, field, key):
+        """Return the value of an entry; raise KeyError if there's none."""
+
+    @abstractmethod
+    def put(self, sid, field, key, value):
+        """Set the value of an entry."""
+
+    @abstractmethod
+    def delete(self, sid, field, key):
+        """Delete an entry; raise KeyError if there's none."""
+
+    @abstractmethod
+    def keys(self, sid, field) -> list:
+        """Return the keys of a field's entries, in the order they were added."""
+
+    @abstractmethod
+    def contains(self, sid, field, key):
+        """Return whether a field has an entry for a key."""
+
+    @abstractmethod
+    def clear(self, sid, field=None):
+        """Delete the entries of a field, or of all fields if it's None."""
+
+    @abstractmethod
+    def has_session(self, sid):
+        """Return whether any state is stored for a session."""
+
+    @abstractmethod
+    def expire(self, max_age):
+        """Delete the state of sessions not written to for `max_age` seconds."""
+
+
+class InMemorySessionStateStore(SessionStateStore):
+    """Keep session state in the memory of the server process."""
+
+    def __init__(self):
+        self.sessions = {}
+        self.updated_at = {}
+        self.lock = Lock()
+
+    def entries(self, sid, field):
+        return self.sessions.get(sid, {}).get(field, {})
+
+    def get(self, sid, field, key):
+        with self.lock:
+            return self.entries(sid, field)[key]
+
+    def put(self, sid, field, key, value):
+        with self.lock:
+            self.sessions.setdefault(sid, {}).setdefault(field, {})[key] = value
+            self.updated_at[sid] = time.time()
+
+    def delete(self, sid, field, key):
+        with self.lock:
+            del self.entries(sid, field)[key]
+            self.updated_at[sid] = time.time()
+
+    def keys(self, sid, field):
+        with self.lock:
+            return list(self.entries(sid, field))
+
+    def contains(self, sid, field, key):
+        with self.lock:
+            return key in self.entries(sid, field)
+
+    def clear(self, sid, field=None):
+        with self.lock:
+            if field is None:
+                self.sessions.pop(sid, None)
+                self.updated_at.pop(sid, None)
+            elif sid in self.sessions:
+                self.sessions[sid].pop(field, None)
+
+    def has_session(self, sid):
+        with self.lock:
+            return sid in self.sessions
+
+    def expire(self, max_age):
+        limit = time.time() - max_age
+        with self.lock:
+            for sid in [sid for sid, t in self.updated_at.items() if t < limit]:
+                del self.sessions[sid]
+                del self.updated_at[sid]
+
+
+class SessionStateMap(MutableMapping):
+    """Dict-like view of one field of a session's state, which loads entries
+    from the store only as they're accessed."""
+
+    def __init__(self, store: SessionStateStore, sid, field):
+        self.store = store
+        self.sid = sid
+        self.field = field
+
+    def __getitem__(self, key):
+        return self.store.get(self.sid, self.field, key)
+
+    def __setitem__(self, key, value):
+        self.store.put(self.sid, self.field, key, value)
+
+    def __delitem__(self, key):
+        self.store.delete(self.sid, self.field, key)
+
+    def __contains__(self, key):
+        return self.store.contains(self.sid, self.field, key)
+
+    def __iter__(self):
+        return iter(self.store.keys(self.sid, self.field))
+
+    def __len__(self):
+        return len(self.store.keys(self.sid, self.field))
+
+    def clear(self):
+        self.store.clear(self.sid, self.field)
+
+
+class SessionRegistry(dict):
+    """Map session IDs to the SessionManager instances of this process,
+    creating one on first access for sessions whose state another process
+    stored in a shared SessionStateStore.
+
+    Only the per-image state in the store is shared. A running analysis (its
+    GPU task groups, the CircleFinders awaiting arena results and the list of
+    counted files) stays in the process that started it, so another process
+    can serve reads, downloads and annotations of a session but can't finalize
+    its in-flight counts.
+    """
+
+    def __init__(self, store: SessionStateStore, factory):
+        """Create a new SessionRegistry instance.
+
+        Arguments:
+          - store: store of the sessions' state
+          - factory: function taking a session ID and returning a new
+                     SessionManager for it
+        """
+        super().__init__()
+        self.store = store
+        self.factory = factory
+
+    def __contains__(self, sid):
+        return super().__contains__(sid) or (
+            self.store.shared and self.store.has_session(sid)
+        )
+
+    def __missing__(self, sid):
+        if not (self.store.shared and self.store.has_session(sid)):
+            raise KeyError(sid)
+        session = self.factory(sid)
+        self[sid] = session
+        return session
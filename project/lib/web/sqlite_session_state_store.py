@@ -0,0 +1,189 @@
+from collections import OrderedDict
+import json
+import sqlite3
+import threading
+import time
+
+from project.lib.web.session_state_store import (
+    SessionStateStore,
+    decode_value,
+    encode_value,
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS session_state (
+    sid TEXT NOT NULL,
+    field TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value BLOB NOT NULL,
+    PRIMARY KEY (sid, field, key)
+);
+CREATE TABLE IF NOT EXISTS session_versions (
+    sid TEXT PRIMARY KEY,
+    version INTEGER NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_session_versions_updated_at
+    ON session_versions (updated_at);
+"""
+
+
+class SQLiteSessionStateStore(SessionStateStore):
+    """Keep session state in a SQLite database file that several server
+    processes on the same host can share, so that any of them can serve a
+    session.
+
+    Values are serialized compactly (lists of predictions as numpy arrays,
+    anything else as JSON) and loaded one entry at a time. Decoded entries are
+    cached, tagged with a version of their session that every write bumps, so
+    that a cached entry is only reused while no process has changed the
+    session since.
+    """
+
+    shared = True
+
+    def __init__(self, path, max_cached_entries=1024):
+        """Create a new SQLiteSessionStateStore instance.
+
+        Arguments:
+          - path: path of the database file
+          - max_cached_entries: max number of decoded entries kept in memory
+        """
+        self.path = path
+        self.max_cached_entries = max_cached_entries
+        self.cache = OrderedDict()
+        self.cache_lock = threading.Lock()
+        self.local = threading.local()
+        with self.connection() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+
+    def connection(self) -> sqlite3.Connection:
+        if not hasattr(self.local, "conn"):
+            self.local.conn = sqlite3.connect(self.path, timeout=30)
+        return self.local.conn
+
+    def version(self, sid):
+        row = (
+            self.connection()
+            .execute("SELECT version FROM session_versions WHERE sid = ?", (sid,))
+            .fetchone()
+        )
+        return None if row is None else row[0]
+
+    @staticmethod
+    def bump_version(conn, sid):
+        conn.execute(
+            "INSERT INTO session_versions (sid, version, updated_at) VALUES (?, 1, ?)"
+            " ON CONFLICT (sid) DO UPDATE SET version = version + 1,"
+            " updated_at = excluded.updated_at",
+            (sid, time.time()),
+        )
+
+    def uncache(self, sid):
+        with self.cache_lock:
+            for cache_key in [k for k in self.cache if k[0] == sid]:
+                del self.cache[cache_key]
+
+    def get(self, sid, field, key):
+        cache_key = (sid, field, json.dumps(key))
+        version = self.version(sid)
+        with self.cache_lock:
+            cached = self.cache.get(cache_key)
+            if cached is not None and cached[0] == version:
+                self.cache.move_to_end(cache_key)
+                return cached[1]
+        row = (
+            self.connection()
+            .execute(
+                "SELECT value FROM session_state"
+                " WHERE sid = ? AND field = ? AND key = ?",
+                cache_key,
+            )
+            .fetchone()
+        )
+        if row is None:
+            raise KeyError(key)
+        value = decode_value(field, row[0])
+        with self.cache_lock:
+            self.cache[cache_key] = (version, value)
+            self.cache.move_to_end(cache_key)
+            while len(self.cache) > self.max_cached_entries:
+                self.cache.popitem(last=False)
+        return value
+
+    def put(self, sid, field, key, value):
+        data = encode_value(field, value)
+        with self.connection() as conn:
+            # updating in place keeps the entry's rowid, and so its order
+            conn.execute(
+                "INSERT INTO session_state (sid, field, key, value)"
+                " VALUES (?, ?, ?, ?)"
+                " ON CONFLICT (sid, field, key) DO UPDATE SET value = excluded.value",
+                (sid, field, json.dumps(key), data),
+            )
+            self.bump_version(conn, sid)
+
+    def delete(self, sid, field, key):
+        with self.connection() as conn:
+            n_deleted = conn.execute(
+                "DELETE FROM session_state WHERE sid = ? AND field = ? AND key = ?",
+                (sid, field, json.dumps(key)),
+            ).rowcount
+            if n_deleted == 0:
+                raise KeyError(key)
+            self.bump_version(conn, sid)
+
+    def keys(self, sid, field):
+        rows = (
+            self.connection()
+            .execute(
+                "SELECT key FROM session_state WHERE sid = ? AND field = ?"
+                " ORDER BY rowid",
+                (sid, field),
+            )
+            .fetchall()
+        )
+        return [json.loads(row[0]) for row in rows]
+
+    def contains(self, sid, field, key):
+        row = (
+            self.connection()
+            .execute(
+                "SELECT 1 FROM session_state WHERE sid = ? AND field = ? AND key = ?",
+                (sid, field, json.dumps(key)),
+            )
+            .fetchone()
+        )
+        return row is not None
+
+    def clear(self, sid, field=None):
+        with self.connection() as conn:
+            if field is None:
+                conn.execute("DELETE FROM session_state WHERE sid = ?", (sid,))
+                conn.execute("DELETE FROM session_versions WHERE sid = ?", (sid,))
+            else:
+                conn.execute(
+                    "DELETE FROM session_state WHERE sid = ? AND field = ?",
+                    (sid, field),
+                )
+                self.bump_version(conn, sid)
+        self.uncache(sid)
+
+    def has_session(self, sid):
+        return self.version(sid) is not None
+
+    def expire(self, max_age):
+        limit = time.time() - max_age
+        with self.connection() as conn:
+            sids = [
+                row[0]
+                for row in conn.execute(
+                    "SELECT sid FROM session_versions WHERE updated_at < ?", (limit,)
+                )
+            ]
+            for sid in sids:
+                conn.execute("DELETE FROM session_state WHERE sid = ?", (sid,))
+                conn.execute("DELETE FROM session_versions WHERE sid = ?", (sid,))
+        for sid in sids:
+            self.uncache(sid)
@@ -0,0 +1,279 @@
+import json
+import sqlite3
+import threading
+import time
+from typing import List
+
+from project.lib.web.fair_task_queue import TASK_TYPE_PRIORITIES
+from project.lib.web.gpu_task import GPUTask
+from project.lib.web.gpu_task_group import GPUTaskGroup
+from project.lib.web.gpu_task_types import GPUTaskTypes
+from project.lib.web.task_queue_backend import TaskQueueBackend
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS gpu_tasks (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    id TEXT NOT NULL UNIQUE,
+    group_id TEXT NOT NULL,
+    room TEXT NOT NULL,
+    task_type TEXT NOT NULL,
+    priority INTEGER NOT NULL,
+    img_path TEXT NOT NULL,
+    data TEXT NOT NULL,
+    cache_key TEXT,
+    owner TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    state TEXT NOT NULL,
+    enqueued_at REAL NOT NULL,
+    leased_until REAL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_gpu_tasks_state_seq ON gpu_tasks (state, seq);
+CREATE INDEX IF NOT EXISTS ix_gpu_tasks_group_id ON gpu_tasks (group_id);
+CREATE TABLE IF NOT EXISTS gpu_task_rooms (
+    room TEXT PRIMARY KEY,
+    last_served INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS gpu_task_results (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    owner TEXT NOT NULL,
+    group_id TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_gpu_task_results_owner ON gpu_task_results (owner);
+"""
+TASK_COLUMNS = "id, group_id, room, task_type, img_path, data, cache_key, owner, attempts"
+
+
+class SQLiteTaskQueueBackend(TaskQueueBackend):
+    """Keep the task queue in a SQLite database file that several server
+    processes on the same host can share.
+
+    Tasks are delivered in the same order as by FairShareTaskQueue. Leasing is
+    atomic across processes because each lease is taken inside a write
+    transaction. Results posted to an instance that doesn't hold the task's
+    group are stored for the owning instance to fetch.
+    """
+
+    shared = True
+
+    def __init__(self, path, aging_interval=30, poll_interval=0.2):
+        """Create a new SQLiteTaskQueueBackend instance.
+
+        Arguments:
+          - path: path of the database file
+          - aging_interval: number of seconds a task needs to wait for its
+                            priority to be raised by one level
+          - poll_interval: number of seconds between checks of the database
+                           while waiting for a task
+        """
+        self.path = path
+        self.aging_interval = aging_interval
+        self.poll_interval = poll_interval
+        self.local = threading.local()
+        self.task_added = threading.Condition()
+        with self.connection() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+
+    def connection(self) -> sqlite3.Connection:
+        if not hasattr(self.local, "conn"):
+            self.local.conn = sqlite3.connect(self.path, timeout=30)
+        return self.local.conn
+
+    def transaction(self):
+        """Return a connection with an open write transaction, which keeps other
+        processes from leasing the same task concurrently."""
+        conn = self.connection()
+        conn.execute("BEGIN IMMEDIATE")
+        return conn
+
+    @staticmethod
+    def task_from_row(row) -> GPUTask:
+        id, group_id, room, task_type, img_path, data, cache_key, owner, attempts = row
+        task_type = GPUTaskTypes[task_type]
+        task_group = GPUTaskGroup(None, room, task_type, id=group_id)
+        task = GPUTask(task_group, img_path, json.loads(data), id=id)
+        task.cache_key = cache_key
+        task.owner = owner
+        task.attempts = attempts
+        return task
+
+    def put(self, task: GPUTask, owner):
+        task.owner = owner
+        now = time.time()
+        with self.connection() as conn:
+            conn.execute(
+                "INSERT INTO gpu_tasks (id, group_id, room, task_type, priority,"
+                " img_path, data, cache_key, owner, state, enqueued_at, updated_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 'queued', ?, ?)",
+                (
+                    task.id,
+                    task.task_group.id,
+                    task.task_group.room,
+                    task.task_type.name,
+                    TASK_TYPE_PRIORITIES.get(
+                        task.task_type, len(TASK_TYPE_PRIORITIES)
+                    ),
+                    task.img_path,
+                    json.dumps(task.data),
+                    task.cache_key,
+                    owner,
+                    now,
+                    now,
+                ),
+            )
+        with self.task_added:
+            self.task_added.notify_all()
+
+    def try_lease(self, lease_duration) -> GPUTask:
+        now = time.time()
+        with self.transaction() as conn:
+            row = conn.execute(
+                f"SELECT seq, {TASK_COLUMNS} FROM gpu_tasks"
+                " LEFT JOIN gpu_task_rooms USING (room) WHERE state = 'queued'"
+                " ORDER BY MAX(priority - (? - enqueued_at >= ?), ?),"
+                " COALESCE(last_served, -1), seq LIMIT 1",
+                (now, self.aging_interval, min(TASK_TYPE_PRIORITIES.values())),
+            ).fetchone()
+            if row is None:
+                return None
+            task = self.task_from_row(row[1:])
+            task.attempts += 1
+            conn.execute(
+                "UPDATE gpu_tasks SET state = 'leased', attempts = ?,"
+                " leased_until = ?, updated_at = ? WHERE seq = ?",
+                (task.attempts, now + lease_duration, now, row[0]),
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO gpu_task_rooms (room, last_served) VALUES"
+                " (?, (SELECT COALESCE(MAX(last_served), 0) + 1 FROM gpu_task_rooms))",
+                (task.task_group.room,),
+            )
+            return task
+
+    def lease(self, timeout, lease_duration) -> GPUTask:
+        deadline = time.time() + timeout
+        while True:
+            task = self.try_lease(lease_duration)
+            remaining = deadline - time.time()
+            if task is not None or remaining <= 0:
+                return task
+            with self.task_added:
+                self.task_added.wait(min(self.poll_interval, remaining))
+
+    def renew(self, task_id, lease_duration):
+        now = time.time()
+        with self.connection() as conn:
+            n_updated = conn.execute(
+                "UPDATE gpu_tasks SET leased_until = ?, updated_at = ?"
+                " WHERE id = ? AND state = 'leased'",
+                (now + lease_duration, now, task_id),
+            ).rowcount
+        return n_updated > 0
+
+    def complete(self, task_id) -> GPUTask:
+        with self.transaction() as conn:
+            row = conn.execute(
+                f"SELECT {TASK_COLUMNS} FROM gpu_tasks"
+                " WHERE id = ? AND state != 'done'",
+                (task_id,),
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                "UPDATE gpu_tasks SET state = 'done', leased_until = NULL,"
+                " updated_at = ? WHERE id = ?",
+                (time.time(), task_id),
+            )
+            return self.task_from_row(row)
+
+    def expire_leases(self, owner) -> List[GPUTask]:
+        now = time.time()
+        with self.transaction() as conn:
+            rows = conn.execute(
+                f"SELECT {TASK_COLUMNS} FROM gpu_tasks WHERE state = 'leased'"
+                " AND leased_until < ? AND owner = ?",
+                (now, owner),
+            ).fetchall()
+            conn.executemany(
+                "UPDATE gpu_tasks SET state = 'expired', leased_until = NULL,"
+                " updated_at = ? WHERE id = ?",
+                [(now, row[0]) for row in rows],
+            )
+        return [self.task_from_row(row) for row in rows]
+
+    def requeue(self, task: GPUTask):
+        with self.connection() as conn:
+            conn.execute(
+                "UPDATE gpu_tasks SET state = 'queued', updated_at = ?"
+                " WHERE id = ? AND state = 'expired'",
+                (time.time(), task.id),
+            )
+        with self.task_added:
+            self.task_added.notify_all()
+
+    def discard_group(self, group_id):
+        with self.connection() as conn:
+            conn.execute(
+                "DELETE FROM gpu_tasks WHERE group_id = ?"
+                " AND state IN ('queued', 'expired')",
+                (group_id,),
+            )
+
+    def collect_garbage(self, limit):
+        with self.connection() as conn:
+            conn.execute(
+                "DELETE FROM gpu_tasks WHERE updated_at < ?"
+                " AND state IN ('done', 'expired')",
+                (limit,),
+            )
+            conn.execute("DELETE FROM gpu_task_results WHERE created_at < ?", (limit,))
+            conn.execute(
+                "DELETE FROM gpu_task_rooms WHERE room NOT IN"
+                " (SELECT room FROM gpu_tasks WHERE state = 'queued')"
+            )
+
+    def qsize(self):
+        return self.connection().execute(
+            "SELECT COUNT(*) FROM gpu_tasks WHERE state = 'queued'"
+        ).fetchone()[0]
+
+    def qsize_for_room(self, room):
+        return self.connection().execute(
+            "SELECT COUNT(*) FROM gpu_tasks WHERE state = 'queued' AND room = ?",
+            (room,),
+        ).fetchone()[0]
+
+    def queued_tasks(self) -> List[GPUTask]:
+        rows = self.connection().execute(
+            f"SELECT {TASK_COLUMNS} FROM gpu_tasks WHERE state = 'queued'"
+        ).fetchall()
+        return [self.task_from_row(row) for row in rows]
+
+    def leased_tasks(self) -> List[GPUTask]:
+        rows = self.connection().execute(
+            f"SELECT {TASK_COLUMNS} FROM gpu_tasks WHERE state = 'leased'"
+        ).fetchall()
+        return [self.task_from_row(row) for row in rows]
+
+    def post_results(self, task_id, results):
+        with self.connection() as conn:
+            conn.execute(
+                "INSERT INTO gpu_task_results (owner, group_id, payload, created_at)"
+                " SELECT owner, group_id, ?, ? FROM gpu_tasks WHERE id = ?",
+                (json.dumps({**results, "task_id": task_id}), time.time(), task_id),
+            )
+
+    def fetch_results(self, owner):
+        with self.transaction() as conn:
+            rows = conn.execute(
+                "SELECT id, group_id, payload FROM gpu_task_results"
+                " WHERE owner = ? ORDER BY id",
+                (owner,),
+            ).fetchall()
+            conn.executemany(
+                "DELETE FROM gpu_task_results WHERE id = ?", [(row[0],) for row in rows]
+            )
+        return [(group_id, json.loads(payload)) for _, group_id, payload in rows]
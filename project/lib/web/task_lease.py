@@ -0,0 +1,27 @@
+import time
+
+from project.lib.web.gpu_task import GPUTask
+
+
+class TaskLease:
+    """Track a GPU task handed to a worker, which must keep renewing the lease
+    via heartbeats until it submits the task's results."""
+
+    def __init__(self, task: GPUTask, duration):
+        """Create a new TaskLease instance.
+
+        Arguments:
+          - task: the leased task
+          - duration: number of seconds the lease lasts without being renewed
+        """
+        self.task = task
+        self.duration = duration
+        self.renew()
+
+    def renew(self):
+        self.expires_at = time.time() + self.duration
+        self.task.task_group.touch()
+
+    @property
+    def expired(self):
+        return time.time() > self.expires_at
@@ -0,0 +1,192 @@
+from abc import ABC, abstractmethod
+import queue
+from threading import Lock
+import time
+from typing import Dict, List
+
+from project.lib.web.fair_task_queue import FairShareTaskQueue
+from project.lib.web.gpu_task import GPUTask
+from project.lib.web.task_lease import TaskLease
+
+
+class TaskQueueBackend(ABC):
+    """Store queued GPU tasks and the leases of the tasks handed to workers.
+
+    A task's lifecycle is: put -> lease -> (renew)* -> complete. If its lease
+    expires, it's returned from expire_leases and must then be either requeued
+    or completed (i.e., abandoned).
+    """
+
+    shared = False
+
+    @abstractmethod
+    def put(self, task: GPUTask, owner):
+        """Add a task to the queue.
+
+        Arguments:
+          - task: the task to add
+          - owner: ID of the server instance holding the task's group
+        """
+
+    @abstractmethod
+    def lease(self, timeout, lease_duration) -> GPUTask:
+        """Atomically take the next task from the queue and lease it, waiting up
+        to `timeout` seconds for one to arrive. Return None if none arrived."""
+
+    @abstractmethod
+    def renew(self, task_id, lease_duration):
+        """Extend the lease of a task; return False if the task isn't leased."""
+
+    @abstractmethod
+    def complete(self, task_id) -> GPUTask:
+        """Mark a task as completed and return it, or return None if it was
+        already completed or is unknown."""
+
+    @abstractmethod
+    def expire_leases(self, owner) -> List[GPUTask]:
+        """Return the tasks owned by the given instance whose leases expired."""
+
+    @abstractmethod
+    def requeue(self, task: GPUTask):
+        """Put a task whose lease expired back in the queue."""
+
+    @abstractmethod
+    def discard_group(self, group_id):
+        """Drop the queued tasks of a task group."""
+
+    @abstractmethod
+    def collect_garbage(self, limit):
+        """Forget completed tasks (and undelivered results) older than the
+        given timestamp."""
+
+    @abstractmethod
+    def qsize(self):
+        """Return the number of queued tasks."""
+
+    @abstractmethod
+    def qsize_for_room(self, room):
+        """Return the number of queued tasks for a given room."""
+
+    @abstractmethod
+    def queued_tasks(self) -> List[GPUTask]:
+        """Return a list of the queued tasks, in no particular order."""
+
+    @abstractmethod
+    def leased_tasks(self) -> List[GPUTask]:
+        """Return a list of the leased tasks (i.e., being processed by workers),
+        in no particular order."""
+
+    def post_results(self, task_id, results):
+        """Hand over results for a task owned by another server instance."""
+
+    def fetch_results(self, owner):
+        """Return (and remove) a list of (group_id, results) tuples posted for
+        tasks owned by the given instance, with the task's ID stored in the
+        results under "task_id"."""
+        return []
+
+
+class InMemoryTaskQueueBackend(TaskQueueBackend):
+    """Keep the task queue in the memory of a single server process."""
+
+    def __init__(self, aging_interval=30):
+        self.queue = FairShareTaskQueue(aging_interval=aging_interval)
+        self.leases: Dict[str, TaskLease]
+        self.leases = {}
+        self.dispatched_tasks: Dict[str, GPUTask]
+        self.dispatched_tasks = {}
+        self.completed_tasks = {}
+        self.discarded_groups = {}
+        self.expired_tasks = {}
+        self.lock = Lock()
+
+    def put(self, task: GPUTask, owner):
+        task.owner = owner
+        self.queue.put(task)
+
+    def is_stale(self, task: GPUTask):
+        return (
+            task.id in self.completed_tasks
+            or task.task_group.id in self.discarded_groups
+        )
+
+    def lease(self, timeout, lease_duration) -> GPUTask:
+        deadline = time.time() + timeout
+        while True:
+            try:
+                task = self.queue.get(timeout=max(deadline - time.time(), 0))
+            except queue.Empty:
+                return None
+            with self.lock:
+                if self.is_stale(task):
+                    continue
+                task.attempts += 1
+                self.leases[task.id] = TaskLease(task, lease_duration)
+                self.dispatched_tasks[task.id] = task
+            return task
+
+    def renew(self, task_id, lease_duration):
+        with self.lock:
+            if task_id not in self.leases:
+                return False
+            self.leases[task_id].renew()
+            return True
+
+    def complete(self, task_id) -> GPUTask:
+        with self.lock:
+            if task_id in self.completed_tasks:
+                return None
+            self.leases.pop(task_id, None)
+            self.expired_tasks.pop(task_id, None)
+            task = self.dispatched_tasks.pop(task_id, None)
+            if task is not None:
+                self.completed_tasks[task_id] = time.time()
+            return task
+
+    def expire_leases(self, owner) -> List[GPUTask]:
+        with self.lock:
+            expired = [
+                lease.task
+                for lease in self.leases.values()
+                if lease.expired and not self.is_stale(lease.task)
+            ]
+            for task in expired:
+                del self.leases[task.id]
+                self.expired_tasks[task.id] = task
+        return expired
+
+    def requeue(self, task: GPUTask):
+        with self.lock:
+            if self.expired_tasks.pop(task.id, None) is None:
+                return
+        self.queue.put(task)
+
+    def discard_group(self, group_id):
+        with self.lock:
+            self.discarded_groups[group_id] = time.time()
+            for task_id in list(self.dispatched_tasks.keys()):
+                if self.dispatched_tasks[task_id].task_group.id == group_id:
+                    self.leases.pop(task_id, None)
+                    self.expired_tasks.pop(task_id, None)
+                    del self.dispatched_tasks[task_id]
+
+    def collect_garbage(self, limit):
+        with self.lock:
+            for records in (self.completed_tasks, self.discarded_groups):
+                for key in list(records.keys()):
+                    if records[key] < limit:
+                        del records[key]
+
+    def qsize(self):
+        return self.queue.qsize()
+
+    def qsize_for_room(self, room):
+        return self.queue.qsize_for_room(room)
+
+    def queued_tasks(self) -> List[GPUTask]:
+        with self.lock:
+            return [task for task in self.queue.snapshot() if not self.is_stale(task)]
+
+    def leased_tasks(self) -> List[GPUTask]:
+        with self.lock:
+            return [lease.task for lease in self.leases.values()]
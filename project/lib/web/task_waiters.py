@@ -0,0 +1,46 @@
+from collections import OrderedDict
+import itertools
+from threading import Event, Lock
+
+
+class TaskWaiter:
+    """Represent a worker poll waiting for a GPU task to become available."""
+
+    def __init__(self, id):
+        self.id = id
+        self.event = Event()
+
+    def wait(self, timeout):
+        return self.event.wait(timeout=timeout)
+
+
+class TaskWaiterRegistry:
+    """Hand newly available GPU tasks to waiting worker polls in the order the
+    polls arrived. Registering, waking and cancelling a waiter are all O(1)."""
+
+    def __init__(self):
+        self.waiters = OrderedDict()
+        self.ids = itertools.count()
+        self.lock = Lock()
+
+    def __len__(self):
+        return len(self.waiters)
+
+    def register(self) -> TaskWaiter:
+        waiter = TaskWaiter(next(self.ids))
+        with self.lock:
+            self.waiters[waiter.id] = waiter
+        return waiter
+
+    def cancel(self, waiter: TaskWaiter):
+        with self.lock:
+            self.waiters.pop(waiter.id, None)
+
+    def notify_one(self):
+        """Wake the longest-waiting poll, if any; return whether one was woken."""
+        with self.lock:
+            if len(self.waiters) == 0:
+                return False
+            _, waiter = self.waiters.popitem(last=False)
+        waiter.event.set()
+        return True
@@ -0,0 +1,52 @@
+from threading import Lock
+
+from project.lib.web.gpu_task_types import GPUTaskTypes
+
+
+class ThroughputEstimator:
+    """Keep rolling estimates of how many seconds a worker spends on a task,
+    both per task type and per task type and number of regions, based on the
+    timings that workers report along with their results."""
+
+    def __init__(self, smoothing=0.2, default_seconds=10):
+        """Create a new ThroughputEstimator instance.
+
+        Arguments:
+          - smoothing: weight of each new timing in the exponential moving
+                       averages
+          - default_seconds: estimate used for task types without any timings
+        """
+        self.smoothing = smoothing
+        self.default_seconds = default_seconds
+        self.by_type = {}
+        self.by_regions = {}
+        self.lock = Lock()
+
+    def update(self, averages, key, seconds):
+        if key in averages:
+            averages[key] += self.smoothing * (seconds - averages[key])
+        else:
+            averages[key] = seconds
+
+    def record(self, task_type: GPUTaskTypes, n_regions, seconds):
+        with self.lock:
+            self.update(self.by_type, task_type, seconds)
+            if n_regions is not None:
+                self.update(self.by_regions, (task_type, n_regions), seconds)
+
+    def estimate(self, task_type: GPUTaskTypes, n_regions=None):
+        """Return the expected number of seconds a worker spends on a task."""
+        with self.lock:
+            if (task_type, n_regions) in self.by_regions:
+                return self.by_regions[(task_type, n_regions)]
+            return self.by_type.get(task_type, self.default_seconds)
+
+    def as_dict(self):
+        with self.lock:
+            estimates = {
+                task_type.name: {"seconds": seconds, "by_regions": {}}
+                for task_type, seconds in self.by_type.items()
+            }
+            for (task_type, n_regions), seconds in self.by_regions.items():
+                estimates[task_type.name]["by_regions"][n_regions] = seconds
+        return estimates
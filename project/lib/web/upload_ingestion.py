@@ -0,0 +1,49 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+
+class UploadIngestionPipeline:
+    """Prepare uploaded images (e.g., EXIF correction and decoding) in parallel
+    on a bounded pool of threads, handing them over in batches as they become
+    ready so that each batch can be stored in a single transaction."""
+
+    def __init__(self, n_threads=4):
+        """Create a new UploadIngestionPipeline instance.
+
+        Arguments:
+          - n_threads: number of threads preparing images, shared by all uploads
+        """
+        self.executor = ThreadPoolExecutor(
+            max_workers=n_threads, thread_name_prefix="ingestion"
+        )
+
+    def ingest(self, uploads, prepare, store_batch):
+        """Prepare a list of uploads and store them, blocking until done.
+
+        Arguments:
+          - uploads: list of uploads to ingest
+          - prepare: function taking an upload and returning it prepared for
+                     storage; runs on the pool
+          - store_batch: function taking a list of prepared uploads; runs on
+                         the calling thread (which may hold a database
+                         session) each time one or more uploads are ready
+
+        The first exception raised while preparing an upload is re-raised once
+        all other uploads have been stored.
+        """
+        pending = {self.executor.submit(prepare, upload) for upload in uploads}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            prepared = []
+            for future in done:
+                if future.exception() is None:
+                    prepared.append(future.result())
+                elif error is None:
+                    error = future.exception()
+            if len(prepared) > 0:
+                store_batch(prepared)
+        if error is not None:
+            raise error
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
@@ -8,27 +8,30 @@ from flask import (
     send_file,
     send_from_directory,
 )
+from flask.json import jsonify
 from flask_login import current_user
 import os
 from pathlib import Path
-import shutil
 import sys
-import time
+import uuid
 from werkzeug.utils import secure_filename
 import zipstream
 
-from project import app, backend_type, db, socketIO
+from project import app, backend_type, socketIO
+from project.lib.datamanagement.blob_store import blob_store
 from project.lib.datamanagement.models import (
-    delete_expired_rows,
+    add_images,
     EggLayingImage,
+    ImageContent,
     login_google_user,
-    SocketIOUser,
 )
-from project.lib.image.exif import correct_via_exif
+from project.lib.image.metadata import image_metadata, probe_image
+from project.lib.image.pyramid import level_factor, read_level
 from project.lib.os.pauser import PythonPauser
 from project.lib.util import dashed_datetime
 from project.lib.web.backend_types import BackendTypes
 from project.lib.web.exceptions import CUDAMemoryException, ImageAnalysisException
+from project.lib.web.image_store import content_digest
 
 
 main = Blueprint("main", __name__)
@@ -40,26 +43,6 @@ def allowed_file(filename):
     return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
-def remove_old_files(folder):
-    now = time.time()
-    for fname in os.listdir(folder):
-        if fname == ".gitkeep":
-            continue
-        f = os.path.join(folder, fname)
-        if now - os.stat(f).st_mtime > 60 * 60:
-            if os.path.isfile(f):
-                os.remove(f)
-            else:
-                shutil.rmtree(f)
-
-
-def remove_old_sql_rows():
-    for cls in (SocketIOUser, EggLayingImage):
-        delete_expired_rows(cls)
-    # with db.engine.begin() as conn:
-    #     conn.execute("VACUUM FULL")
-
-
 @main.route("/", methods=["GET", "POST"])
 def index():
     origin_flag = request.args.get("origin")
@@ -79,12 +62,25 @@ def index():
 
 @main.route("/uploads/<sid>/<filename>")
 def uploaded_file(sid, filename):
+    """Serve an uploaded image, or, given a `scale` query parameter, the
+    smallest level of its pyramid that is at least as large as the image
+    downscaled by that factor (for previews)."""
+    factor = level_factor(float(request.args.get("scale", 1)))
+    if factor > 1:
+        data = read_level(
+            os.path.join(app.config["UPLOAD_FOLDER"], sid, secure_filename(filename)),
+            factor,
+        )
+        if data is not None:
+            return send_file(BytesIO(data), mimetype="image/jpeg")
     if backend_type == BackendTypes.sql:
-        query = EggLayingImage.query.filter_by(
-            session_id=sid, basename=filename
-        ).first_or_404()
+        sha256 = EggLayingImage.find_column(
+            sid, filename, EggLayingImage.content_sha256
+        )
+        if sha256 is None:
+            abort(404)
         return send_file(
-            BytesIO(query.image),
+            blob_store.open(ImageContent.blob_key_for(sha256)),
             mimetype=f"image/{os.path.splitext(filename)[0]}",
             as_attachment=False,
         )
@@ -94,11 +90,19 @@ def uploaded_file(sid, filename):
         )
 
 
+@main.route("/queue-status/<sid>")
+def queue_status(sid):
+    return jsonify(app.gpu_manager.queue_status_for_room(sid))
+
+
 def zip_img_data(sm, zipstr):
     for path in sm.basenames.values():
-        img = img_as_bytes(sm.room, path)
-        if img.getbuffer().nbytes > 0:
-            zipstr.write_iter(path, img)
+        with app.app_context():
+            key = EggLayingImage.find_column(
+                sm.room, path, EggLayingImage.annotated_img_key
+            )
+        if key is not None:
+            zipstr.write_iter(path, blob_store.iter_chunks(key))
 
 
 def zip_egg_position_data(sm, zipstr):
@@ -118,15 +122,6 @@ def zip_generator(id, zip_data_generator):
     del app.downloadManager.sessions[id]
 
 
-def img_as_bytes(session_id, basename):
-    with app.app_context():
-        return BytesIO(
-            EggLayingImage.query.filter_by(session_id=session_id, basename=basename)
-            .first()
-            .annotated_img
-        )
-
-
 @main.route("/zip/<type>/<id>", methods=["POST"])
 def return_zipfile(type, id):
     if type == "annot-img":
@@ -146,63 +141,177 @@ def return_zipfile(type, id):
 def handle_upload():
     pauser.set_resume_timer()
     sid = request.form["sid"]
-    if backend_type == BackendTypes.sql:
-        remove_old_sql_rows()
-    elif backend_type == BackendTypes.filesystem:
-        for dir_name in ("uploads", "downloads"):
-            remove_old_files(dir_name)
+    if backend_type == BackendTypes.filesystem:
+        app.retention.track(os.path.join(app.config["UPLOAD_FOLDER"], sid))
     check_chamber_type_of_imgs(sid)
     return "OK"
 
 
+@main.route("/upload/chunked/<sid>/<filename>", methods=["GET", "POST"])
+def handle_chunked_upload(sid, filename):
+    """Receive a chunk of an uploaded file, or (via GET) report how many bytes
+    of it were received so far so that an interrupted upload can be resumed.
+
+    POST query parameters:
+      - offset: position of the chunk in the file
+      - total: size of the file
+      - sha256: SHA-256 hex digest of the file (optional, checked once the
+                last chunk arrives)
+
+    Completed files stay staged until they're ingested together, via
+    /upload/chunked/<sid>, without ever being held in memory by the web server
+    (except to store them as SQL blobs).
+    """
+    filename = secure_filename(filename)
+    if not allowed_file(filename):
+        abort(400)
+    folder_path = os.path.join(app.config["UPLOAD_FOLDER"], sid)
+    staged_path = os.path.join(folder_path, f"{filename}.part")
+    if request.method == "GET":
+        return jsonify(received=app.chunked_uploads.received(staged_path))
+    pauser.set_resume_timer()
+    app.retention.track(folder_path)
+    total = int(request.args["total"])
+    accepted, received = app.chunked_uploads.write_chunk(
+        staged_path, int(request.args.get("offset", 0)), request.stream
+    )
+    if not accepted:
+        return jsonify(received=received), 409
+    if received < total:
+        return jsonify(received=received)
+    sha256 = app.chunked_uploads.finish(staged_path)
+    if received > total or request.args.get("sha256", sha256).lower() != sha256:
+        app.chunked_uploads.discard(staged_path)
+        return jsonify(received=0, error="content mismatch"), 422
+    return jsonify(received=received, sha256=sha256)
+
+
+@main.route("/upload/chunked/<sid>", methods=["POST"])
+def ingest_chunked_uploads(sid):
+    """Ingest a batch of files uploaded in chunks, in parallel and with one
+    transaction per ready batch, as for /upload. Files that aren't completely
+    uploaded or were ingested already (e.g., by a retried request) are skipped.
+
+    Expects a JSON body with keys files (a list of dicts with keys filename and
+    index) and n_files (number of files uploaded by the user).
+    """
+    pauser.set_resume_timer()
+    folder_path = os.path.join(app.config["UPLOAD_FOLDER"], sid)
+    uploads = []
+    for file in request.json["files"]:
+        filename = secure_filename(file["filename"])
+        staged_path = os.path.join(folder_path, f"{filename}.part")
+        sha256 = app.chunked_uploads.claim(staged_path)
+        if sha256 is None:
+            continue
+        uploads.append(
+            {
+                "index": int(file["index"]),
+                "filename": filename,
+                "staged_path": staged_path,
+                "sha256": sha256,
+                "n_files": int(request.json["n_files"]),
+                "sid": sid,
+            }
+        )
+    ingest_uploads(sid, uploads)
+    return jsonify(ingested=[upload["filename"] for upload in uploads])
+
+
 def check_chamber_type_of_imgs(sid):
-    file_list = request.files
     n_files = len(request.files)
-    for i, file in enumerate(file_list):
-        check_chamber_type_of_img(i, file, sid, n_files)
-
-
-def save_img_as_file(file, file_path):
-    folder_path = Path(file_path).parent
-    if not os.path.exists(folder_path):
-        Path(folder_path).mkdir(exist_ok=True, parents=True)
-    request.files[file].save(file_path)
-    correct_via_exif(path=file_path)
-
-
-def save_img_as_sql_blob(sid, file, file_path):
-    user = SocketIOUser.query.filter_by(id=sid).first()
-    if not user:
-        user = SocketIOUser(id=sid)
-        db.session.add(user)
-    data = correct_via_exif(
-        data=request.files[file].read(),
-        format=os.path.splitext(file_path)[1][1:],
-    )
-    EggLayingImage(image=data, basename=os.path.basename(file_path), user=user)
-    db.session.commit()
+    uploads = [
+        {
+            "index": i,
+            "filename": secure_filename(file),
+            "file": request.files[file],
+            "n_files": n_files,
+            "sid": sid,
+        }
+        for i, file in enumerate(request.files)
+        if file and allowed_file(file)
+    ]
+    ingest_uploads(sid, uploads)
 
 
-def save_uploaded_img(sid, file, file_path):
+def ingest_uploads(sid, uploads):
+    """Store uploaded images and start their analysis.
+
+    Arguments:
+      - sid: ID of the socket session that uploaded the images
+      - uploads: list of dicts describing the images, each with keys index,
+                 filename, n_files, sid and either file (a FileStorage with the
+                 image bytes), data (the bytes) or staged_path (path of a file
+                 with them) and sha256 (their SHA-256 hex digest)
+    """
     if backend_type == BackendTypes.sql:
-        save_img_as_sql_blob(sid, file, file_path)
+
+        def store_batch(batch):
+            add_images(sid, batch)
+            for upload in batch:
+                # staged files of images stored already weren't moved
+                if "staged_path" in upload and os.path.isfile(upload["staged_path"]):
+                    os.remove(upload["staged_path"])
+            check_chamber_type_of_batch(sid, batch)
+
     elif backend_type == BackendTypes.filesystem:
-        save_img_as_file(file, file_path)
 
+        def store_batch(batch):
+            check_chamber_type_of_batch(sid, batch)
 
-def check_chamber_type_of_img(i, file, sid, n_files):
-    if file and allowed_file(file):
-        filename = secure_filename(file)
-        socketIO.emit(
-            "counting-progress",
-            {"data": "Uploading image %i of %i (%s)" % (i + 1, n_files, filename)},
-            room=sid,
+    app.ingestion_pipeline.ingest(uploads, prepare_upload, store_batch)
+
+
+def prepare_upload(upload):
+    """Record the shape of an uploaded image, with its EXIF orientation applied
+    (and store the image, for the filesystem backend). The image is stored
+    unchanged, with the orientation applied whenever it's decoded, and only
+    once per distinct content.
+
+    No pyramid is built for it: nothing reads pyramid levels at the moment, and
+    building them costs a full decode and three JPEG encodes per upload."""
+    socketIO.emit(
+        "counting-progress",
+        {
+            "data": "Uploading image %i of %i (%s)"
+            % (upload["index"] + 1, upload["n_files"], upload["filename"])
+        },
+        room=upload["sid"],
+    )
+    upload["file_path"] = os.path.join(
+        app.config["UPLOAD_FOLDER"], upload["sid"], upload["filename"]
+    )
+    if "file" in upload:
+        # spooled here rather than read by the request thread, so that at most
+        # one image per ingestion thread is in memory at a time
+        upload["staged_path"] = f"{upload['file_path']}.{uuid.uuid4().hex}.part"
+        Path(upload["staged_path"]).parent.mkdir(parents=True, exist_ok=True)
+        upload.pop("file").save(upload["staged_path"])
+        upload["sha256"] = content_digest(path=upload["staged_path"])
+    if "staged_path" in upload:
+        metadata = probe_image(upload["staged_path"])
+    else:
+        upload["sha256"] = content_digest(upload["data"])
+        metadata = probe_image(BytesIO(upload["data"]))
+    if backend_type == BackendTypes.filesystem:
+        app.image_store.store(
+            upload["sha256"],
+            upload["file_path"],
+            data=upload.get("data"),
+            staged_path=upload.pop("staged_path", None),
         )
-        folder_path = os.path.join(app.config["UPLOAD_FOLDER"], sid)
-        file_path = os.path.join(folder_path, filename)
-        save_uploaded_img(sid, file, file_path)
+    image_metadata.put(upload["file_path"], metadata._replace(sha256=upload["sha256"]))
+    upload["shape"] = metadata.shape
+    return upload
+
+
+def check_chamber_type_of_batch(sid, batch):
+    for upload in batch:
         app.sessions[sid].check_chamber_type_and_find_bounding_boxes(
-            file_path, i, n_files
+            upload["file_path"],
+            upload["index"],
+            upload["n_files"],
+            img_shape=upload["shape"],
         )
 
 
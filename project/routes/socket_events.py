@@ -10,7 +10,7 @@ import zipfile
 
 from project import app, backend_type, db
 from project.lib.common import zipdir
-from project.lib.datamanagement.models import EggRegionTemplate, SocketIOUser
+from project.lib.datamanagement.models import EggRegionTemplate
 from project.lib.datamanagement.socket_io_auth import authenticated_only
 from project.lib.mail import send
 from project.lib.util import dashed_datetime
@@ -29,19 +29,28 @@ def setup_event_handlers():
             del app.sessions[request.sid]
         app.sessions[data["sid"]].emit_to_room("pong", {})
 
+    @app.socketIO.on("get-queue-status")
+    def get_queue_status(data):
+        if data["sid"] not in app.sessions:
+            return
+        app.sessions[data["sid"]].emit_to_room(
+            "queue-status", app.gpu_manager.queue_status_for_room(data["sid"])
+        )
+
     @app.socketIO.on("connect")
     def connected():
         app.sessions[request.sid] = SessionManager(
-            app.socketIO, request.sid, app.gpu_manager
+            app.socketIO,
+            request.sid,
+            app.gpu_manager,
+            app.finalization_executor,
+            state_store=app.session_state_store,
         )
         app.socketIO.emit("sid-from-server", {"sid": request.sid}, room=request.sid)
 
     @app.socketIO.on("disconnect")
     def disconnected():
-        socket_session = SocketIOUser.query.filter_by(id=request.sid).first()
-        if socket_session:
-            db.session.delete(socket_session)
-        db.session.commit()
+        app.retention.expire_session(request.sid)
 
     @app.socketIO.on("save-custom-mask")
     @authenticated_only
@@ -4,13 +4,17 @@ from flask.json import jsonify
 from jwt.exceptions import InvalidTokenError
 import numpy as np
 import os
-from threading import Event, Thread
 
 from project import app
 from project.lib.web.auth_helper import AuthDecoder
-from project.lib.web.exceptions import CUDAMemoryException, ImageIgnoredException
+from project.lib.web.exceptions import (
+    CUDAMemoryException,
+    ImageAnalysisException,
+    ImageIgnoredException,
+)
 from project.lib.web.gpu_task import GPUTask
 from project.lib.web.gpu_task_types import GPUTaskTypes
+from project.lib.web.result_cache import MODEL_REVISION
 
 
 load_dotenv()
@@ -22,17 +26,21 @@ auth_decoder = AuthDecoder(
 )
 
 
-class TaskFinalizer(Thread):
+class TaskFinalizer:
     def __init__(self, group_id, results):
-        Thread.__init__(self)
         self.group_id = group_id
         self.room = app.gpu_manager.task_groups[group_id].room
         self.task_type = app.gpu_manager.task_groups[group_id].task_type
         self.results = results
 
     def handle_error(self):
-        if self.results["error"] == repr(CUDAMemoryException()):
-            if self.results["will_retry"]:
+        err_type = (
+            CUDAMemoryException
+            if self.results["error"] == repr(CUDAMemoryException())
+            else ImageAnalysisException
+        )
+        if self.results.get("will_retry", False):
+            if err_type is CUDAMemoryException:
                 app.socketIO.emit(
                     "counting-progress",
                     {
@@ -41,14 +49,20 @@ class TaskFinalizer(Thread):
                     },
                     room=self.room,
                 )
-            else:
-                app.sessions[self.room].report_counting_error(
-                    self.results["img_path"], CUDAMemoryException
-                )
+        else:
+            fail_task(
+                self.group_id,
+                self.task_type,
+                self.room,
+                self.results["img_path"],
+                self.results.get("index"),
+                err_type,
+            )
 
     def run(self):
         if "error" in self.results:
             self.handle_error()
+            return
         if self.task_type == GPUTaskTypes.arena:
             results = {
                 "predictions": [
@@ -64,6 +78,47 @@ class TaskFinalizer(Thread):
         app.gpu_manager.register_completed_task(results, self.group_id)
 
 
+def finalize_task_results(group_id, results):
+    task_finalizer = TaskFinalizer(group_id, results)
+    app.finalization_executor.submit(task_finalizer.run)
+
+
+def fail_task(group_id, task_type, room, img_path, index, err_type):
+    """Record that a task failed for good, so that its group still completes:
+    arena groups are discarded, with the error reported to the user, and egg
+    counting groups get an error result for the image."""
+    if group_id not in app.gpu_manager.task_groups:
+        return
+    if task_type == GPUTaskTypes.arena:
+        app.gpu_manager.discard_task_group(group_id)
+        if room in app.sessions:
+            app.sessions[room].report_counting_error(img_path, err_type)
+    else:
+        app.gpu_manager.register_completed_task(
+            {
+                "predictions": [err_type],
+                "metadata": {
+                    "index": index,
+                    "filename": os.path.basename(img_path),
+                    "model": MODEL_REVISION,
+                },
+            },
+            group_id,
+        )
+
+
+def abandon_task(task: GPUTask):
+    """Report an analysis error for a task that no worker managed to complete."""
+    fail_task(
+        task.task_group.id,
+        task.task_type,
+        task.task_group.room,
+        task.img_path,
+        task.data.get("index"),
+        ImageAnalysisException,
+    )
+
+
 def check_auth(request):
     if not request.headers.get("Authorization"):
         abort(400)
@@ -81,6 +136,7 @@ def get_task():
 
     def task_as_json(task: GPUTask):
         return jsonify(
+            task_id=task.id,
             img_path=task.img_path,
             type=task.task_type.name,
             room=task.task_group.room,
@@ -90,24 +146,19 @@ def get_task():
 
     task: GPUTask
     task = app.gpu_manager.get_task()
-    if type(task) is not GPUTask:
-        task_request = Event()
-        app.gpu_manager.add_task_request(task_request)
-        task_available = task_request.wait(timeout=SAFE_TIMEOUT)
-        if task_request in app.gpu_manager.task_requests:
-            app.gpu_manager.task_requests.remove(task_request)
-        if task_available:
-            return task_as_json(app.gpu_manager.get_task())
-        else:
-            return jsonify({})
-    else:
+    if type(task) is not GPUTask and app.gpu_manager.wait_for_task(SAFE_TIMEOUT):
+        task = app.gpu_manager.get_task()
+    if type(task) is GPUTask:
         return task_as_json(task)
+    return jsonify({})
 
 
 @tasks.route("/tasks/gpu/report", methods=["POST"])
 def report_task_progress():
     info = request.get_json()
     task_type = info["task_type"]
+    if info["group_id"] not in app.gpu_manager.task_groups:
+        return ("", 204)
     room = app.gpu_manager.task_groups[info["group_id"]].room
     s = app.sessions[room]
     path_map = s.paths_to_indices
@@ -130,10 +181,56 @@ def report_task_progress():
     return ("", 204)
 
 
+@tasks.route("/tasks/gpu/heartbeat", methods=["POST"])
+def renew_task_leases():
+    check_auth(request)
+    task_ids = request.get_json()["task_ids"]
+    return jsonify(
+        renewed=[
+            task_id for task_id in task_ids if app.gpu_manager.renew_lease(task_id)
+        ]
+    )
+
+
+@tasks.route("/tasks/gpu/status")
+def get_backlog_status():
+    check_auth(request)
+    return jsonify(app.gpu_manager.backlog_status())
+
+
 @tasks.route("/tasks/gpu/<group_id>", methods=["POST"])
 def receive_task_results(group_id):
     check_auth(request)
     results = request.get_json()
-    task_finalizer = TaskFinalizer(group_id, results)
-    task_finalizer.start()
-    return group_id
+    task_id = results.pop("task_id", None)
+    timing = results.pop("timing", None)
+    if task_id is not None:
+        if "error" in results and results.get("will_retry", False):
+            app.gpu_manager.renew_lease(task_id)
+        else:
+            task = app.gpu_manager.complete_task(task_id)
+            if task is None:
+                print(f"ignoring duplicate results for task {task_id}")
+                return results_receipt(group_id)
+            if timing is not None:
+                app.gpu_manager.record_timing(task, timing)
+            if "error" in results:
+                # workers don't echo the task's data, which failing it needs
+                results["index"] = task.data.get("index")
+            app.gpu_manager.cache_results(results, task)
+    if group_id not in app.gpu_manager.task_groups:
+        if task_id is not None and app.gpu_manager.backend.shared:
+            app.gpu_manager.forward_results(task_id, results)
+        return results_receipt(group_id)
+    finalize_task_results(group_id, results)
+    return results_receipt(group_id)
+
+
+def results_receipt(group_id):
+    """Acknowledge results, asking the worker to back off before requesting
+    more work if finalization is falling behind."""
+    return jsonify(
+        group_id=group_id,
+        queue_depth=app.finalization_executor.queue_depth,
+        backoff=app.finalization_executor.backoff,
+    )
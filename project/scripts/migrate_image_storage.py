@@ -0,0 +1,153 @@
+"""Migrate a SQL database from storing image blobs in its egg_laying_image and
+error_report tables to the current schema: image contents deduplicated by hash,
+blobs kept in the blob store (only their keys in SQL), and lookup indexes.
+
+The script is idempotent and can be rerun if interrupted. Run it from the root
+of the repository, with the server stopped:
+
+    python project/scripts/migrate_image_storage.py
+"""
+import argparse
+import hashlib
+import os, sys
+
+import sqlalchemy
+
+sys.path.append(os.path.abspath("./"))
+from project import create_app, app, db
+from project.lib.datamanagement.blob_store import blob_store
+from project.lib.datamanagement.models import (
+    EggLayingImage,
+    ErrorReport,
+    ImageContent,
+    SocketIOUser,
+)
+
+p = argparse.ArgumentParser(
+    description="move image blobs out of SQL and add lookup indexes"
+)
+p.add_argument(
+    "--batch_size",
+    help="number of rows migrated per transaction (default: 100)",
+    type=int,
+    default=100,
+)
+opts = p.parse_args()
+
+create_app()
+app.app_context().push()
+
+
+def columns_of(table_name):
+    return {
+        col["name"] for col in sqlalchemy.inspect(db.engine).get_columns(table_name)
+    }
+
+
+def add_column(table_name, name, col_type):
+    if name not in columns_of(table_name):
+        print(f"Adding column {table_name}.{name}")
+        with db.engine.begin() as conn:
+            conn.execute(
+                sqlalchemy.text(
+                    f"ALTER TABLE {table_name} ADD COLUMN {name} {col_type}"
+                )
+            )
+
+
+def drop_column(table_name, name):
+    if name in columns_of(table_name):
+        print(f"Dropping column {table_name}.{name}")
+        with db.engine.begin() as conn:
+            conn.execute(
+                sqlalchemy.text(f"ALTER TABLE {table_name} DROP COLUMN {name}")
+            )
+
+
+def migrate_rows(table_name, blob_columns, migrate_row):
+    """Move the blobs of rows not yet migrated to the blob store, a batch at a
+    time; `migrate_row` takes a connection and a row and returns the values to
+    update the row with."""
+    table = sqlalchemy.Table(
+        table_name, sqlalchemy.MetaData(), autoload_with=db.engine
+    )
+    marker = list(blob_columns.values())[0]
+    n_migrated = 0
+    while True:
+        with db.engine.begin() as conn:
+            rows = conn.execute(
+                sqlalchemy.select(table.c.id, *[table.c[col] for col in blob_columns])
+                .where(table.c[marker].is_(None))
+                .limit(opts.batch_size)
+            ).all()
+            for row in rows:
+                conn.execute(
+                    sqlalchemy.update(table)
+                    .where(table.c.id == row.id)
+                    .values(**migrate_row(conn, row))
+                )
+        n_migrated += len(rows)
+        print(f"Migrated {n_migrated} rows of {table_name}")
+        if len(rows) < opts.batch_size:
+            break
+
+
+def migrate_image(conn, row):
+    values = {}
+    if row.image is not None:
+        sha256 = hashlib.sha256(row.image).hexdigest()
+        content = ImageContent.__table__
+        n_updated = conn.execute(
+            sqlalchemy.update(content)
+            .where(content.c.sha256 == sha256)
+            .values(refcount=content.c.refcount + 1)
+        ).rowcount
+        if n_updated == 0:
+            blob_store.put(ImageContent.blob_key_for(sha256), data=row.image)
+            conn.execute(sqlalchemy.insert(content).values(sha256=sha256, refcount=1))
+        values["content_sha256"] = sha256
+    if row.annotated_img is not None:
+        values["annotated_img_key"] = f"annotated/migrated/{row.id}"
+        blob_store.put(values["annotated_img_key"], data=row.annotated_img)
+    return values
+
+
+def migrate_error_report(conn, row):
+    values = {}
+    for col, key_col in (
+        ("image", "image_key"),
+        ("outline_image", "outline_image_key"),
+    ):
+        values[key_col] = f"error-reports/migrated/{row.id}_{col}.png"
+        blob_store.put(values[key_col], data=getattr(row, col))
+    return values
+
+
+db.create_all()
+image_table = EggLayingImage.__tablename__
+if "image" in columns_of(image_table):
+    add_column(image_table, "content_sha256", "VARCHAR(64)")
+    add_column(image_table, "annotated_img_key", "VARCHAR(255)")
+    migrate_rows(
+        image_table,
+        {"image": "content_sha256", "annotated_img": "annotated_img_key"},
+        migrate_image,
+    )
+    drop_column(image_table, "image")
+    drop_column(image_table, "annotated_img")
+report_table = ErrorReport.__tablename__
+if "image" in columns_of(report_table):
+    add_column(report_table, "image_key", "VARCHAR(255)")
+    add_column(report_table, "outline_image_key", "VARCHAR(255)")
+    migrate_rows(
+        report_table,
+        {"image": "image_key", "outline_image": "outline_image_key"},
+        migrate_error_report,
+    )
+    drop_column(report_table, "image")
+    drop_column(report_table, "outline_image")
+for model in (SocketIOUser, EggLayingImage, ErrorReport):
+    for index in model.__table__.indexes:
+        print(f"Creating index {index.name} (unless it exists)")
+        index.create(bind=db.engine, checkfirst=True)
+print("Done")
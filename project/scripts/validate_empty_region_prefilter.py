@@ -0,0 +1,111 @@
+import argparse
+import csv
+import json
+import os, sys
+
+from csbdeep.utils import normalize
+import numpy as np
+from PIL import Image
+
+sys.path.append(os.path.abspath("./"))
+from project import create_app
+from project.gpu_backend.empty_region_prefilter import EmptyRegionPrefilter
+from project.lib.image.chamber import CT, LargeChamber
+from project.lib.image.circleFinder import CircleFinder
+from project.lib.image.sub_image_helper import SubImageHelper
+
+p = argparse.ArgumentParser(
+    description="score the egg-laying regions of the test images with the"
+    + " empty-region prefilter and compare the scores against the official egg"
+    + " counts in the test CSVs"
+)
+p.add_argument(
+    "--threshold",
+    type=float,
+    help="prefilter threshold to evaluate. If omitted, the highest threshold"
+    + " that wouldn't skip any region containing eggs is reported instead.",
+)
+p.add_argument(
+    "--images",
+    default="project/configs/test_images.json",
+    help="JSON file listing the test images along with their CSVs",
+)
+opts = p.parse_args()
+
+
+def read_official_counts(csv_path, chamber_type, inverted):
+    """Return the egg counts from a test CSV in the same order as the regions
+    produced by the arena detector."""
+    with open(csv_path, "r") as f:
+        cells = [cell for row in csv.reader(f) if len(row) > 1 for cell in row]
+    if chamber_type == CT.large.name:
+        return [int(el) for el in LargeChamber().flattenCounts(cells)]
+    counts = [int(el) for el in cells if el != ""]
+    if inverted:
+        chamber = CT[chamber_type].value()
+        n_rows = chamber.numRows * getattr(chamber, "numRepeatedRowsPerCol", 1)
+        counts = np.array(counts).reshape((-1, n_rows)).T.flatten().tolist()
+    return counts
+
+
+def score_regions(img_path, prefilter: EmptyRegionPrefilter):
+    img = np.array(Image.open(img_path).convert("RGB"))
+    cf = CircleFinder(os.path.basename(img_path), img.shape, None, True, img=img)
+    circles, avgDists, numRowsCols, rotationAngle, _ = cf.findCircles(
+        include_img=True
+    )
+    bboxes = [
+        [round(el) for el in bbox]
+        for bbox in cf.getSubImageBBoxes(circles, avgDists, numRowsCols)
+    ]
+    helper = SubImageHelper()
+    helper.get_sub_images(
+        normalize(img, 1, 99.8, axis=(0, 1)),
+        img_path,
+        {"bboxes": bboxes, "rotationAngle": rotationAngle, "type": cf.ct},
+        None,
+    )
+    return [prefilter.score(sub_img) for sub_img in helper.subImgs], cf
+
+
+create_app()
+with open(opts.images, "r") as f:
+    test_images = json.load(f)
+prefilter = EmptyRegionPrefilter(opts.threshold)
+scores, counts = [], []
+for img_id, img_info in test_images.items():
+    if not os.path.isfile(img_info["path"]):
+        print(f"{img_id}: image not found at {img_info['path']}; skipping")
+        continue
+    img_scores, cf = score_regions(img_info["path"], prefilter)
+    img_counts = read_official_counts(img_info["csv"], cf.ct, cf.inverted)
+    if len(img_scores) != len(img_counts):
+        print(
+            f"{img_id}: found {len(img_scores)} regions but the CSV lists"
+            + f" {len(img_counts)}; skipping"
+        )
+        continue
+    scores += img_scores
+    counts += img_counts
+    print(f"{img_id}:")
+    for i, (score, count) in enumerate(zip(img_scores, img_counts)):
+        print(f"  region {i}: score {score:.2f}, official count {count}")
+
+if len(scores) == 0:
+    sys.exit("no test images could be scored")
+scores, counts = np.array(scores), np.array(counts)
+print(f"\nscored {len(scores)} regions ({np.sum(counts == 0)} empty)")
+if opts.threshold is None:
+    safe_threshold = np.min(scores[counts > 0]) if np.any(counts > 0) else np.inf
+    print(
+        "highest threshold that skips no region with eggs:",
+        f"{safe_threshold:.2f}",
+        f"(would skip {np.sum(scores < safe_threshold)} empty regions)",
+    )
+else:
+    skipped = scores < opts.threshold
+    print(f"threshold {opts.threshold} skips {np.sum(skipped)} regions")
+    print(
+        f"  of which {np.sum(skipped & (counts > 0))} contain eggs",
+        f"({np.sum(counts[skipped])} eggs missed in total)",
+    )
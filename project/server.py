@@ -5,11 +5,28 @@ import time
 import waitress
 
 
-from project import create_app
+from project import backend_type, create_app
+from project.lib.event import Listener
+from project.lib.web.admission_control import AdmissionController
+from project.lib.web.backend_types import BackendTypes
+from project.lib.web.chunked_upload import ChunkedUploadRegistry
 from project.lib.web.downloadManager import DownloadManager
+from project.lib.web.finalization_executor import FinalizationExecutor
 from project.lib.web.gpu_manager import GPUManager
-from project.lib.web.scheduler import Scheduler
+from project.lib.web.image_store import FileImageStore
+from project.lib.web.result_cache import ResultCache
+from project.lib.web.retention import RetentionService
+from project.lib.web.scheduler import scheduler
+from project.lib.web.session_state_store import (
+    InMemorySessionStateStore,
+    SessionRegistry,
+)
+from project.lib.web.sessionManager import SessionManager
+from project.lib.web.sqlite_session_state_store import SQLiteSessionStateStore
+from project.lib.web.sqlite_task_queue_backend import SQLiteTaskQueueBackend
+from project.lib.web.upload_ingestion import UploadIngestionPipeline
 from project.routes import socket_events
+from project.routes.tasks import abandon_task, finalize_task_results
 
 
 def prune_old_sessions():
@@ -17,17 +34,137 @@ def prune_old_sessions():
     for sid in list(app.sessions.keys()):
         if current_time - app.sessions[sid].lastPing > 60 * 10:
             del app.sessions[sid]
+            if not app.session_state_store.shared:
+                app.session_state_store.clear(sid)
+
+
+def report_task_admission(task, status):
+    room = task.task_group.room
+    if room not in app.sessions:
+        return
+    app.sessions[room].emit_to_room(
+        "task-admission",
+        {
+            "status": status,
+            "task_type": task.task_type.name,
+            "filename": os.path.basename(task.img_path),
+            "deferred": app.gpu_manager.admission_controller.n_deferred(room),
+        },
+    )
+
+
+rooms_with_queue_status = set()
+
+
+def emit_queue_status():
+    statuses = app.gpu_manager.queue_status()
+    # rooms whose tasks have all completed get an empty status once
+    for room in rooms_with_queue_status - set(statuses):
+        statuses[room] = app.gpu_manager.queue_status_for_room(room)
+    rooms_with_queue_status.clear()
+    for room, status in statuses.items():
+        if room in app.sessions:
+            app.sessions[room].emit_to_room("queue-status", status)
+            if status["completion_time"] is not None:
+                rooms_with_queue_status.add(room)
 
 
 flask_debug = os.environ.get("FLASK_DEBUG", "0")
 app = create_app()
-app.sessions = {}
+if os.environ.get("SESSION_STATE_BACKEND", "memory") == "sqlite":
+    app.session_state_store = SQLiteSessionStateStore(
+        os.environ.get("SESSION_STATE_PATH", "./session_state.sqlite")
+    )
+else:
+    app.session_state_store = InMemorySessionStateStore()
+app.sessions = SessionRegistry(
+    app.session_state_store,
+    lambda sid: SessionManager(
+        app.socketIO,
+        sid,
+        app.gpu_manager,
+        app.finalization_executor,
+        state_store=app.session_state_store,
+    ),
+)
 app.downloadManager = DownloadManager()
-app.gpu_manager = GPUManager()
+if backend_type == BackendTypes.filesystem:
+    app.image_store = FileImageStore(
+        os.path.join(app.config["UPLOAD_FOLDER"], "objects")
+    )
+app.retention = RetentionService(
+    max_age=float(os.environ.get("UPLOAD_RETENTION_SECONDS", 60 * 60)),
+    batch_size=int(os.environ.get("RETENTION_BATCH_SIZE", 100)),
+    image_store=getattr(app, "image_store", None),
+)
+app.chunked_uploads = ChunkedUploadRegistry()
+app.ingestion_pipeline = UploadIngestionPipeline(
+    n_threads=int(os.environ.get("INGESTION_THREADS", 4))
+)
+app.finalization_executor = FinalizationExecutor(
+    n_threads=int(os.environ.get("FINALIZER_THREADS", 4)),
+    max_queue_depth=int(os.environ.get("FINALIZER_MAX_QUEUE_DEPTH", 32)),
+    n_processes=int(os.environ.get("FINALIZER_PROCESSES", 0)),
+)
+if os.environ.get("RESULT_CACHE_ENABLED", "1") == "1":
+    result_cache = ResultCache(
+        os.environ.get("RESULT_CACHE_DIR", "./result_cache"),
+        max_entries=int(os.environ.get("RESULT_CACHE_MAX_ENTRIES", 256)),
+        max_disk_bytes=int(float(os.environ.get("RESULT_CACHE_MAX_DISK_MB", 512)))
+        * 1024**2,
+    )
+else:
+    result_cache = None
+task_aging_interval = float(os.environ.get("GPU_TASK_AGING_SECONDS", 30))
+if os.environ.get("GPU_TASK_QUEUE_BACKEND", "memory") == "sqlite":
+    task_queue_backend = SQLiteTaskQueueBackend(
+        os.environ.get("GPU_TASK_QUEUE_PATH", "./task_queue.sqlite"),
+        aging_interval=task_aging_interval,
+    )
+else:
+    task_queue_backend = None
+# admission control is off unless a limit is set
+admission_limits = dict(
+    max_tasks_per_room=int(os.environ.get("ADMISSION_MAX_TASKS_PER_ROOM", 0)),
+    max_tasks=int(os.environ.get("ADMISSION_MAX_TASKS", 0)),
+    max_bytes_per_room=int(float(os.environ.get("ADMISSION_MAX_MB_PER_ROOM", 0)))
+    * 1024**2,
+    max_bytes=int(float(os.environ.get("ADMISSION_MAX_MB", 0))) * 1024**2,
+)
+admission_controller = (
+    AdmissionController(**admission_limits) if any(admission_limits.values()) else None
+)
+app.gpu_manager = GPUManager(
+    result_cache=result_cache,
+    task_aging_interval=task_aging_interval,
+    lease_duration=float(os.environ.get("GPU_TASK_LEASE_SECONDS", 120)),
+    max_attempts=int(os.environ.get("GPU_TASK_MAX_ATTEMPTS", 3)),
+    task_group_ttl=float(os.environ.get("GPU_TASK_GROUP_TTL_SECONDS", 60 * 60)),
+    backend=task_queue_backend,
+    n_workers=int(os.environ["NUM_GPU_WORKERS"]),
+    admission_controller=admission_controller,
+)
+app.gpu_manager.add_results_listener(Listener(finalize_task_results))
+app.gpu_manager.add_abandoned_task_listener(Listener(abandon_task))
+app.gpu_manager.add_task_admission_listener(Listener(report_task_admission))
 socket_events.setup_event_handlers()
-scheduler = Scheduler(1)
-scheduler.schedule.every(5).minutes.do(prune_old_sessions)
-stop_scheduler = scheduler.run_continuously()
+scheduler.call_every(5 * 60, prune_old_sessions)
+if app.session_state_store.shared:
+    scheduler.call_every(
+        5 * 60,
+        app.session_state_store.expire,
+        float(os.environ.get("SESSION_STATE_MAX_AGE_SECONDS", 60 * 60)),
+    )
+scheduler.call_every(15, app.gpu_manager.requeue_expired_leases)
+scheduler.call_every(5 * 60, app.gpu_manager.collect_garbage)
+scheduler.call_every(
+    float(os.environ.get("RETENTION_SWEEP_SECONDS", 60)), app.retention.sweep
+)
+scheduler.call_every(
+    float(os.environ.get("QUEUE_STATUS_INTERVAL_SECONDS", 5)), emit_queue_status
+)
+if app.gpu_manager.backend.shared:
+    scheduler.call_every(1, app.gpu_manager.deliver_forwarded_results)
 if flask_debug == "0":
     server_host = "0.0.0.0"
 elif flask_debug == "1":
@@ -40,5 +177,15 @@ p.add_argument("--port", default="5000", help="port where the server should list
 opts = p.parse_args()
 logger = logging.getLogger("waitress")
 logger.setLevel(logging.INFO)
-waitress.serve(app, host=opts.host, port=opts.port)
-stop_scheduler.set()
+# each GPU worker holds a request thread while long-polling for tasks, so
+# reserve one per worker on top of the threads that serve users
+waitress.serve(
+    app,
+    host=opts.host,
+    port=opts.port,
+    threads=int(os.environ.get("SERVER_THREADS", 4))
+    + int(os.environ["NUM_GPU_WORKERS"]),
+)
+scheduler.shutdown()
+app.finalization_executor.shutdown()
+app.ingestion_pipeline.shutdown()
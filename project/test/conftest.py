@@ -0,0 +1,19 @@
+"""Configuration for the unit tests, which run from the root of the repository:
+
+    python -m pytest project/test
+
+The app reads its configuration from the environment when it's imported, so
+the tests default to the SQLite-backed SQL backend, with blobs kept in a
+temporary folder.
+"""
+import os
+import sys
+import tempfile
+
+os.environ.setdefault("EGG_COUNTING_BACKEND_TYPE", "sql")
+os.environ.setdefault("SQL_ADDR_TYPE", "sqlite")
+os.environ.setdefault("BLOB_STORE_PATH", tempfile.mkdtemp(prefix="blobs-"))
+sys.path.append(os.path.abspath("./"))
+
+# browser test run as a script against a deployed server
+collect_ignore = ["test_counting_page.py"]
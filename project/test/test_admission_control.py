@@ -0,0 +1,75 @@
+from project.lib.web.admission_control import AdmissionController
+from project.lib.web.gpu_task import GPUTask
+from project.lib.web.gpu_task_group import GPUTaskGroup
+from project.lib.web.gpu_task_types import GPUTaskTypes
+
+
+def make_tasks(room, n_tasks, n_bytes=0):
+    task_group = GPUTaskGroup(n_tasks, room, GPUTaskTypes.egg)
+    return [
+        GPUTask(task_group, f"{room}-{i}.png", {}, n_bytes=n_bytes)
+        for i in range(n_tasks)
+    ]
+
+
+def test_admits_everything_without_limits():
+    controller = AdmissionController()
+    assert all(controller.admit(task) for task in make_tasks("a", 100, 10**9))
+    assert controller.n_deferred("a") == 0
+
+
+def test_defers_tasks_over_room_limit_until_released():
+    controller = AdmissionController(max_tasks_per_room=2)
+    tasks = make_tasks("a", 4)
+    assert [controller.admit(task) for task in tasks] == [True, True, False, False]
+    assert controller.admit(make_tasks("b", 1)[0])
+    assert controller.n_deferred("a") == 2
+    assert controller.release(tasks[0].id) == [tasks[2]]
+    assert controller.release(tasks[0].id) == []
+    assert controller.release(tasks[1].id) == [tasks[3]]
+    assert controller.n_deferred("a") == 0
+    assert controller.deferred_tasks() == []
+
+
+def test_keeps_room_order_once_tasks_are_deferred():
+    controller = AdmissionController(max_bytes_per_room=100)
+    big_task, small_task = make_tasks("a", 1, 80)[0], make_tasks("a", 1, 10)[0]
+    first_task = make_tasks("a", 1, 50)[0]
+    assert controller.admit(first_task)
+    assert not controller.admit(big_task)
+    # would fit, but mustn't overtake the deferred task
+    assert not controller.admit(small_task)
+    assert controller.deferred_tasks() == [big_task, small_task]
+    assert controller.release(first_task.id) == [big_task, small_task]
+
+
+def test_admits_oversized_task_of_idle_room():
+    controller = AdmissionController(max_bytes_per_room=100, max_bytes=100)
+    big_task = make_tasks("a", 1, 500)[0]
+    assert controller.admit(big_task)
+    assert controller.admit(make_tasks("b", 1, 500)[0])
+    assert not controller.admit(make_tasks("a", 1, 1)[0])
+
+
+def test_rooms_take_turns_when_capacity_frees_up():
+    controller = AdmissionController(max_tasks=2)
+    first_a, first_b = make_tasks("a", 1)[0], make_tasks("b", 1)[0]
+    assert controller.admit(first_a) and controller.admit(first_b)
+    waiting_a, waiting_b = make_tasks("a", 2), make_tasks("b", 2)
+    for task in waiting_a + waiting_b:
+        assert not controller.admit(task)
+    assert controller.release(first_a.id) == [waiting_a[0]]
+    assert controller.release(first_b.id) == [waiting_b[0]]
+    assert controller.release(waiting_a[0].id) == [waiting_a[1]]
+
+
+def test_release_group_drops_deferred_and_releases_outstanding_tasks():
+    controller = AdmissionController(max_tasks=2)
+    tasks_a, tasks_b = make_tasks("a", 3), make_tasks("b", 2)
+    assert controller.admit(tasks_a[0]) and controller.admit(tasks_b[0])
+    for task in tasks_a[1:] + tasks_b[1:]:
+        assert not controller.admit(task)
+    assert controller.release_group(tasks_a[0].task_group.id) == [tasks_b[1]]
+    assert controller.deferred_tasks() == []
+    assert controller.release(tasks_a[0].id) == []
+    assert controller.admit(make_tasks("a", 1)[0])
@@ -0,0 +1,82 @@
+import hashlib
+import os
+import uuid
+
+import pytest
+import sqlalchemy
+
+from project import app, db
+from project.lib.datamanagement import models
+from project.lib.datamanagement.blob_store import blob_store
+from project.lib.datamanagement.models import (
+    add_images,
+    delete_sessions,
+    EggLayingImage,
+    ImageContent,
+)
+from project.lib.image.metadata import ImageMetadataService
+
+
+@pytest.fixture
+def session_id():
+    with app.app_context():
+        db.create_all()
+        session_id = uuid.uuid4().hex
+        yield session_id
+        db.session.rollback()
+        delete_sessions([session_id])
+
+
+def staged_upload(tmp_path, filename):
+    data = uuid.uuid4().bytes
+    path = tmp_path / f"{filename}.part"
+    path.write_bytes(data)
+    return {
+        "filename": filename,
+        "sha256": hashlib.sha256(data).hexdigest(),
+        "staged_path": str(path),
+    }
+
+
+def test_add_images_stores_batch(session_id, tmp_path):
+    uploads = [staged_upload(tmp_path, f"{i}.png") for i in range(2)]
+    add_images(session_id, uploads)
+    assert EggLayingImage.query.filter_by(session_id=session_id).count() == 2
+    for upload in uploads:
+        assert blob_store.exists(ImageContent.blob_key_for(upload["sha256"]))
+
+
+def test_add_images_retries_batch_after_content_insert_race(
+    session_id, tmp_path, monkeypatch
+):
+    uploads = [staged_upload(tmp_path, f"{i}.png") for i in range(3)]
+    raced_sha256 = uploads[1]["sha256"]
+    add_image_reference = models.add_image_reference
+    n_races = []
+
+    def racing_add_image_reference(user, basename, sha256, **kwargs):
+        image = add_image_reference(user, basename, sha256, **kwargs)
+        if sha256 == raced_sha256 and len(n_races) == 0:
+            # another session inserts the same content after this one found
+            # none, so that the batch's flush fails
+            n_races.append(1)
+            db.session.execute(
+                sqlalchemy.insert(ImageContent.__table__).values(
+                    sha256=sha256, refcount=1
+                )
+            )
+        return image
+
+    monkeypatch.setattr(models, "add_image_reference", racing_add_image_reference)
+    add_images(session_id, uploads)
+    assert len(n_races) == 1
+    assert EggLayingImage.query.filter_by(session_id=session_id).count() == 3
+    for upload in uploads:
+        # the first upload's staged file was moved during the failed attempt
+        assert blob_store.exists(ImageContent.blob_key_for(upload["sha256"]))
+        assert db.session.get(ImageContent, upload["sha256"]).refcount == 1
+
+
+def test_probe_raises_file_not_found_for_unknown_image(session_id):
+    with pytest.raises(FileNotFoundError):
+        ImageMetadataService.probe(os.path.join("uploads", session_id, "0.png"))
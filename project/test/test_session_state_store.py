@@ -0,0 +1,126 @@
+import time
+
+import pytest
+
+from project.lib.web.exceptions import ImageAnalysisException
+from project.lib.web.session_state_store import (
+    decode_regions,
+    encode_regions,
+    InMemorySessionStateStore,
+    SessionStateMap,
+)
+from project.lib.web.sqlite_session_state_store import SQLiteSessionStateStore
+
+
+def round_trip(regions):
+    return decode_regions(encode_regions(regions))
+
+
+def test_regions_round_trip_predictions():
+    predictions = [
+        {
+            "bbox": [10, 20, 110, 220],
+            "outlines": [[[1, 2], [3, 4], [5, 6]], [[7, 8], [9, 10]]],
+            "score": 0.75,
+            "label": "egg",
+        },
+        {
+            "bbox": [5, 6, 7, 8],
+            "outlines": [],
+            "score": 0.5,
+            "label": "egg",
+        },
+        {"bbox": [0, 0, 3_000_000_000, 1], "outlines": [], "score": 1 / 3},
+    ]
+    decoded = round_trip(predictions)
+    assert decoded == predictions
+    assert all(type(v) is int for region in decoded for v in region["bbox"])
+    assert type(decoded[0]["outlines"][0][0][0]) is int
+
+
+def test_regions_round_trip_keeps_ints_next_to_empty_lists():
+    regions = [{"points": []}, {"points": [[1, 2], [3, 4]]}, {"points": []}]
+    decoded = round_trip(regions)
+    assert decoded == regions
+    assert type(decoded[1]["points"][0][0]) is int
+
+
+def test_regions_round_trip_error_and_empty_lists():
+    assert round_trip([ImageAnalysisException]) == [ImageAnalysisException]
+    assert round_trip([]) == []
+    assert round_trip([{}, {"count": 3}]) == [{}, {"count": 3}]
+
+
+def test_regions_round_trip_turns_tuples_into_lists():
+    assert round_trip([{"center": (1, 2)}]) == [{"center": [1, 2]}]
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, tmp_path):
+    if request.param == "memory":
+        return InMemorySessionStateStore()
+    return SQLiteSessionStateStore(str(tmp_path / "state.sqlite"))
+
+
+def test_store_map_keeps_entries_in_order(store):
+    predictions = SessionStateMap(store, "sid", "predictions")
+    predictions["b.png"] = [{"bbox": [1, 2, 3, 4]}]
+    predictions["a.png"] = [ImageAnalysisException]
+    predictions["b.png"] = [{"bbox": [5, 6, 7, 8]}]
+    assert list(predictions) == ["b.png", "a.png"]
+    assert predictions["b.png"] == [{"bbox": [5, 6, 7, 8]}]
+    assert "a.png" in predictions and "c.png" not in predictions
+    assert len(predictions) == 2
+
+
+def test_store_deletes_entries(store):
+    info = SessionStateMap(store, "sid", "info")
+    info["n_files"] = 3
+    del info["n_files"]
+    assert "n_files" not in info
+    with pytest.raises(KeyError):
+        info["n_files"]
+    with pytest.raises(KeyError):
+        del info["n_files"]
+    assert info.pop("n_files", None) is None
+
+
+def test_store_clears_field_or_session(store):
+    predictions = SessionStateMap(store, "sid", "predictions")
+    basenames = SessionStateMap(store, "sid", "basenames")
+    other_basenames = SessionStateMap(store, "other", "basenames")
+    predictions["a.png"] = []
+    basenames["a.png"] = "a"
+    other_basenames["b.png"] = "b"
+    predictions.clear()
+    assert len(predictions) == 0 and basenames["a.png"] == "a"
+    store.clear("sid")
+    assert not store.has_session("sid") and len(basenames) == 0
+    assert store.has_session("other") and other_basenames["b.png"] == "b"
+
+
+def test_store_expires_idle_sessions(store):
+    SessionStateMap(store, "old", "basenames")["a.png"] = "a"
+    time.sleep(0.05)
+    SessionStateMap(store, "new", "basenames")["b.png"] = "b"
+    store.expire(0.025)
+    assert not store.has_session("old")
+    assert store.keys("old", "basenames") == []
+    assert store.has_session("new")
+    store.expire(0)
+    assert not store.has_session("new")
+
+
+def test_sqlite_store_shares_state_between_instances(tmp_path):
+    path = str(tmp_path / "state.sqlite")
+    writer, reader = SQLiteSessionStateStore(path), SQLiteSessionStateStore(path)
+    predictions = SessionStateMap(writer, "sid", "predictions")
+    predictions["a.png"] = [{"bbox": [1, 2, 3, 4]}]
+    assert reader.get("sid", "predictions", "a.png") == [{"bbox": [1, 2, 3, 4]}]
+    # a cached entry isn't served after another instance updates it
+    predictions["a.png"] = [{"bbox": [5, 6, 7, 8]}]
+    assert reader.get("sid", "predictions", "a.png") == [{"bbox": [5, 6, 7, 8]}]
+    reader.clear("sid")
+    assert not writer.has_session("sid")
+    with pytest.raises(KeyError):
+        writer.get("sid", "predictions", "a.png")
@@ -0,0 +1,203 @@
+import pytest
+
+from project.lib.event import Listener
+from project.lib.web.admission_control import AdmissionController
+from project.lib.web.fair_task_queue import FairShareTaskQueue
+from project.lib.web.gpu_manager import GPUManager
+from project.lib.web.gpu_task import GPUTask
+from project.lib.web.gpu_task_group import GPUTaskGroup
+from project.lib.web.gpu_task_types import GPUTaskTypes
+from project.lib.web.sqlite_task_queue_backend import SQLiteTaskQueueBackend
+from project.lib.web.task_queue_backend import InMemoryTaskQueueBackend
+
+OWNER = "instance-1"
+
+
+def make_tasks(room, n_tasks, task_type=GPUTaskTypes.egg):
+    task_group = GPUTaskGroup(n_tasks, room, task_type)
+    return [GPUTask(task_group, f"{room}-{i}.png", {}) for i in range(n_tasks)]
+
+
+def drain(task_queue: FairShareTaskQueue):
+    tasks = []
+    while not task_queue.empty():
+        tasks.append(task_queue.get_nowait())
+    return tasks
+
+
+def test_queue_takes_turns_between_rooms():
+    task_queue = FairShareTaskQueue()
+    for task in make_tasks("a", 3) + make_tasks("b", 2):
+        task_queue.put(task)
+    rooms = [task.task_group.room for task in drain(task_queue)]
+    assert rooms == ["a", "b", "a", "b", "a"]
+
+
+def test_queue_serves_arena_tasks_first():
+    task_queue = FairShareTaskQueue()
+    for task in make_tasks("a", 2) + make_tasks("b", 1, GPUTaskTypes.arena):
+        task_queue.put(task)
+    assert [task.task_type for task in drain(task_queue)] == [
+        GPUTaskTypes.arena,
+        GPUTaskTypes.egg,
+        GPUTaskTypes.egg,
+    ]
+
+
+def test_queue_promotes_waiting_tasks():
+    task_queue = FairShareTaskQueue(aging_interval=0)
+    egg_task = make_tasks("a", 1)[0]
+    task_queue.put(egg_task)
+    task_queue.put(make_tasks("b", 1, GPUTaskTypes.arena)[0])
+    # the aged egg task ties with the arena task and was enqueued first
+    assert task_queue.get_nowait() is egg_task
+
+
+def test_queue_aging_keeps_rooms_taking_turns():
+    task_queue = FairShareTaskQueue(aging_interval=0)
+    for task in make_tasks("a", 2, GPUTaskTypes.arena) + make_tasks("b", 1):
+        task_queue.put(task)
+    rooms = [task.task_group.room for task in drain(task_queue)]
+    assert rooms == ["a", "b", "a"]
+
+
+def test_queue_counts_tasks_per_room():
+    task_queue = FairShareTaskQueue()
+    for task in make_tasks("a", 2) + make_tasks("a", 1, GPUTaskTypes.arena):
+        task_queue.put(task)
+    assert task_queue.qsize_for_room("a") == 3
+    assert task_queue.qsize_for_room("b") == 0
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def backend(request, tmp_path):
+    if request.param == "memory":
+        return InMemoryTaskQueueBackend()
+    return SQLiteTaskQueueBackend(str(tmp_path / "tasks.sqlite"), poll_interval=0.01)
+
+
+def test_backend_leases_tasks_round_robin(backend):
+    for task in make_tasks("a", 2) + make_tasks("b", 2):
+        backend.put(task, OWNER)
+    rooms = [backend.lease(0, 60).task_group.room for _ in range(4)]
+    assert rooms == ["a", "b", "a", "b"]
+    assert backend.lease(0, 60) is None
+
+
+def test_backend_completes_task_once(backend):
+    task = make_tasks("a", 1)[0]
+    backend.put(task, OWNER)
+    leased = backend.lease(0, 60)
+    assert leased.id == task.id and leased.attempts == 1
+    assert backend.renew(task.id, 60)
+    assert backend.complete(task.id).id == task.id
+    assert backend.complete(task.id) is None
+    assert not backend.renew(task.id, 60)
+
+
+def test_backend_requeues_expired_lease(backend):
+    task = make_tasks("a", 1)[0]
+    backend.put(task, OWNER)
+    backend.lease(0, -1)
+    expired = backend.expire_leases(OWNER)
+    assert [t.id for t in expired] == [task.id]
+    assert backend.expire_leases(OWNER) == []
+    assert backend.qsize() == 0
+    backend.requeue(expired[0])
+    assert backend.qsize() == 1
+    leased = backend.lease(0, 60)
+    assert leased.id == task.id and leased.attempts == 2
+
+
+def test_backend_keeps_unexpired_lease(backend):
+    backend.put(make_tasks("a", 1)[0], OWNER)
+    backend.lease(0, 60)
+    assert backend.expire_leases(OWNER) == []
+
+
+def test_backend_discards_queued_tasks_of_group(backend):
+    tasks = make_tasks("a", 2)
+    other_task = make_tasks("b", 1)[0]
+    for task in tasks + [other_task]:
+        backend.put(task, OWNER)
+    backend.discard_group(tasks[0].task_group.id)
+    assert [task.id for task in backend.queued_tasks()] == [other_task.id]
+    assert backend.lease(0, 60).id == other_task.id
+    assert backend.lease(0, 60) is None
+
+
+def test_sqlite_backend_leases_each_task_once_across_instances(tmp_path):
+    path = str(tmp_path / "tasks.sqlite")
+    backends = [SQLiteTaskQueueBackend(path, poll_interval=0.01) for _ in range(2)]
+    tasks = make_tasks("a", 3) + make_tasks("b", 3)
+    for i, task in enumerate(tasks):
+        backends[i % 2].put(task, OWNER)
+    leased = [backends[i % 2].lease(0, 60) for i in range(len(tasks))]
+    assert sorted(task.id for task in leased) == sorted(task.id for task in tasks)
+    assert [task.task_group.room for task in leased] == ["a", "b"] * 3
+    assert all(backend.lease(0, 60) is None for backend in backends)
+    assert backends[1].complete(leased[0].id).id == leased[0].id
+    assert backends[0].complete(leased[0].id) is None
+
+
+def test_sqlite_backend_expires_only_leases_of_owner(tmp_path):
+    backend = SQLiteTaskQueueBackend(str(tmp_path / "tasks.sqlite"))
+    task = make_tasks("a", 1)[0]
+    backend.put(task, OWNER)
+    backend.lease(0, -1)
+    assert backend.expire_leases("instance-2") == []
+    assert [t.id for t in backend.expire_leases(OWNER)] == [task.id]
+
+
+def test_sqlite_backend_hands_over_results(tmp_path):
+    path = str(tmp_path / "tasks.sqlite")
+    owner_backend, other_backend = (SQLiteTaskQueueBackend(path) for _ in range(2))
+    task = make_tasks("a", 1)[0]
+    owner_backend.put(task, OWNER)
+    other_backend.lease(0, 60)
+    other_backend.post_results(task.id, {"count": 3})
+    assert other_backend.fetch_results("instance-2") == []
+    assert owner_backend.fetch_results(OWNER) == [
+        (task.task_group.id, {"count": 3, "task_id": task.id})
+    ]
+    assert owner_backend.fetch_results(OWNER) == []
+
+
+def test_manager_abandons_task_after_max_attempts():
+    gpu_manager = GPUManager(lease_duration=-1, max_attempts=2)
+    abandoned = []
+    gpu_manager.add_abandoned_task_listener(
+        Listener(lambda task: abandoned.append(task))
+    )
+    task_group = gpu_manager.add_task_group("a", 1, GPUTaskTypes.egg)
+    gpu_manager.add_task(task_group, "a-0.png")
+    assert gpu_manager.get_task().attempts == 1
+    # the first attempt's lease expired, so the task is requeued
+    assert gpu_manager.get_task().attempts == 2
+    assert gpu_manager.get_task() == {}
+    assert len(abandoned) == 1 and abandoned[0].img_path == "a-0.png"
+    assert gpu_manager.complete_task(abandoned[0].id) is None
+
+
+def test_manager_queue_status_counts_leased_and_deferred_tasks():
+    gpu_manager = GPUManager(
+        admission_controller=AdmissionController(max_tasks_per_room=2)
+    )
+    task_group = gpu_manager.add_task_group("a", 4, GPUTaskTypes.egg)
+    for i in range(4):
+        gpu_manager.add_task(task_group, f"a-{i}.png")
+    gpu_manager.get_task()
+    other_group = gpu_manager.add_task_group("b", 1, GPUTaskTypes.egg)
+    gpu_manager.add_task(other_group, "b-0.png")
+    other_task = gpu_manager.get_task()
+    statuses = gpu_manager.queue_status()
+    assert {room: status["queued"] for room, status in statuses.items()} == {
+        "a": 1,
+        "b": 0,
+    }
+    assert statuses["a"]["processing"] == 1 and statuses["a"]["deferred"] == 2
+    assert statuses["b"]["processing"] == 1 and statuses["b"]["position"] == 1
+    assert statuses["a"]["position"] == 0
+    gpu_manager.complete_task(other_task.id)
+    assert "b" not in gpu_manager.queue_status()
+    assert gpu_manager.queue_status_for_room("b")["completion_time"] is None